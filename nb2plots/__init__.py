@@ -1,18 +1,34 @@
 # nb2plots package
 
+from importlib import import_module
+
 from . import _version
 __version__ = _version.get_versions()['version']
 
-from . import nbplots
-from . import runroles
-from . import mpl_interactive
-from . import codelinks
-from . import sphinx2foos
+# Import the Sphinx extension modules on first use, so command-line scripts
+# can import nb2plots modules that do not need Sphinx, without importing
+# Sphinx.
+_SUBMODULES = ('nbplots', 'runroles', 'mpl_interactive', 'codelinks',
+               'sphinx2foos')
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return import_module('.' + name, __name__)
+    if name == 'build_all':
+        from .multibuild import build_all
+        return build_all
+    raise AttributeError('module {!r} has no attribute {!r}'.format(
+        __name__, name))
 
 
 def setup(app):
+    from . import nbplots, runroles, mpl_interactive, codelinks, sphinx2foos
     nbplots.setup(app)
     runroles.setup(app)
     mpl_interactive.setup(app)
     codelinks.setup(app)
     sphinx2foos.setup(app)
+    return {'version': __version__,
+            'parallel_read_safe': True,
+            'parallel_write_safe': True}
@@ -44,6 +44,46 @@ set in the ``conf.py`` file.
         Default value for Jupyter kernel timeout when executing notebooks
         during page build.  If not set, default is 30 seconds. Set to -1 or
         None to disable timeout.
+
+    fill_notebook_jobs
+        Maximum number of full notebooks to execute at the same time, each in
+        its own worker process and Jupyter kernel.  If greater than 1, we
+        report errors for all the notebooks that failed, after writing the
+        notebooks that succeeded.  Default is 1.
+
+    fill_notebook_kernel_pool
+        If True, keep Jupyter kernels running between notebooks, instead of
+        starting a new kernel for each notebook.  After each notebook, we
+        reset the kernel by closing figures, returning to the original working
+        directory and clearing the namespace, and restore the matplotlib,
+        numpy and pandas settings, random states, ``sys.path`` and warning
+        filters.  Modules stay imported.  With
+        ``fill_notebook_jobs`` greater than 1, each worker process starts its
+        own kernel.  Default is False.
+
+    fill_notebook_kernel_uses
+        With ``fill_notebook_kernel_pool``, replace a kernel after it has
+        executed this many notebooks.  Default is 20.
+
+    fill_notebook_kernel_memory
+        With ``fill_notebook_kernel_pool``, replace a kernel when its process
+        uses more than this many megabytes of memory after the reset that
+        follows each notebook.  Default is None (no memory limit).
+
+    fill_notebook_cache
+        If True, store full notebooks in an on-disk cache, and reuse their
+        outputs in later builds, instead of running the notebook again.  The
+        cache key covers the code cells of the notebook, in order, the kernel
+        spec, and the timeout, but not the text between the code cells, so
+        changes to the text do not run the notebook again.  The key does not
+        cover any data files that the code reads, or the installed libraries;
+        delete the cache directory to force a fresh run.  Default is False.
+
+    fill_notebook_cache_dir
+        Directory for the notebook cache.  If None (the default), use a
+        ``fill_notebook_cache`` directory next to the ``doctrees`` directory
+        of the build.  If the directory is relative, it is relative to the
+        directory containing ``conf.py``.
 """
 
 from docutils.statemachine import StringList
@@ -119,3 +159,11 @@ def setup(app):
                  **{builder: (null, null)
                     for builder in ('html', 'latex', 'text', 'texinfo')})
     app.add_config_value('fill_notebook_timeout', 30, True)
+    app.add_config_value('fill_notebook_jobs', 1, True)
+    app.add_config_value('fill_notebook_kernel_pool', False, True)
+    app.add_config_value('fill_notebook_kernel_uses', 20, True)
+    app.add_config_value('fill_notebook_kernel_memory', None, True)
+    app.add_config_value('fill_notebook_cache', False, True)
+    app.add_config_value('fill_notebook_cache_dir', None, True)
+    return {'parallel_read_safe': True,
+            'parallel_write_safe': True}
@@ -1,31 +1,548 @@
 """ Support for command-line scripts
 """
 
+import os
+from os.path import (join as pjoin, isdir, dirname, relpath, splitext,
+                     abspath, realpath)
 import sys
+from glob import glob, has_magic
 from argparse import ArgumentParser
+import traceback
 
-from .converters import NbConverter
+from . import server
+
+# Import Sphinx, and modules using Sphinx, only when converting in this
+# process, so we can send conversions to the server quickly.
+
+
+def builder_suffix(buildername):
+    """ Return output file suffix for builder `buildername`
+    """
+    from sphinx.builders.xml import PseudoXMLBuilder
+    from .sphinx2foos import MarkdownBuilder, PythonBuilder, NotebookBuilder
+    for builder in (MarkdownBuilder, PythonBuilder, NotebookBuilder,
+                    PseudoXMLBuilder):
+        if builder.name == buildername:
+            return builder.out_suffix
+    return '.' + buildername
 
 
 def get_parser(description):
     """ Get parser for sphinx2something utilities
     """
     parser = ArgumentParser(description=description)
-    parser.add_argument('rst_file', help = 'ReST file to convert')
+    parser.add_argument('rst_files', nargs='+', metavar='rst_file',
+                        help='ReST file to convert, or glob pattern, or '
+                        'directory to search for .rst files')
+    parser.add_argument('-o', '--output-dir',
+                        help='directory to which to write output files; '
+                        'required for more than one input file; without '
+                        'it, write output to stdout')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes for converting files')
     parser.add_argument('-W', '--warn-is-error', action='store_true',
                         help = 'turn warnings into errors')
+    parser.add_argument('--server', action='store_true',
+                        help='send conversions to nb2plots-server, if '
+                        'running; convert in this process otherwise')
     return parser
 
 
+def _glob_root(pattern):
+    """ Return leading directory of glob `pattern` without glob characters
+    """
+    parts = []
+    for part in pattern.split(os.sep):
+        if has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts)
+
+
+def find_files(paths, suffix='.rst'):
+    """ Return input files and output paths from file, glob and dir `paths`
+
+    Parameters
+    ----------
+    paths : sequence
+        Sequence of paths to input files, glob patterns, or directories.  We
+        search directories, recursively, for files ending in `suffix`,
+        skipping hidden directories, such as ``.ipynb_checkpoints``.
+    suffix : str, optional
+        Suffix of input files to find in directories.
+
+    Returns
+    -------
+    in_files : list
+        List of ``(in_file, rel_path)`` tuples, where ``rel_path`` is the
+        path of the file relative to the directory, or the directory part of
+        the glob pattern, or the directory containing the file.
+
+    Raises
+    ------
+    ValueError
+        If two different input files have the same ``rel_path``, apart from
+        the suffix, so their outputs would overwrite each other.
+    """
+    in_files = []
+    for path in paths:
+        if isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = sorted(d for d in dirnames
+                                     if not d.startswith('.'))
+                for fname in sorted(filenames):
+                    if fname.endswith(suffix):
+                        in_file = pjoin(dirpath, fname)
+                        in_files.append((in_file, relpath(in_file, path)))
+        elif has_magic(path):
+            root = _glob_root(path)
+            for in_file in sorted(glob(path, recursive=True)):
+                in_files.append((in_file, relpath(in_file, root or '.')))
+        else:
+            in_files.append((path, os.path.basename(path)))
+    _check_outputs(in_files)
+    return in_files
+
+
+def _check_outputs(in_files):
+    """ Raise ValueError if different input files have the same output
+    """
+    by_output = {}
+    for in_file, rel_path in in_files:
+        key = os.path.normcase(splitext(rel_path)[0])
+        other = by_output.setdefault(key, in_file)
+        if realpath(other) != realpath(in_file):
+            raise ValueError(
+                'Input files {} and {} would both write output {}'.format(
+                    other, in_file, splitext(rel_path)[0]))
+
+
+# Warm converter for worker process.
+_converter = None
+
+
+def _close_converter():
+    global _converter
+    if _converter is not None:
+        _converter.close()
+        _converter = None
+
+
+def init_converter(buildername, warningiserror):
+    """ Set up warm converter for converting files in this process
+    """
+    import multiprocessing.util
+    from .converters import WarmNbConverter
+    global _converter
+    _converter = WarmNbConverter(buildername,
+                                 status=None,
+                                 warningiserror=warningiserror)
+    # Remove Sphinx application temporary directory at process exit.
+    multiprocessing.util.Finalize(None, _close_converter, exitpriority=10)
+
+
+def _write_output(out_file, output):
+    out_path = dirname(out_file)
+    if out_path and not isdir(out_path):
+        os.makedirs(out_path, exist_ok=True)
+    with open(out_file, 'wb') as fobj:
+        fobj.write(output.encode('utf-8'))
+
+
+def convert_file(rst_file, out_file):
+    """ Convert `rst_file` to `out_file` with process converter
+
+    Return None on success, or an error message.
+    """
+    try:
+        with open(rst_file, 'rt') as fobj:
+            contents = fobj.read()
+        output = _converter.from_rst(contents)
+    except Exception:
+        return traceback.format_exc()
+    _write_output(out_file, output)
+    return None
+
+
+def convert_file_with_server(rst_file, out_file, buildername,
+                             warningiserror=False):
+    """ Convert `rst_file` to `out_file` with server
+
+    Return None on success, or an error message.
+    """
+    with open(rst_file, 'rt') as fobj:
+        contents = fobj.read()
+    try:
+        output = server.convert(contents, buildername, warningiserror)
+    except server.ServerError as e:
+        return str(e)
+    _write_output(out_file, output)
+    return None
+
+
+# Result for file that the server did not convert.
+_NOT_CONVERTED = object()
+
+
+def convert_files(rst_files, output_dir, buildername, warningiserror=False,
+                  jobs=1, use_server=False):
+    """ Convert `rst_files` to files in `output_dir`
+
+    Parameters
+    ----------
+    rst_files : list
+        List of ``(rst_file, rel_path)`` tuples, as returned by
+        :func:`find_files`.  We write the output for ``rst_file`` to
+        ``rel_path`` in `output_dir`, with the suffix for `buildername`.
+    output_dir : str
+        Output directory.
+    buildername : str
+        Name of builder for output format.
+    warningiserror : {False, True}, optional
+        If True, raise an error for warning during the Sphinx build.
+    jobs : int, optional
+        Number of processes in which to convert files.  Each process keeps
+        a warm converter (see :class:`nb2plots.converters.WarmConverter`).
+        With `use_server`, the number of files to send to the server at the
+        same time.
+    use_server : {False, True}, optional
+        If True, and the server is running, send the conversions to the server
+        (see :mod:`nb2plots.server`).  If the server stops during the
+        conversions, convert the remaining files in this process, or in
+        `jobs` processes.
+
+    Returns
+    -------
+    errors : dict
+        Dict with key, value pairs of ReST file name and error message, for
+        files that failed to convert.
+    """
+    suffix = builder_suffix(buildername)
+    out_files = [pjoin(output_dir, splitext(rel_path)[0] + suffix)
+                 for rst_file, rel_path in rst_files]
+    in_files = [rst_file for rst_file, rel_path in rst_files]
+    if use_server and server.server_running():
+        from concurrent.futures import ThreadPoolExecutor
+
+        def convert_with_server(in_file, out_file):
+            try:
+                return convert_file_with_server(in_file, out_file,
+                                                buildername, warningiserror)
+            except OSError:  # Server died; convert in process below.
+                return _NOT_CONVERTED
+
+        with ThreadPoolExecutor(max(jobs, 1)) as executor:
+            results = list(executor.map(convert_with_server,
+                                        in_files, out_files))
+        missed = [i for i, result in enumerate(results)
+                  if result is _NOT_CONVERTED]
+        if missed:
+            errors = convert_files([rst_files[i] for i in missed],
+                                   output_dir,
+                                   buildername,
+                                   warningiserror=warningiserror,
+                                   jobs=jobs)
+            for i in missed:
+                results[i] = errors.get(rst_files[i][0])
+    elif jobs < 2:
+        init_converter(buildername, warningiserror)
+        try:
+            results = [convert_file(rst_file, out_file) for
+                       (rst_file, rel_path), out_file in
+                       zip(rst_files, out_files)]
+        finally:
+            _close_converter()
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs,
+                                 initializer=init_converter,
+                                 initargs=(buildername,
+                                           warningiserror)) as executor:
+            results = list(executor.map(convert_file, in_files, out_files))
+    return {rst_file: error for (rst_file, rel_path), error in
+            zip(rst_files, results) if error is not None}
+
+
 def do_main(description, buildername):
     """ Get main clause for sphinx2something utilities
     """
     parser = get_parser(description)
     args = parser.parse_args()
-    with open(args.rst_file, 'rt') as fobj:
-        contents = fobj.read()
-    converter = NbConverter(buildername,
-                            status=sys.stderr,
-                            warningiserror=args.warn_is_error)
-    output = converter.from_rst(contents)
-    sys.stdout.buffer.write(output.encode('utf-8'))
+    try:
+        rst_files = find_files(args.rst_files)
+    except ValueError as e:
+        parser.error(str(e))
+    if len(rst_files) == 0:
+        parser.error('no input files')
+    if args.output_dir is None:
+        if len(rst_files) != 1:
+            parser.error('Need --output-dir for more than one input file')
+        with open(rst_files[0][0], 'rt') as fobj:
+            contents = fobj.read()
+        output = None
+        if args.server:
+            try:
+                output = server.convert(contents, buildername,
+                                        args.warn_is_error)
+            except OSError:  # Server not running
+                pass
+            except server.ServerError as e:
+                sys.stderr.write('{}\n'.format(e))
+                sys.exit(1)
+        if output is None:
+            from .converters import NbConverter
+            converter = NbConverter(buildername,
+                                    status=sys.stderr,
+                                    warningiserror=args.warn_is_error)
+            output = converter.from_rst(contents)
+        sys.stdout.buffer.write(output.encode('utf-8'))
+        return
+    errors = convert_files(rst_files,
+                           args.output_dir,
+                           buildername,
+                           warningiserror=args.warn_is_error,
+                           jobs=args.jobs,
+                           use_server=args.server)
+    for rst_file, error in sorted(errors.items()):
+        sys.stderr.write('Error converting {}:\n{}\n'.format(rst_file, error))
+    sys.exit(1 if errors else 0)
+
+
+# Name of file in output directory recording hashes of converted notebooks.
+NB_HASHES_NAME = '.nb2plots_hashes.json'
+
+# Notebook exporter for worker process.
+_exporter = None
+
+
+def init_exporter():
+    """ Set up notebook exporter for converting notebooks in this process
+    """
+    from .from_notebook import make_exporter
+    global _exporter
+    _exporter = make_exporter()
+
+
+def file_hash(fname):
+    """ Return SHA256 hex digest of contents of file `fname`
+    """
+    from hashlib import sha256
+    digest = sha256()
+    with open(fname, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(2 ** 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def convert_notebook(nb_file, out_file):
+    """ Convert notebook `nb_file` to ReST file `out_file`
+
+    Use the process exporter, if set up (see :func:`init_exporter`).
+
+    Return None on success, or an error message.
+    """
+    from .from_notebook import convert_nb_fname
+    try:
+        rst_text = convert_nb_fname(nb_file, _exporter) + '\n'
+    except Exception:
+        return traceback.format_exc()
+    _write_output(out_file, rst_text)
+    return None
+
+
+def _hash_key(nb_file, output_dir):
+    """ Return key for `nb_file` in notebook hashes file of `output_dir`
+    """
+    try:
+        path = relpath(abspath(nb_file), abspath(output_dir))
+    except ValueError:  # Different drives on Windows
+        path = abspath(nb_file)
+    return path.replace(os.sep, '/')
+
+
+def convert_notebooks(nb_files, output_dir, jobs=1, force=False):
+    """ Convert notebooks `nb_files` to ReST files in `output_dir`
+
+    Skip notebooks that have not changed since we last converted them to
+    `output_dir`.  We record the hash of each notebook we convert, with the
+    nb2plots version, in the file ``.nb2plots_hashes.json`` in `output_dir`.
+    The file has an entry for each notebook, keyed by the path of the
+    notebook relative to `output_dir`, giving the notebook hash and the
+    output file.  When we write an output file, we drop the entries of other
+    notebooks that wrote the same output file.
+
+    Parameters
+    ----------
+    nb_files : list
+        List of ``(nb_file, rel_path)`` tuples, as returned by
+        :func:`find_files`.  We write the output for ``nb_file`` to
+        ``rel_path`` in `output_dir`, with suffix ``.rst``.
+    output_dir : str
+        Output directory.
+    jobs : int, optional
+        Number of processes in which to convert notebooks.  Each process keeps
+        one notebook exporter.
+    force : {False, True}, optional
+        If True, convert all notebooks, whether or not they have changed.
+
+    Returns
+    -------
+    errors : dict
+        Dict with key, value pairs of notebook file name and error message,
+        for notebooks that failed to convert.
+    skipped : list
+        List of notebook file names that we did not convert, because they had
+        not changed.
+    """
+    import json
+    from . import __version__
+    hashes_fname = pjoin(output_dir, NB_HASHES_NAME)
+    old_hashes = {}
+    if not force and os.path.isfile(hashes_fname):
+        with open(hashes_fname, 'rt') as fobj:
+            old_hashes = json.load(fobj)
+        if old_hashes.pop('__version__', None) != __version__:
+            old_hashes = {}
+    to_convert, skipped, hashes = [], [], {}
+    for nb_file, rel_path in nb_files:
+        out_rel = splitext(rel_path)[0] + '.rst'
+        out_file = pjoin(output_dir, out_rel)
+        key = _hash_key(nb_file, output_dir)
+        hashes[key] = dict(sha256=file_hash(nb_file),
+                           output=out_rel.replace(os.sep, '/'))
+        if old_hashes.get(key) == hashes[key] and os.path.isfile(out_file):
+            skipped.append(nb_file)
+        else:
+            to_convert.append((nb_file, out_file, key))
+    in_files = [nb_file for nb_file, out_file, key in to_convert]
+    out_files = [out_file for nb_file, out_file, key in to_convert]
+    if jobs < 2 or len(to_convert) < 2:
+        init_exporter()
+        results = [convert_notebook(nb_file, out_file) for
+                   nb_file, out_file in zip(in_files, out_files)]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs,
+                                 initializer=init_exporter) as executor:
+            results = list(executor.map(convert_notebook,
+                                        in_files,
+                                        out_files))
+    errors = {}
+    for (nb_file, out_file, key), error in zip(to_convert, results):
+        if error is not None:
+            errors[nb_file] = error
+            del hashes[key]
+    # Keep hashes of notebooks converted in earlier runs, unless we have
+    # written over their output files.
+    outputs = set(entry['output'] for entry in hashes.values())
+    old_hashes = {key: entry for key, entry in old_hashes.items()
+                  if isinstance(entry, dict) and
+                  entry.get('output') not in outputs}
+    old_hashes.update(hashes)
+    old_hashes['__version__'] = __version__
+    if not isdir(output_dir):
+        os.makedirs(output_dir)
+    with open(hashes_fname, 'wt') as fobj:
+        json.dump(old_hashes, fobj, indent=1, sort_keys=True)
+    return errors, skipped
+
+
+def do_nb2plots():
+    """ Main clause for nb2plots utility
+    """
+    parser = ArgumentParser(
+        description="Convert notebook to ReST format with plot directives")
+    parser.add_argument('notebooks', nargs='+', metavar='notebook',
+                        help='notebook file to convert, or glob pattern, or '
+                        'directory to search for .ipynb files')
+    parser.add_argument('-o', '--output-dir',
+                        help='directory to which to write ReST files; '
+                        'required for more than one notebook; without it, '
+                        'write ReST to stdout')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes for converting notebooks')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='convert all notebooks, including those that '
+                        'have not changed since the last conversion to the '
+                        'output directory')
+    args = parser.parse_args()
+    try:
+        nb_files = find_files(args.notebooks, '.ipynb')
+    except ValueError as e:
+        parser.error(str(e))
+    if len(nb_files) == 0:
+        parser.error('no input files')
+    if args.output_dir is None:
+        if len(nb_files) != 1:
+            parser.error('Need --output-dir for more than one notebook')
+        from .from_notebook import convert_nb_fname
+        rst_text = convert_nb_fname(nb_files[0][0]) + '\n'
+        sys.stdout.buffer.write(rst_text.encode('utf-8'))
+        return
+    errors, skipped = convert_notebooks(nb_files,
+                                        args.output_dir,
+                                        jobs=args.jobs,
+                                        force=args.force)
+    if skipped:
+        sys.stderr.write('Skipped {} unchanged notebooks\n'.format(
+            len(skipped)))
+    for nb_file, error in sorted(errors.items()):
+        sys.stderr.write('Error converting {}:\n{}\n'.format(nb_file, error))
+    sys.exit(1 if errors else 0)
+
+
+def do_build_all():
+    """ Main clause for sphinx2all utility
+    """
+    from .multibuild import build_all, DEFAULT_BUILDERS
+    parser = ArgumentParser(
+        description='Build Sphinx project with several builders, reading '
+        'the sources once')
+    parser.add_argument('srcdir', help='Sphinx source directory')
+    parser.add_argument('outdir',
+                        help='Output directory; each builder writes to a '
+                        'subdirectory named for the builder')
+    parser.add_argument('-b', '--builder', action='append', dest='builders',
+                        help='builder to run; can be given more than once '
+                        '(default {})'.format(', '.join(DEFAULT_BUILDERS)))
+    parser.add_argument('-c', '--confdir',
+                        help='directory containing conf.py (default srcdir)')
+    parser.add_argument('-d', '--doctreedir',
+                        help='directory for doctrees and environment '
+                        '(default OUTDIR/.doctrees)')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='number of processes for parallel read and write')
+    parser.add_argument('-W', '--warn-is-error', action='store_true',
+                        help = 'turn warnings into errors')
+    args = parser.parse_args()
+    app = build_all(args.srcdir, args.outdir,
+                    builders=(DEFAULT_BUILDERS if args.builders is None
+                              else args.builders),
+                    doctreedir=args.doctreedir,
+                    confdir=args.confdir,
+                    warningiserror=args.warn_is_error,
+                    parallel=args.jobs)
+    sys.exit(app.statuscode)
+
+
+def do_server():
+    """ Main clause for nb2plots-server utility
+    """
+    parser = ArgumentParser(
+        description='Serve fast conversions from ReST for the sphinx2* '
+        'scripts, when run with --server')
+    parser.add_argument('-s', '--socket',
+                        help='path of Unix socket on which to listen '
+                        '(default from {} environment variable, or {})'.format(
+                            server.SOCKET_VAR, server.default_socket_path()))
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes for converting')
+    parser.add_argument('-b', '--builder', action='append', dest='builders',
+                        help='builder for which to keep a warm converter '
+                        'from start-up; can be given more than once '
+                        '(default {})'.format(', '.join(server.WARM_BUILDERS)))
+    args = parser.parse_args()
+    server.serve(args.socket,
+                 jobs=args.jobs,
+                 buildernames=(server.WARM_BUILDERS if args.builders is None
+                               else args.builders))
@@ -5,21 +5,9 @@ import sys
 from os.path import join as pjoin
 from importlib import import_module
 
-from docutils.io import Output
-
 from sphinxtesters import TempApp
 
-
-class UnicodeOutput(Output):
-    """ Don't do anything to the string; just return it.
-    """
-
-    default_destination_path = '<string>'
-
-    def write(self, data):
-        """ Store `data` in `self.destination`, and return it."""
-        self.destination = data
-        return data
+from .unicodeio import UnicodeOutput
 
 
 class Converter(object):
@@ -88,7 +76,7 @@ class Converter(object):
             dt = app.env.get_doctree(master_doc)
         return dt, app
 
-    def from_doctree(self, doctree, builder):
+    def from_doctree(self, doctree, builder, docname=None):
         """ Convert doctree `doctree` to output format
 
         Parameters
@@ -97,13 +85,20 @@ class Converter(object):
             Document node.
         builder : object
             Sphinx builder object.
+        docname : None or str, optional
+            Name of document for `doctree`.  If None, use name of master
+            document.
 
         Returns
         ------
         output : str
             Representation in output format
         """
-        builder.prepare_writing([builder.config.master_doc])
+        if docname is None:
+            docname = builder.config.master_doc
+        builder.prepare_writing([docname])
+        # Set current docname for writer to work out link targets
+        builder.current_docname = docname
         return builder.writer.write(doctree, UnicodeOutput())
 
     def from_rst(self, rst_text, resolve=True):
@@ -126,6 +121,115 @@ class Converter(object):
         app.cleanup()
         return res
 
+    def from_rst_many(self, rst_texts, resolve=True, jobs=1):
+        """ Build many Sphinx formatted ReST texts in one Sphinx build
+
+        Each text becomes a separate document in the same Sphinx project, so
+        the texts can't refer to each other's labels, and each has its own
+        nbplot namespace.
+
+        Parameters
+        ----------
+        rst_texts : mapping
+            Mapping with values being strings containing ReST to build.
+        resolve : {True, False}, optional
+            Whether to resolve references before returning doctree.
+        jobs : int, optional
+            Number of processes in which Sphinx reads the documents.  Sphinx
+            only reads in parallel if there are more than 5 documents, and we
+            only ask it to, if all the extensions declare they are safe for
+            parallel reading.
+
+        Returns
+        -------
+        outputs : dict
+            Dict with the same keys as `rst_texts`, and values being the
+            texts in output format.
+        """
+        names = {'doc{:06d}'.format(i): key
+                 for i, key in enumerate(rst_texts)}
+        # List documents in master document, to avoid warnings.
+        master_text = '.. toctree::\n    :hidden:\n\n' + ''.join(
+            '    {}\n'.format(docname) for docname in names)
+        # Always use a new application.
+        app = Converter._make_app(self, master_text)
+        try:
+            for docname, key in names.items():
+                with open(pjoin(app.tmp_dir, docname + '.rst'), 'wt') as fobj:
+                    fobj.write(rst_texts[key])
+            if all(ext.parallel_read_safe
+                   for ext in app.extensions.values()):
+                app.parallel = jobs
+            app.build(True, [])
+            outputs = {}
+            for docname, key in names.items():
+                if resolve:
+                    dt = app.env.get_and_resolve_doctree(docname, app.builder)
+                else:
+                    dt = app.env.get_doctree(docname)
+                outputs[key] = self.from_doctree(dt, app.builder, docname)
+        finally:
+            app.cleanup()
+        return outputs
+
+
+class WarmConverter(Converter):
+    """ Converter keeping one Sphinx application for all conversions
+
+    Making the Sphinx application, and loading the extensions, takes much
+    longer than building a short document.  This converter makes the
+    application for the first conversion, and reuses it for later
+    conversions, replacing the master document each time.
+
+    Call :meth:`close` to delete the application and its temporary directory
+    when done, or use the converter as a context manager.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(WarmConverter, self).__init__(*args, **kwargs)
+        self._app = None
+
+    def _make_app(self, rst_text):
+        """ Return Sphinx application instance, making it if necessary
+        """
+        if self._app is None:
+            self._app = super(WarmConverter, self)._make_app(rst_text)
+        return self._app
+
+    def _build_rst(self, rst_text, resolve=True):
+        app = self._make_app(rst_text)
+        # Sphinx keeps doctrees it has loaded; throw away the previous one.
+        master_doc = app.config.master_doc
+        for name in ('_pickled_doctree_cache', '_write_doc_doctree_cache'):
+            getattr(app.env, name, {}).pop(master_doc, None)
+        try:
+            return super(WarmConverter, self)._build_rst(rst_text, resolve)
+        except Exception:
+            # Application may be in any state after a failed build.
+            self.close()
+            raise
+
+    def from_rst(self, rst_text, resolve=True):
+        """ Build Sphinx formatted ReST text `rst_text` into output format
+
+        See :meth:`Converter.from_rst` for parameters.
+        """
+        doctree, app = self._build_rst(rst_text, resolve)
+        return self.from_doctree(doctree, app.builder)
+
+    def close(self):
+        """ Delete Sphinx application and its temporary directory
+        """
+        if self._app is not None:
+            self._app.cleanup()
+            self._app = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 
 def can_import(module_str):
     try:
@@ -154,6 +258,10 @@ class NbConverter(Converter):
     default_conf = DEFAULT_CONF
 
 
+class WarmNbConverter(WarmConverter):
+    default_conf = DEFAULT_CONF
+
+
 # Some standard converters
 to_pxml = NbConverter('pseudoxml')
 to_markdown = NbConverter('markdown')
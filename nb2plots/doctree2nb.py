@@ -2,25 +2,31 @@
 """
 from docutils import nodes
 
-from nbformat import v4 as nbf
-
 from . import doctree2py as d2py
 
 
 class Translator(d2py.Translator):
 
     def _init_output(self):
+        from nbformat import v4 as nbf
         self._notebook = nbf.new_notebook()
 
     def _add_text_block(self, txt):
+        from nbformat import v4 as nbf
         self._notebook['cells'].append(nbf.new_markdown_cell(txt))
 
+    def notebook(self):
+        """ Return the document as a notebook node """
+        self.flush_text()
+        return self._notebook
+
     def astext(self):
         """ Return the document as a string """
-        self.flush_text()
-        return nbf.writes(self._notebook)
+        from nbformat import v4 as nbf
+        return nbf.writes(self.notebook())
 
     def add_code_block(self, txt):
+        from nbformat import v4 as nbf
         self.flush_text()
         self._notebook['cells'].append(nbf.new_code_cell(txt))
 
@@ -34,3 +40,13 @@ class Writer(d2py.Writer):
     """Formats this writer supports."""
 
     translator_class = Translator
+
+    def to_notebook(self, document):
+        """ Return notebook node translated from `document`
+
+        Use this rather than ``write`` to work with the notebook, without
+        writing the notebook to JSON and reading it back.
+        """
+        visitor = self.translator_class(document, self.builder)
+        document.walkabout(visitor)
+        return visitor.notebook()
@@ -0,0 +1,10 @@
+""" Module for fork server to import before running nbplot code
+
+Importing this module imports pyplot with the Agg backend, as for the nbplot
+directives, so the processes forked from the server do not pay to import
+pyplot.  See :func:`nb2plots.nbplots.fork_pool_kwargs`.
+"""
+
+from .nbplots import _pyplot
+
+_pyplot()
@@ -1,63 +1,28 @@
 #!python
 """ Convert from notebook to rst page with plot directives
+
+We walk the notebook cells, and write the ReST for each cell.  Code cells
+become nbplot directives, with the code as doctest input, and the printed
+output and the final result of the cell as doctest output.  Other cells and
+outputs have the same ReST as for the nbconvert ReST template.
 """
 
+import os
 import re
+import mmap
 
-from jinja2 import DictLoader
-
-import traitlets
+from traitlets import default
 import traitlets.config as config
 import nbformat
-import nbconvert
+from nbconvert.exporters import Exporter
+from nbconvert.filters import (DataTypeFilter, indent, strip_ansi,
+                               strip_dollars, convert_pandoc)
 
 
 MPL_INLINE = re.compile(r"^\s*%\s*matplotlib\s+(inline|nbagg)\s*$",
                         re.MULTILINE)
 
 
-# Template to label code and output and plot blocks
-dl = DictLoader({'rst_plots.tpl': """\
-{%- extends '__RST_DEFAULT_TEMPLATE__' -%}
-
-{% block input %}
-{%- if cell.source.strip() | has_mpl_inline -%}
-.. mpl-interactive::
-
-{% endif -%}
-{%- if cell.source.strip() | strip_ipy -%}
-##CODE_START##
-{{ cell.source | strip_ipy | to_doctests | indent}}
-##CODE_END##
-{% endif -%}
-{% endblock input %}
-
-{%- block execute_result -%}
-{%- block data_priority scoped -%}
-{{ super() }}
-{%- endblock -%}
-{%- endblock execute_result -%}
-
-{%- block data_svg -%}
-{%- endblock data_svg -%}
-{%- block data_png -%}
-{%- endblock data_png -%}
-
-{%- block stream -%}
-##STDOUT_START##
-{{ output.text | ellipse_mpl | indent }}
-##STDOUT_END##
-{%- endblock stream -%}
-
-{%- block data_text scoped -%}
-##END_OUT_START##
-{{ output.data['text/plain'] | ellipse_mpl | indent }}
-##END_OUT_END##
-{%- endblock data_text -%}
-""".replace('__RST_DEFAULT_TEMPLATE__',
-            nbconvert.RSTExporter().template_file)})
-
-
 def has_mpl_inline(code):
     return MPL_INLINE.search(code)
 
@@ -103,57 +68,335 @@ def ellipse_mpl(text):
     return MPL_OBJ_OUT.sub('<...>', text)
 
 
-class PlotsExporter(nbconvert.RSTExporter):
-    template_file = 'rst_plots.tpl'
-    filters = traitlets.Dict(dict(
-        has_mpl_inline=has_mpl_inline,
-        to_doctests=to_doctests,
-        strip_ipy=strip_ipy,
-        ellipse_mpl=ellipse_mpl,
-    ), config=True)
+PLOT_DIRECTIVE_PREFIX = """\
+.. nbplot::
 
+"""
 
-# Code, with option stdout and optional end-of-block output
-CODE_WITH_OUTPUT = re.compile(
-    '^##CODE_START##\n'
-    '(?P<code>.*?)'
-    '^##CODE_END##(\n|$)'
-    '([\\s\\n]*?'
-    '^##STDOUT_START##\n'
-    '(?P<stdout>.*?)'
-    '^##STDOUT_END##(\n|$))?'
-    '([\\s\\n]*?'
-    '^##END_OUT_START##\n'
-    '(?P<end_out>.*?)'
-    '^##END_OUT_END##(\n|$))?', re.S | re.M)
+# Raw cell types that we copy to the ReST output.
+RAW_MIMETYPES = ('text/x-rst', 'text/restructuredtext', '')
 
 
-PLOT_DIRECTIVE_PREFIX = """\
-.. nbplot::
+def _data_rst(data, data_type):
+    """ Return ReST for display `data` of type `data_type`, as for nbconvert
 
-"""
+    We do not write images; nbplot directives make their own figures.
+    """
+    if data_type == 'text/html':
+        return '\n.. raw:: html\n\n' + indent(data['text/html']) + '\n'
+    if data_type == 'text/latex':
+        return ('\n.. math::\n\n' +
+                indent(strip_dollars(data['text/latex'])) + '\n')
+    if data_type == 'text/markdown':
+        return ('\n' + convert_pandoc(data['text/markdown'], 'markdown',
+                                      'rst') + '\n')
+    if data_type == 'text/x-rst':
+        return '\n' + data['text/x-rst'] + '\n'
+    if data_type == 'text/plain':
+        return ('\n.. parsed-literal::\n\n' +
+                indent(ellipse_mpl(data['text/plain'])) + '\n')
+    return ''
+
+
+def _cell_parts(cell, filter_data_type, raw_mimetypes):
+    """ Yield ``(kind, value)`` pairs for parts of notebook `cell`
+
+    `kind` is one of ``code`` (`value` is the cell source), ``stdout``
+    (`value` is text of a stream output), ``end_out`` (`value` is plain text
+    of a result or display output) or ``text`` (`value` is ReST text).  See
+    :func:`iter_rst`.
+    """
+    show_source = not cell.get('metadata', {}).get(
+        'transient', {}).get('remove_source', False)
+    if cell['cell_type'] == 'markdown':
+        if show_source:
+            yield 'text', ('\n' +
+                           convert_pandoc(cell['source'], 'markdown', 'rst') +
+                           '\n')
+        return
+    if cell['cell_type'] == 'raw':
+        mimetype = cell['metadata'].get('raw_mimetype', '').lower()
+        if show_source and mimetype in raw_mimetypes:
+            yield 'text', '\n' + cell['source'] + '\n'
+        return
+    if cell['cell_type'] != 'code':
+        return
+    if show_source:
+        source = cell['source']
+        stripped = source.strip()
+        yield 'text', '\n'
+        if has_mpl_inline(stripped):
+            yield 'text', '.. mpl-interactive::\n\n'
+        if strip_ipy(stripped):
+            yield 'code', source
+    outputs = cell.get('outputs', [])
+    if outputs:
+        yield 'text', '\n'
+    for output in outputs:
+        output_type = output['output_type']
+        if output_type == 'stream':
+            yield 'stdout', output['text']
+        elif output_type in ('execute_result', 'display_data'):
+            data_types = filter_data_type(output['data'])
+            if data_types and data_types[0] == 'text/plain':
+                yield 'text', '\n'
+                yield 'end_out', output['data']['text/plain']
+                yield 'text', '\n'
+            else:
+                yield 'text', ('\n' +
+                               (_data_rst(output['data'], data_types[0])
+                                if data_types else '') +
+                               '\n')
+        elif output_type == 'error':
+            yield 'text', ('\n::\n\n' +
+                           ''.join('\n' + strip_ansi(indent(line)) + '\n'
+                                   for line in output['traceback']) +
+                           '\n')
+
+
+def _directive_rst(code, stdout, end_out):
+    """ Return nbplot directive for `code`, with `stdout` and `end_out` texts
+    """
+    rst = (PLOT_DIRECTIVE_PREFIX +
+           indent(to_doctests(strip_ipy(code))) + '\n')
+    if end_out:
+        rst += indent(ellipse_mpl('\n'.join(end_out))) + '\n'
+    if stdout:
+        rst += '\n' + indent(ellipse_mpl(''.join(stdout))) + '\n'
+    return rst
 
-def repl_code_plot(match):
-    groups = match.groupdict(default='')
-    out = ''.join((PLOT_DIRECTIVE_PREFIX,
-                   groups['code'],
-                   groups['end_out']))
-    if groups['stdout']:
-        out += '\n' + groups['stdout']
-    return out
 
+def _after_directive(last, text):
+    """ Return `text` following directive with `last` part of kind `last`
+
+    A directive ending in output takes up one following newline.
+    """
+    if last != 'code' and text.startswith('\n'):
+        return text[1:]
+    return text
+
+
+def iter_rst(cells, filter_data_type, raw_mimetypes=RAW_MIMETYPES):
+    """ Generate ReST text for notebook `cells`
+
+    Each code cell with code gives an nbplot directive.  The directive has
+    the code as doctest input, the plain text of any results and displays as
+    doctest output, and the text of any streams after that, as printed
+    output.  Stream and plain text outputs of following code cells without
+    code, such as cells with only IPython magics, also go into the directive,
+    if there is only whitespace between.  A directive ending in output takes
+    up one newline from the start of the following text.  Other outputs, and
+    markdown and raw cells, have the same ReST as for the nbconvert ReST
+    template, except that we do not write images.
+
+    Parameters
+    ----------
+    cells : iterable
+        Notebook cells.
+    filter_data_type : callable
+        Callable returning list with preferred data type from output data.
+        See :class:`nbconvert.filters.DataTypeFilter`.
+    raw_mimetypes : sequence, optional
+        Mimetypes of raw cells to copy to the ReST output.
+
+    Yields
+    ------
+    rst : str
+        ReST text, in order.
+    """
+    # Code and outputs for current directive, or None if no directive.
+    code, stdout, end_out = None, [], []
+    # Kind of last part in directive, and whitespace since.
+    last, space = None, ''
+    for cell in cells:
+        for kind, value in _cell_parts(cell, filter_data_type,
+                                       raw_mimetypes):
+            if code is not None:
+                if kind in ('stdout', 'end_out'):
+                    (stdout if kind == 'stdout' else end_out).append(value)
+                    last, space = kind, ''
+                    continue
+                if kind == 'text' and not value.strip():
+                    space += value
+                    continue
+                yield _directive_rst(code, stdout, end_out)
+                yield _after_directive(
+                    last, space + value if kind == 'text' else space)
+                code, stdout, end_out = None, [], []
+                if kind == 'text':
+                    continue
+            if kind == 'code':
+                code, last, space = value, 'code', ''
+            elif kind in ('stdout', 'end_out'):
+                # Output without directive.
+                yield _data_rst({'text/plain': value}, 'text/plain')
+            else:
+                yield value
+    if code is not None:
+        yield _directive_rst(code, stdout, end_out)
+        yield _after_directive(last, space)
+
+
+class PlotsExporter(Exporter):
+    """ Exporter from notebook to ReST with nbplot directives
+    """
 
-def convert_nb_fname(nb_fname):
-    with open(nb_fname, 'rt') as nb_fobj:
-        notebook = nbformat.read(nb_fobj, as_version=4)
-    return convert_nb(notebook)
+    output_mimetype = 'text/x-rst'
 
+    @default('file_extension')
+    def _file_extension_default(self):
+        return '.rst'
 
-def convert_nb(notebook):
-    # Turn off output preprocessor (we don't want the figures)
+    def from_notebook_node(self, nb, resources=None, **kw):
+        """ Return ReST text and resources from notebook `nb`
+
+        See :func:`iter_rst` for the ReST.
+        """
+        nb_copy, resources = super().from_notebook_node(nb, resources, **kw)
+        filter_data_type = DataTypeFilter(parent=self)
+        filter_data_type.display_data_priority = [
+            self.output_mimetype] + filter_data_type.display_data_priority
+        rst = ''.join(iter_rst(nb_copy.cells,
+                               filter_data_type,
+                               resources.get('raw_mimetypes', RAW_MIMETYPES)))
+        return rst.lstrip('\r\n'), resources
+
+
+def make_exporter():
+    """ Return exporter for converting notebooks
+
+    Make one exporter and pass it to :func:`convert_nb` to convert many
+    notebooks.
+    """
+    # Turn off output preprocessor (we don't want the figures).  Validate the
+    # notebook once, rather than after each preprocessor.
     c =  config.Config({
-        'ExtractOutputPreprocessor':{'enabled': False}
+        'ExtractOutputPreprocessor':{'enabled': False},
+        'Exporter': {'optimistic_validation': True},
     })
-    plots_exporter = PlotsExporter(extra_loaders=[dl], config=c)
-    output, resources = plots_exporter.from_notebook_node(notebook)
-    return CODE_WITH_OUTPUT.sub(repl_code_plot, output)
+    return PlotsExporter(config=c)
+
+
+
+
+# Output types that we do not write.  We do not need their data.
+SKIP_TYPES = ('image/png', 'image/svg+xml')
+
+# Key for output type we do not need, with start of string or list value.
+SKIP_KEY = re.compile(
+    b'"(?:' + b'|'.join(re.escape(t.encode('ascii')) for t in SKIP_TYPES) +
+    b')"[ \t\n\r]*:[ \t\n\r]*(?=["[])')
+
+WHITESPACE = re.compile(b'[ \t\n\r]*')
+
+
+def _n_backslashes(buf, pos):
+    # Number of backslashes in `buf` immediately before `pos`
+    n = 0
+    while pos - n > 0 and buf[pos - n - 1] == 0x5c:
+        n += 1
+    return n
+
+
+def _string_end(buf, pos):
+    # Position after JSON string starting at `pos` in `buf`
+    while True:
+        pos = buf.find(b'"', pos + 1)
+        if pos == -1:
+            raise ValueError('Unterminated string in notebook')
+        if _n_backslashes(buf, pos) % 2 == 0:
+            return pos + 1
+
+
+def _skip_end(buf, pos):
+    """ Position after string or list of strings starting at `pos` in `buf`
+    """
+    if buf[pos] == 0x22:  # '"'
+        return _string_end(buf, pos)
+    # List of strings (multi-line string)
+    pos = WHITESPACE.match(buf, pos + 1).end()
+    while buf[pos] != 0x5d:  # ']'
+        if buf[pos] != 0x22:
+            raise ValueError('Expecting string in list in notebook')
+        pos = _string_end(buf, pos)
+        pos = WHITESPACE.match(buf, pos).end()
+        if buf[pos] == 0x2c:  # ','
+            pos = WHITESPACE.match(buf, pos + 1).end()
+    return pos + 1
+
+
+def _without_skip_data(buf):
+    """ Return JSON bytes in `buf` with values for `SKIP_TYPES` set to ""
+
+    We find keys for `SKIP_TYPES`, with string or list values, in `buf`.  In
+    valid JSON, a double quote without a backslash before it is always a
+    string delimiter, so a match starting with such a quote, and ending with a
+    colon, is always an object key.
+    """
+    out = bytearray()
+    pos = 0
+    with memoryview(buf) as view:
+        for match in SKIP_KEY.finditer(buf):
+            if (match.start() < pos or
+                _n_backslashes(buf, match.start()) % 2):
+                continue
+            out += view[pos:match.end()]
+            out += b'""'
+            pos = _skip_end(buf, match.end())
+        out += view[pos:]
+    return out
+
+
+def read_nb(nb_fname):
+    """ Read notebook from `nb_fname` for conversion to ReST
+
+    Like ``nbformat.read(nb_fname, as_version=4)``, but we do not read the
+    data for outputs with types in `SKIP_TYPES`, and set this data to empty
+    strings instead.  Executed notebooks can have many megabytes of image data
+    that we do not use.  We do not validate the notebook.
+
+    Parameters
+    ----------
+    nb_fname : str
+        Notebook file name.
+
+    Returns
+    -------
+    notebook : :class:`nbformat.NotebookNode` instance
+        Notebook, in nbformat version 4.
+    """
+    with open(nb_fname, 'rb') as fobj:
+        if os.fstat(fobj.fileno()).st_size == 0:
+            contents = b''
+        else:
+            with mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                contents = _without_skip_data(buf)
+    notebook = nbformat.reader.reads(contents)
+    return nbformat.convert(notebook, 4)
+
+
+def convert_nb_fname(nb_fname, exporter=None):
+    return convert_nb(read_nb(nb_fname), exporter)
+
+
+def convert_nb(notebook, exporter=None):
+    """ Return ReST text from `notebook`
+
+    Parameters
+    ----------
+    notebook : :class:`nbformat.NotebookNode` instance
+        Notebook to convert.
+    exporter : None or :class:`PlotsExporter` instance, optional
+        Exporter to use for conversion, from :func:`make_exporter`.  If None,
+        make a new exporter.
+
+    Returns
+    -------
+    rst_text : str
+        ReST text, with nbplot directives for the code cells.  See
+        :func:`iter_rst`.
+    """
+    if exporter is None:
+        exporter = make_exporter()
+    output, resources = exporter.from_notebook_node(notebook)
+    return output
@@ -0,0 +1,278 @@
+""" Pool of running Jupyter kernels to reuse for filling notebooks
+
+Starting a kernel, and importing the usual libraries into it, can take longer
+than running the code in a short notebook.  The pool keeps kernels running
+between notebooks.  After each notebook, we reset the kernel by closing any
+figures, returning to the original working directory, and clearing the
+namespace.  We also restore settings that the notebook may have changed: the
+matplotlib rcParams, the numpy print options and random state, the pandas
+options, the Python random state, ``sys.path`` and the warning filters.
+Modules that the notebook imported stay imported, so the next notebook does not
+pay to import them again.
+
+We replace a kernel after it has filled a given number of notebooks, or when
+its process uses more than a given amount of memory after the reset, and after
+any error during a notebook run or the reset.
+"""
+
+import os
+from copy import deepcopy
+import threading
+
+from nbformat import v4 as nbf
+import nbconvert as nbc
+from nbclient.util import run_sync
+
+from .trace import span
+
+
+# Tag for line of reset cell output giving memory use of kernel.
+MEMORY_TAG = '__nb2plots_kernel_memory__'
+
+# Code to save kernel state on start, for reset after running notebook.  We
+# import numpy, if available, to get its default print options.
+SAVE_CODE = """\
+import sys as _sys, warnings as _warnings
+_state = dict(path=list(_sys.path), filters=list(_warnings.filters))
+try:
+    import numpy as _np
+except ImportError:
+    pass
+else:
+    _state['printoptions'] = _np.get_printoptions()
+    del _np
+get_ipython()._nb2plots_state = _state
+del _sys, _warnings, _state
+"""
+
+# Code to reset kernel after running notebook.  Then print the tagged current
+# memory use (resident set size) of the kernel process in megabytes, or -1 if
+# we can't get it.  The notebook code may print during the reset, for example
+# from ``__del__`` methods, so we look for the tagged line in the output.
+RESET_CODE = """\
+import os as _os, sys as _sys, warnings as _warnings, random as _random
+_state = get_ipython()._nb2plots_state
+if 'matplotlib.pyplot' in _sys.modules:
+    _sys.modules['matplotlib.pyplot'].close('all')
+if 'matplotlib' in _sys.modules:
+    _sys.modules['matplotlib'].rc_file_defaults()
+if 'numpy' in _sys.modules:
+    _sys.modules['numpy'].set_printoptions(**_state['printoptions'])
+    _sys.modules['numpy'].random.seed()
+if 'pandas' in _sys.modules:
+    with _warnings.catch_warnings():
+        _warnings.simplefilter('ignore')
+        _sys.modules['pandas'].reset_option('all')
+_random.seed()
+_sys.path[:] = _state['path']
+# Reset clears warning registries, so warnings show again, as in a new kernel.
+_warnings.resetwarnings()
+_warnings.filters.extend(_state['filters'])
+_os.chdir({cwd!r})
+get_ipython().reset(new_session=True)
+import gc as _gc
+_gc.collect()
+def _nb2plots_rss():
+    import os
+    try:
+        with open('/proc/self/statm', 'rt') as fobj:
+            pages = int(fobj.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return -1
+    return psutil.Process().memory_info().rss / 2 ** 20
+print({tag!r}, _nb2plots_rss())
+del _gc, _nb2plots_rss
+"""
+
+
+def _reset_memory(outputs):
+    """ Return memory use from reset cell `outputs`, or None if not found
+
+    Memory use is -1 if the kernel could not get it.
+    """
+    text = ''.join(output.get('text', '') for output in outputs
+                   if output.get('name') == 'stdout')
+    for line in text.splitlines():
+        if line.startswith(MEMORY_TAG):
+            try:
+                return float(line[len(MEMORY_TAG):])
+            except ValueError:
+                return None
+    return None
+
+
+class PooledKernel(object):
+    """ Running kernel that can fill several notebooks, one after another
+
+    Parameters
+    ----------
+    kernel_name : None or str, optional
+        Name of kernel to start.  If None, start default kernel.
+    cwd : None or str, optional
+        Working directory for kernel.  If None, use current working directory.
+    """
+
+    def __init__(self, kernel_name=None, cwd=None):
+        self.cwd = os.getcwd() if cwd is None else cwd
+        self.uses = 0
+        # False if the kernel may not be in a clean state for reuse.
+        self.reusable = True
+        self.preprocessor = nbc.preprocessors.execute.ExecutePreprocessor()
+        self.preprocessor.enabled = True
+        self.preprocessor.nb = nbf.new_notebook()
+        if kernel_name is not None:
+            self.preprocessor.kernel_name = kernel_name
+        with span('kernel start', 'kernel'):
+            self.km = self.preprocessor.create_kernel_manager()
+            self.kernel_name = self.km.kernel_name
+            self.preprocessor.start_new_kernel(cwd=self.cwd)
+            # Save state for reset.  If this fails, the reset fails too, and
+            # we replace the kernel after the first notebook.
+            self.preprocessor.start_new_kernel_client()
+            try:
+                self._execute(SAVE_CODE)
+            finally:
+                self._stop_client()
+
+    def _execute(self, code):
+        """ Execute `code` in kernel, outside the history, return outputs
+
+        Return empty list if execution fails.
+        """
+        preprocessor = self.preprocessor
+        cell = nbf.new_code_cell(code)
+        preprocessor.nb = nbf.new_notebook(cells=[cell])
+        try:
+            preprocessor.execute_cell(cell, 0, store_history=False)
+        except Exception:
+            return []
+        return cell.outputs
+
+    def _stop_client(self):
+        preprocessor = self.preprocessor
+        if preprocessor.kc is not None:
+            preprocessor.kc.stop_channels()
+            preprocessor.kc = None
+
+    def fill(self, nb, timeout=30):
+        """ Execute notebook `nb`, reset kernel, return notebook, memory use
+
+        Parameters
+        ----------
+        nb : notebook
+            Notebook to execute.
+        timeout : None or int, optional
+            Timeout for each cell, in seconds.
+
+        Returns
+        -------
+        full_nb : notebook
+            Notebook with built outputs.
+        memory : None or float
+            Memory use of kernel process after reset, in megabytes, or None if
+            not known.
+
+        If the reset fails, or does not report the memory use, we set the
+        ``reusable`` attribute to False, but still return the notebook.
+        """
+        preprocessor = self.preprocessor
+        preprocessor.timeout = timeout
+        RD = nbc.exporters.exporter.ResourcesDict
+        res = RD()
+        res['metadata'] = RD()
+        try:
+            with span('kernel run', 'kernel', uses=self.uses):
+                full_nb, _ = preprocessor.preprocess(deepcopy(nb), res,
+                                                     km=self.km)
+            self.uses += 1
+            # Run reset code outside the history, to restart the execution
+            # count for the next notebook.
+            outputs = self._execute(RESET_CODE.format(cwd=self.cwd,
+                                                      tag=MEMORY_TAG))
+        finally:
+            self._stop_client()
+        memory = _reset_memory(outputs)
+        if memory is None:
+            self.reusable = False
+        return full_nb, (None if memory is None or memory < 0 else memory)
+
+    def shutdown(self):
+        """ Shut down kernel """
+        run_sync(self.km.shutdown_kernel)(now=True)
+
+
+class KernelPool(object):
+    """ Pool of running kernels to fill notebooks
+
+    Parameters
+    ----------
+    size : int, optional
+        Maximum number of idle kernels to keep running.
+    max_uses : int, optional
+        Replace a kernel after it has filled this many notebooks.
+    max_memory : None or float, optional
+        If not None, replace a kernel when its process uses more than this
+        many megabytes of memory after the reset following a notebook.  We
+        measure memory on Linux, or with psutil, if installed.
+    cwd : None or str, optional
+        Working directory for kernels.  If None, use current working
+        directory.
+    """
+
+    def __init__(self, size=1, max_uses=20, max_memory=None, cwd=None):
+        self.size = size
+        self.max_uses = max_uses
+        self.max_memory = max_memory
+        self.cwd = os.getcwd() if cwd is None else cwd
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def start(self, kernel_name=None):
+        """ Start kernels until the pool has `size` idle kernels
+        """
+        while len(self._idle) < self.size:
+            self._idle.append(PooledKernel(kernel_name, self.cwd))
+
+    def _checkout(self, kernel_name):
+        with self._lock:
+            for i, kernel in enumerate(self._idle):
+                if kernel_name in (None, kernel.kernel_name):
+                    return self._idle.pop(i)
+        return PooledKernel(kernel_name, self.cwd)
+
+    def _checkin(self, kernel, memory):
+        with self._lock:
+            if (kernel.reusable and
+                kernel.uses < self.max_uses and
+                (self.max_memory is None or memory is None or
+                 memory <= self.max_memory) and
+                len(self._idle) < self.size):
+                self._idle.append(kernel)
+                return
+        kernel.shutdown()
+
+    def fill(self, nb, timeout=30):
+        """ Execute notebook `nb` in pool kernel, return notebook with outputs
+        """
+        kernel_name = nb.metadata.get('kernelspec', {}).get('name')
+        kernel = self._checkout(kernel_name)
+        try:
+            full_nb, memory = kernel.fill(nb, timeout)
+        except Exception:
+            kernel.shutdown()
+            raise
+        self._checkin(kernel, memory)
+        return full_nb
+
+    def shutdown(self):
+        """ Shut down all idle kernels
+        """
+        with self._lock:
+            kernels, self._idle = self._idle, []
+        for kernel in kernels:
+            kernel.shutdown()
@@ -0,0 +1,158 @@
+""" Report memory used by nbplot code
+
+With the ``nbplot_memory`` configuration option set to True, the nbplot
+directives trace the memory that their code allocates, using
+:mod:`tracemalloc`.  At the end of the build, we write a report to
+``nbplot_memory.json`` in the output directory.  The report is a dict with
+keys:
+
+* ``documents``: list of dicts, one per document, largest net growth first,
+  with keys ``docname``, ``net`` (total megabytes allocated by the nbplot code
+  in the document, and still allocated after each block ran), ``peak``
+  (largest peak megabytes for a single block), ``rss`` (current resident
+  memory of the process running the code, after the last block that ran, in
+  megabytes, or None if not known) and ``n_blocks`` (number of nbplot
+  directives).
+* ``blocks``: list of dicts, one per nbplot directive, largest net growth
+  first, with keys ``docname``, ``lineno``, ``error``, and the memory use from
+  :func:`track_memory`.  Directives taking their figures from the image cache
+  have ``cached`` set to True, and no memory use.
+
+Net growth for a block is the memory that the block allocated, and that is
+still allocated when the block finishes; this is mostly the objects that the
+block has added to the plot namespace.  Net growth for a document is the sum
+of the net growth for its blocks.
+
+If you set ``nbplot_memory_budget`` to a number of megabytes, the build warns
+about any nbplot directive with code that has a peak allocation over this
+budget.
+
+Tracing allocations slows the code, so timings (see :mod:`nb2plots.timing`)
+will be longer when ``nbplot_memory`` is set.
+"""
+
+import os
+import json
+import tracemalloc
+from os.path import join as pjoin
+from contextlib import contextmanager
+
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+REPORT_NAME = 'nbplot_memory.json'
+
+# Number of largest documents and blocks to show in build output.
+N_LARGEST = 5
+
+MB = 2 ** 20
+
+
+def current_rss():
+    """ Return current resident memory of this process in megabytes, or None
+
+    We read ``/proc/self/statm`` on Linux, or use psutil, if installed.
+    """
+    try:
+        with open('/proc/self/statm', 'rt') as fobj:
+            pages = int(fobj.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / MB
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / MB
+
+
+@contextmanager
+def track_memory(record):
+    """ Context manager recording memory allocated in block into `record`
+
+    Parameters
+    ----------
+    record : None or dict
+        If None, do nothing.  Otherwise, fill with megabytes allocated in block
+        and still allocated at the end, in key ``net``, peak megabytes
+        allocated during the block, in key ``peak``, and current resident
+        memory of the process after the block, in key ``rss`` (see
+        :func:`current_rss`).
+    """
+    if record is None:
+        yield
+        return
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    elif hasattr(tracemalloc, 'reset_peak'):  # Python >= 3.9
+        tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    try:
+        yield
+    finally:
+        current, peak = tracemalloc.get_traced_memory()
+        if started:
+            tracemalloc.stop()
+        record['net'] = (current - before) / MB
+        record['peak'] = max(peak - before, 0) / MB
+        record['rss'] = current_rss()
+
+
+def _by_net(records):
+    return sorted(records, key=lambda r: r.get('net', 0), reverse=True)
+
+
+def memory_report(block_memories):
+    """ Return memory report from memory use of nbplot directives
+
+    Parameters
+    ----------
+    block_memories : dict
+        Dict with keys being document names, and values being lists of dicts
+        with memory use for nbplot directives in document, in document order.
+
+    Returns
+    -------
+    report : dict
+        Memory report.  See module docstring.
+    """
+    documents, blocks = [], []
+    for docname, memories in block_memories.items():
+        record = dict(docname=docname, net=0., peak=0., rss=None, n_blocks=0)
+        for memory in memories:
+            record['n_blocks'] += 1
+            record['net'] += memory.get('net', 0)
+            record['peak'] = max(record['peak'], memory.get('peak', 0))
+            if memory.get('rss') is not None:  # After last block that ran.
+                record['rss'] = memory['rss']
+            blocks.append(dict(docname=docname, **memory))
+        documents.append(record)
+    return dict(documents=_by_net(documents), blocks=_by_net(blocks))
+
+
+def over_budget(memory, budget):
+    """ True if `memory` record has peak allocation over `budget` megabytes
+    """
+    return budget is not None and memory.get('peak', 0) > budget
+
+
+def write_memory_report(app, exception):
+    """ Write memory report to output directory, show summary
+
+    Called at ``build-finished`` event.
+    """
+    if exception is not None or not app.config.nbplot_memory:
+        return
+    report = memory_report(app.env.nbplot_memories)
+    with open(pjoin(app.outdir, REPORT_NAME), 'wt') as fobj:
+        json.dump(report, fobj, indent=1)
+    logger.info('nbplot memory use written to {}'.format(REPORT_NAME))
+    for record in report['documents'][:N_LARGEST]:
+        logger.info('  {docname}: {net:.1f}MB net, {peak:.1f}MB peak '
+                    '({n_blocks} blocks)'.format(**record))
+    blocks = [block for block in report['blocks'] if 'net' in block]
+    for block in blocks[:N_LARGEST]:
+        logger.info('  {docname}, line {lineno}: {net:.1f}MB net, '
+                    '{peak:.1f}MB peak'.format(**block))
@@ -52,12 +52,10 @@ def depart_mpl_inter(self, node):
 
 
 def setup(app):
-    setup.app = app
-    setup.config = app.config
-    setup.confdir = app.confdir
-
     # mpl_hint treated same as hint
     app.add_node(mpl_hint,
                  **{builder: (visit_mpl_inter, depart_mpl_inter)
                     for builder in ('html', 'latex', 'text')})
     app.add_directive('mpl-interactive', MPLInteractive)
+    return {'parallel_read_safe': True,
+            'parallel_write_safe': True}
@@ -0,0 +1,83 @@
+""" Run several Sphinx builders from a single read of the sources
+
+The first builder reads the documents and runs the nbplot code.  Later
+builders run in new Sphinx applications that load the saved environment from
+the same doctree directory, and reuse the figures and the built runrole
+outputs, so they write their outputs without reading or running anything
+again.
+"""
+
+import sys
+from os.path import join as pjoin
+
+from sphinx.application import Sphinx
+from sphinx.util.docutils import docutils_namespace
+
+DEFAULT_BUILDERS = ('html', 'markdown', 'python', 'jupyter')
+
+
+def build_all(srcdir, outdir, builders=DEFAULT_BUILDERS, doctreedir=None,
+              confdir=None, confoverrides=None, status=sys.stdout,
+              warning=sys.stderr, warningiserror=False, parallel=0):
+    """ Build Sphinx project in `srcdir` with each builder in `builders`
+
+    Read the sources, and run nbplot code, only once, for all builders.
+
+    Parameters
+    ----------
+    srcdir : str
+        Directory containing Sphinx sources.
+    outdir : str
+        Output directory.  Each builder writes into a subdirectory named for
+        the builder.
+    builders : sequence, optional
+        Names of builders to run, in order.
+    doctreedir : None or str, optional
+        Directory for pickled doctrees and environment.  If None, use
+        ``.doctrees`` in `outdir`.
+    confdir : None or str, optional
+        Directory containing ``conf.py``.  If None, use `srcdir`.
+    confoverrides : None or dict, optional
+        Settings overriding values in ``conf.py``.
+    status : file-like object or None, optional
+        File-like object to which to write build status messages, or None
+        for no build status messages.
+    warning : file-like object or None, optional
+        File-like object to which to write warnings, or None for no warnings.
+    warningiserror : {False, True}, optional
+        if True, raise an error for warning during the Sphinx build.
+    parallel : int, optional
+        Number of processes for reading and writing, if greater than 1.
+
+    Returns
+    -------
+    app : Sphinx application
+        Application that ran the last build.
+    """
+    builders = list(builders)
+    if len(builders) == 0:
+        raise ValueError('Need at least one builder')
+    confdir = srcdir if confdir is None else confdir
+    doctreedir = (pjoin(outdir, '.doctrees') if doctreedir is None
+                  else doctreedir)
+    confoverrides = {} if confoverrides is None else dict(confoverrides)
+    # Render figures for all the builders, so builds after the first do not
+    # need to read the documents again.
+    confoverrides['nbplot_render_for'] = builders
+    runrole_cache = None
+    for buildername in builders:
+        # Each builder gets a new application, with its own tags for "only"
+        # directives.  The application loads the environment that the first
+        # application saved in `doctreedir`, and finds no documents to read.
+        with docutils_namespace():
+            app = Sphinx(srcdir, confdir, pjoin(outdir, buildername),
+                         doctreedir, buildername, confoverrides, status,
+                         warning, warningiserror=warningiserror,
+                         parallel=parallel)
+            # Sphinx builds the runrole outputs after it saves the
+            # environment; keep the outputs we have already built.
+            if runrole_cache is not None:
+                app.env.runrole_cache = runrole_cache
+            app.build()
+            runrole_cache = app.env.runrole_cache
+    return app
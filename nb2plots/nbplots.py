@@ -154,6 +154,15 @@ The nbplot directive has the following configuration options:
     nbplot_html_show_formats
         Whether to show links to the files in HTML.
 
+    Builders only render the formats they use.  HTML builders use "png", and
+    all the other formats if ``nbplot_html_show_formats`` is True.  The LaTeX
+    builder uses "pdf", the Texinfo builder uses "png", and builders that do
+    not show figures, such as the doctest, text, markdown, python and jupyter
+    builders, use none.  Other builders get all formats.  A builder can
+    declare the formats it uses with an ``nbplot_formats`` class attribute,
+    a sequence of suffixes.  Custom templates (see ``nbplot_template``) should
+    check the formats in ``img.formats`` before referring to them.
+
     nbplot_rcparams
         A dictionary containing any non-standard rcParams that should
         be applied at the beginning of each document.
@@ -170,6 +179,101 @@ The nbplot directive has the following configuration options:
 
     nbplot_template
         Provide a customized template for preparing restructured text.
+
+    nbplot_cache
+        If True, store the images from each nbplot directive in an on-disk
+        cache, and reuse them in later builds instead of running the code
+        again.  The cache key for a directive covers its own code, the code of
+        all the nbplot directives before it in the same document, and the
+        ``nbplot_pre_code``, ``nbplot_rcparams`` and ``nbplot_formats``
+        settings, as well as the matplotlib and numpy versions.  It does not
+        cover any data files that the code reads; delete the cache directory
+        to force a fresh run.  Default is False.
+
+    nbplot_cache_dir
+        Directory for the image cache.  If None (the default), use an
+        ``nbplot_cache`` directory next to the ``doctrees`` directory of the
+        build.  If the directory is relative, it is relative to the directory
+        containing ``conf.py``.
+
+    nbplot_jobs
+        Number of worker processes in which to run the code of nbplot
+        directives, before Sphinx reads the documents.  The processes run the
+        directives for each document in order, and store the figures in the
+        image cache (see ``nbplot_cache``), so a value greater than 1 also
+        turns on the image cache.  The directives then take their figures from
+        the cache, and only run code that the workers did not run.  The
+        workers find the directives with a scan of the ReST source, that skips
+        documents that include files with nbplot directives; Sphinx logs any
+        document where the directives did not match the scan.  Default is 1,
+        meaning directives run their own code as Sphinx reads each document.
+
+    nbplot_fork_workers
+        If True, and ``nbplot_jobs`` is greater than 1, run the code for each
+        document in a new process, forked from a single-threaded fork server
+        process that has already imported pyplot and the modules that
+        ``nbplot_pre_code`` imports.  Documents do not pay the cost of these
+        imports again, and changes to global state, such as imported modules
+        and matplotlib settings, do not leak from one document to another.
+        Ignored, to use plain worker processes, on platforms without the fork
+        server, and for Python < 3.11.  Default is False.
+
+    nbplot_execute_unrendered
+        If True (the default), run the nbplot code even for builders that do
+        not show figures, such as the doctest, text, markdown, python and
+        jupyter builders, so these builders report errors from the code.  If
+        False, these builders skip running the code.  These builders never
+        save or copy figure files.
+
+    nbplot_render_for
+        List of builder names.  Render figures in the formats that these
+        builders use, as well as the formats for the current builder, so that
+        later builds with these builders can reuse the environment from this
+        build without reading the documents again.  See
+        :func:`nb2plots.build_all`.  Default is [].
+
+    nbplot_capture
+        If True, record the standard output, the value of the final
+        expression, and the figures from each nbplot directive, as they run.
+        The ``fullnotebook`` role (and the ``code-links`` directive) then fill
+        the notebook code cells from these records, instead of running the
+        notebook in a Jupyter kernel.  If any code cell does not come from an
+        nbplot directive that ran without error, or has a final value that we
+        cannot display as the kernel would, the role runs the notebook in a
+        kernel, as usual.  Default is False.
+
+    nbplot_timing
+        If True, record the time to run the code of each nbplot directive, and
+        to save each figure format, and the time to fill each full notebook,
+        with the time for each notebook cell.  At the end of the build, write
+        these times to ``nbplot_timing.json`` in the output directory, and
+        show the slowest documents and directives in the build output.  See
+        :mod:`nb2plots.timing`.  Default is False.
+
+    nbplot_trace
+        If not None, file name, relative to the output directory, to which to
+        write a timeline of the build, in Chrome trace event format.  If None,
+        use the file name in the ``NB2PLOTS_TRACE`` environment variable, if
+        set.  See :mod:`nb2plots.trace`.  Default is None.
+
+    nbplot_memory
+        If True, trace the memory that the code of each nbplot directive
+        allocates, and the memory it leaves allocated when it finishes.  At the
+        end of the build, write the memory use to ``nbplot_memory.json`` in
+        the output directory, and show the documents and directives with the
+        largest growth in the build output.  See :mod:`nb2plots.memory`.
+        Default is False.
+
+    nbplot_profile
+        If True, profile the code of the nbplot directives, and write a
+        profile for each document, and a summary giving the time for each
+        line of code in the ReST documents, to the output directory.  See
+        :mod:`nb2plots.profiling`.  Default is False.
+
+    nbplot_memory_budget
+        If not None, and ``nbplot_memory`` is True, warn about nbplot
+        directives with code that has a peak allocation of more than this
+        many megabytes.  Default is None.
 """
 
 try:
@@ -179,9 +283,19 @@ except ImportError:
 from collections import defaultdict
 import sys, os, shutil, io, re, textwrap
 from os.path import (relpath, abspath, join as pjoin, dirname, exists,
-                     basename, splitext, isdir)
+                     basename, splitext, isdir, isfile)
 import traceback
 from pprint import pformat
+import hashlib
+import json
+import ast
+import base64
+import tokenize
+import time
+import gc
+from tempfile import mkdtemp
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor
 
 from docutils.statemachine import StringList
 from docutils import nodes
@@ -190,18 +304,44 @@ from docutils.parsers.rst.directives.images import Image
 align = Image.align
 from docutils.parsers.rst import Directive
 
+from sphinx.util import logging
+try:
+    from sphinx.util.display import status_iterator
+except ImportError:  # Sphinx < 6.1
+    from sphinx.util import status_iterator
+
 import jinja2
 def format_template(template, **kw):
     return jinja2.Template(template).render(**kw)
 
-import matplotlib
-import matplotlib.cbook as cbook
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from matplotlib._pylab_helpers import Gcf
+from .timing import write_timing_report
+from .memory import track_memory, over_budget, write_memory_report
+from .profiling import CodeProfile, profile_fname, write_profile_summary
+from .trace import (span, start_trace, trace_read_start, trace_read_end,
+                    write_trace)
 
 __version__ = 2
 
+logger = logging.getLogger(__name__)
+
+# Pyplot module, once imported by :func:`_pyplot`.
+_plt = None
+
+
+def _pyplot():
+    """ Return pyplot module, importing with Agg backend on first call
+
+    Importing matplotlib and pyplot is slow, so we wait until we have nbplot
+    code to run.
+    """
+    global _plt
+    if _plt is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        _plt = plt
+    return _plt
+
 
 def _get_rawsource(node):
     # Docutils < 0.18 has rawsource attribute, otherwise, build it.
@@ -390,22 +530,11 @@ class NBPlotDirective(Directive):
             self._dont_doctest_doctests(node)
         return [node]
 
-    def _get_parts(self, option_name):
-        if option_name not in self.options:
-            return (0,)
-        env = self.state.document.settings.env
-        name_space = env.nbplot_flag_namespaces[env.docname].copy()
-        indices = eval(self.options[option_name], name_space)
-        return indices if isinstance(indices, Sequence) else (indices,)
-
     def _select_parts(self):
-        parts = parse_parts(self.content)
-        to_render = [parts[i]['contents']
-                     for i in self._get_parts('render-parts')]
-        to_run = [parts[i]['contents']
-                  for i in self._get_parts('run-parts')]
-        return ('\n'.join(sum(to_render, [])),
-                '\n'.join(sum(to_run, [])))
+        env = self.state.document.settings.env
+        return select_parts(self.content,
+                            self.options,
+                            env.nbplot_flag_namespaces[env.docname])
 
     def _contains_doctest(self, multi_str):
         """ Check  ``format`` option for doctest specifier, else guess
@@ -424,7 +553,8 @@ class NBPlotDirective(Directive):
         # how to link to files from the RST file
         rst_file = document.attributes['source']
         rst_dir = dirname(rst_file)
-        dest_dir_link = pjoin(relpath(setup.confdir, rst_dir),
+        confdir = document.settings.env.app.confdir
+        dest_dir_link = pjoin(relpath(confdir, rst_dir),
                               source_rel_dir).replace(os.path.sep, '/')
         build_dir_link = relpath(build_dir, rst_dir).replace(os.path.sep, '/')
 
@@ -459,13 +589,17 @@ class NBPlotDirective(Directive):
         return self.rst2nodes(epilogue_source.splitlines(),
                               self.nbplot_epilogue)
 
-    def _copy_image_files(self, images, dest_dir):
-        # copy image files to builder's output directory, if necessary
+    def _copy_image_files(self, images, dest_dir, formats):
+        # copy image files in `formats` to builder's output directory, if
+        # necessary
         if not exists(dest_dir):
-            cbook.mkdirs(dest_dir)
+            os.makedirs(dest_dir)
 
         for img in images:
-            for fn in img.filenames():
+            for fmt in img.formats:
+                if fmt not in formats:
+                    continue
+                fn = img.filename(fmt)
                 destimg = pjoin(dest_dir, basename(fn))
                 if fn != destimg:
                     shutil.copyfile(fn, destimg)
@@ -489,6 +623,71 @@ class NBPlotDirective(Directive):
             node_attrs[opt_name] += [b_name.strip() for b_name in values]
         return node_attrs
 
+    def _render_figures(self, code, code_path, output_dir, output_base,
+                        config, formats, **kwargs):
+        """ Render figures for `code`, using image cache if enabled
+
+        If the image cache has images for `code`, copy these to `output_dir`
+        and defer running `code` until a later directive in this document
+        needs the plot context.
+        """
+        env = self.state.document.settings.env
+        context = get_doc_context(env, kwargs['context_reset'])
+        kwargs['ns'] = context.ns
+        capture = kwargs.pop('capture', None)
+        timing = kwargs.pop('timing', None)
+        memory = kwargs.pop('memory', None)
+        profile = None
+        if config.nbplot_profile:
+            if context.profile is None:
+                context.profile = CodeProfile(code_path)
+            profile = context.profile.at_line(self.content_offset + 1)
+        # Profile needs all the code to run.
+        cache = None if profile is not None else get_figure_cache(env)
+        if cache is None:
+            return render_figures(code, code_path, output_dir, output_base,
+                                  config, formats=formats, capture=capture,
+                                  timing=timing, memory=memory,
+                                  profile=profile, **kwargs)
+        prev_key = (doc_cache_key(config, formats, code_path)
+                    if context.cache_key is None else context.cache_key)
+        key = block_cache_key(prev_key,
+                              code,
+                              close_figs=kwargs['close_figs'],
+                              raises=self.options.get('raises'))
+        context.cache_key = key
+        context.keys.append(key)
+        images = cache.get(key, output_dir, output_base)
+        if images is not None and capture is not None:
+            # We also need the captured outputs.
+            cached_capture = cache.get_capture(key)
+            if cached_capture is None:
+                images = None
+            else:
+                capture.update(cached_capture)
+        if images is not None or key in prerun_errors:
+            context.deferred.append(dict(code=code, code_path=code_path,
+                                         config=config, **kwargs))
+        if timing is not None and key in prerun_timings:
+            # Code ran in worker process for this build.
+            timing.update(prerun_timings[key])
+        elif timing is not None and images is not None:
+            timing['cached'] = True
+        if memory is not None and key in prerun_memories:
+            memory.update(prerun_memories[key])
+        elif memory is not None and images is not None:
+            memory['cached'] = True
+        if images is not None:
+            return images
+        if key in prerun_errors:  # Code failed in executor.
+            raise PlotError(prerun_errors[key])
+        context.run_deferred()
+        images = render_figures(code, code_path, output_dir, output_base,
+                                config, formats=formats, capture=capture,
+                                timing=timing, memory=memory, **kwargs)
+        cache.put(key, images, capture)
+        return images
+
     def run(self):
         document = self.state.document
         config = document.settings.env.config
@@ -521,13 +720,13 @@ class NBPlotDirective(Directive):
                   else None)
 
         # determine output directory name fragment
-        source_rel_name = relpath(source_file_name, setup.confdir)
+        source_rel_name = relpath(source_file_name, env.app.confdir)
         source_rel_dir = dirname(source_rel_name)
         while source_rel_dir.startswith(os.path.sep):
             source_rel_dir = source_rel_dir[1:]
 
         # build_dir: where to place output files (temporarily)
-        build_dir = pjoin(dirname(setup.app.doctreedir),
+        build_dir = pjoin(dirname(env.doctreedir),
                           'nbplot_directive',
                           source_rel_dir)
         # get rid of .. in paths, also changes pathsep
@@ -535,12 +734,21 @@ class NBPlotDirective(Directive):
         # need to compare source and dest paths at end
         build_dir = os.path.normpath(build_dir)
 
-        if not exists(build_dir):
-            os.makedirs(build_dir)
-
         # output_dir: final location in the builder's directory
-        dest_dir = abspath(pjoin(setup.app.builder.outdir, source_rel_dir))
-        if not exists(dest_dir):
+        dest_dir = abspath(pjoin(env.app.builder.outdir, source_rel_dir))
+
+        # Image formats to render, and the subset that the current builder
+        # will use.  Builders that use no formats do not show figures; we don't
+        # need the output directories, and maybe we don't need to run the code.
+        formats = get_formats(env)
+        env.nbplot_doc_formats[docname] = [fmt for fmt, dpi in formats]
+        copy_formats = [fmt for fmt, dpi in
+                        builder_formats(env.app.builder, config)]
+        execute = len(formats) > 0 or config.nbplot_execute_unrendered
+
+        if formats and not exists(build_dir):
+            os.makedirs(build_dir)
+        if copy_formats and not exists(dest_dir):
             # no problem here for me, but just use built-ins
             os.makedirs(dest_dir)
 
@@ -565,19 +773,29 @@ class NBPlotDirective(Directive):
         # Break contents into parts, and select
         to_render, to_run = self._select_parts()
 
-        # make figures
+        # make figures, in the formats that the builder will use
+        images, errors = [], []
+        capture = {} if config.nbplot_capture and execute else None
+        timing = {} if config.nbplot_timing and execute else None
+        memory = {} if config.nbplot_memory and execute else None
         try:
-            images = render_figures(to_run,
-                                    source_file_name,
-                                    build_dir,
-                                    output_base,
-                                    config=config,
-                                    context = True,  # keep plot context
-                                    function_name = None,
-                                    context_reset=context_reset,
-                                    close_figs=close_figs,
-                                    raises=raises)
-            errors = []
+            if execute:
+                with span('{}:{}'.format(docname, self.lineno), 'nbplot'):
+                    images = self._render_figures(
+                        to_run,
+                        source_file_name,
+                        build_dir,
+                        output_base,
+                        config=config,
+                        formats=formats,
+                        context=True,  # keep context
+                        function_name=None,
+                        context_reset=context_reset,
+                        close_figs=close_figs,
+                        raises=raises,
+                        capture=capture,
+                        timing=timing,
+                        memory=memory)
         except PlotError as err:
             reporter = self.state.memo.reporter
             sm = reporter.system_message(
@@ -587,9 +805,30 @@ class NBPlotDirective(Directive):
                 'with code:\n\n{to_run}\n\n'
                 'Exception:\n{err}'.format(**locals()),
                 line=self.lineno)
-            images = []
             errors = [sm]
 
+        if capture is not None:
+            # Record outputs for notebook code cells; we can only use them if
+            # the code ran without error, and the notebook shows the code that
+            # ran.
+            env.nbplot_captures.setdefault(docname, []).append(dict(
+                code=to_render,
+                capture=(None if errors or to_render != to_run
+                         else capture)))
+
+        if timing is not None:
+            env.nbplot_timings.setdefault(docname, []).append(dict(
+                lineno=self.lineno, error=len(errors) > 0, **timing))
+
+        if memory is not None:
+            env.nbplot_memories.setdefault(docname, []).append(dict(
+                lineno=self.lineno, error=len(errors) > 0, **memory))
+            if over_budget(memory, config.nbplot_memory_budget):
+                logger.warning(
+                    'nbplot code allocated {:.1f}MB, over budget of {}MB'
+                    .format(memory['peak'], config.nbplot_memory_budget),
+                    location=(docname, self.lineno))
+
         # generate output restructuredtext
         lines = [''] + [row.rstrip() for row in to_render.split('\n')]
         # If the code is not in doctest format, make it into code blocks.
@@ -608,7 +847,12 @@ class NBPlotDirective(Directive):
         # Epilogue node contains the built figures and supporting stuff.
         epilogue = self._build_epilogue(images, source_rel_dir, build_dir)
         ret = rendered_nodes + epilogue + errors
-        self._copy_image_files(images, dest_dir)
+        if copy_formats:
+            self._copy_image_files(images, dest_dir, copy_formats)
+        # Record images, for builders running later from the same read.
+        env.nbplot_doc_images.setdefault(docname, []).extend(
+            (fmt, img.filename(fmt), source_rel_dir)
+            for img in images for fmt in img.formats)
         # Now, we need to put in nodes for the code that ran, so the doctest
         # builder can find it.  But, we hide these nodes from all the other
         # builders (using hide-from all).
@@ -696,6 +940,7 @@ EPILOGUE_TEMPLATE = """
    {% endif %}
 
    {% for img in images %}
+   {% if 'png' in img.formats -%}
    .. figure:: {{ build_dir }}/{{ img.basename }}.png
       {% for option in options -%}
       {{ option }}
@@ -709,6 +954,7 @@ EPILOGUE_TEMPLATE = """
         {%- endfor -%}
         )
       {%- endif -%}
+   {% endif %}
 
    {% endfor %}
 
@@ -723,20 +969,122 @@ EPILOGUE_TEMPLATE = """
 {{ only_texinfo }}
 
    {% for img in images %}
+   {% if 'png' in img.formats -%}
    .. image:: {{ build_dir }}/{{ img.basename }}.png
       {% for option in options -%}
       {{ option }}
       {% endfor %}
+   {% endif %}
 
    {% endfor %}
 
 """
 
 
-# the context of the plot for all directives
+# Default persistent context for code run outside nbplot directives.  The
+# directives use the per-document namespaces of :class:`DocContext`.
 plot_context = dict()
 
 
+class DocContext(object):
+    """ Execution state for the nbplot directives in one document
+
+    Attributes
+    ----------
+    ns : dict
+        Namespace in which to run the code of the nbplot directives.
+    cache_key : None or str
+        Image cache key of the last directive in the document, or None if
+        there has not yet been a directive.
+    keys : list
+        Image cache keys of the directives so far, in document order.
+    deferred : list
+        Code that has not yet run in `ns`, because the image cache had its
+        images.  Each element is a dict of keyword arguments for
+        :func:`execute_code`.
+    profile : None or :class:`nb2plots.profiling.CodeProfile`
+        Profile of code run in `ns`, if profiling.
+    """
+
+    def __init__(self):
+        self.ns = {}
+        self.cache_key = None
+        self.keys = []
+        self.deferred = []
+        self.profile = None
+
+    def run_deferred(self):
+        """ Run any deferred code, to bring `ns` up to date
+        """
+        while self.deferred:
+            kwargs = self.deferred.pop(0)
+            try:
+                execute_code(**kwargs)
+            except PlotError:
+                # We only defer code that ran without error, last time.
+                pass
+
+
+def get_doc_context(env, reset=False):
+    """ Return :class:`DocContext` for document being read in `env`
+
+    We keep the context in ``env.temp_data``, so Sphinx throws it away when it
+    has finished reading the document.
+
+    Parameters
+    ----------
+    env : Sphinx build environment
+    reset : {False, True}, optional
+        If True, start a new context.
+
+    Returns
+    -------
+    context : :class:`DocContext` instance
+    """
+    if reset or 'nbplot_context' not in env.temp_data:
+        env.temp_data['nbplot_context'] = DocContext()
+    return env.temp_data['nbplot_context']
+
+
+def release_doc_context(env):
+    """ Free namespace and figures of document that `env` has just read
+
+    Sphinx would throw away the context with ``env.temp_data`` in any case,
+    but the namespace usually has reference cycles (from functions defined in
+    the namespace), so its objects stay in memory until the next garbage
+    collection, and pyplot keeps the figures open until the next document
+    resets the context.
+
+    We need a full garbage collection, because automatic collections move
+    objects that survive them, including cycles in the namespace, into the
+    oldest generation.  Documents without nbplot code have no context, and
+    do not pay for the collection.
+
+    Log any code that :func:`do_prerun` ran for the document, but that the
+    directives did not use, because the scan of the ReST source did not match
+    the directives.
+
+    Parameters
+    ----------
+    env : Sphinx build environment
+    """
+    context = env.temp_data.pop('nbplot_context', None)
+    expected = prerun_keys.pop(env.docname, None)
+    if expected and set(expected).difference(
+            [] if context is None else context.keys):
+        logger.info('nbplot code run for {} in worker process did not match '
+                    'the nbplot directives, which ran their own code'.format(
+                        env.docname))
+    if context is None:
+        return
+    if context.profile is not None:
+        context.profile.dump(profile_fname(env.app.outdir, env.docname))
+    context.ns.clear()
+    del context.deferred[:]
+    _pyplot().close('all')
+    gc.collect()
+
+
 class ImageFile(object):
     def __init__(self, basename, path):
         self.basename = basename
@@ -791,6 +1139,42 @@ def _part_strs2dicts(part_strs):
     return dicts
 
 
+def _get_parts(options, option_name, flag_ns):
+    if option_name not in options:
+        return (0,)
+    indices = eval(options[option_name], flag_ns.copy())
+    return indices if isinstance(indices, Sequence) else (indices,)
+
+
+def select_parts(content, options, flag_ns):
+    """ Return code to render, code to run from directive `content`
+
+    Parameters
+    ----------
+    content : sequence of str
+        Contents from directive.  Each element is a line.
+    options : dict
+        Directive options, maybe including ``render-parts`` and
+        ``run-parts``.
+    flag_ns : dict
+        Namespace in which to evaluate ``render-parts`` and ``run-parts``.
+
+    Returns
+    -------
+    to_render : str
+        Code to render into built document.
+    to_run : str
+        Code to run to generate figures.
+    """
+    parts = parse_parts(content)
+    to_render = [parts[i]['contents']
+                 for i in _get_parts(options, 'render-parts', flag_ns)]
+    to_run = [parts[i]['contents']
+              for i in _get_parts(options, 'run-parts', flag_ns)]
+    return ('\n'.join(sum(to_render, [])),
+            '\n'.join(sum(to_run, [])))
+
+
 def parse_parts(lines):
     """ Parse string list `content` into `parts`
 
@@ -832,7 +1216,7 @@ def _check_wd(path):
 
 
 def run_code(code, code_path=None, ns=None, function_name=None, workdir=None,
-             pre_code=None, raises=None):
+             pre_code=None, raises=None, capture=None, profile=None):
     """
     Run `code` from file at `code_path` in namespace `ns`
 
@@ -855,6 +1239,14 @@ def run_code(code, code_path=None, ns=None, function_name=None, workdir=None,
         Any code to run before `code`.
     raises : None or Exception class
         An exception that the run code should raise.
+    capture : None or dict, optional
+        If dict, record standard output from `code` in key ``stdout``, and the
+        display data for the value of any final expression in `code` in key
+        ``result`` (None if no final expression, or value is None).  See
+        :func:`format_result`.  Key ``complete`` is False if there is a value
+        for which we cannot make the display data.
+    profile : None or :class:`nb2plots.profiling.CodeProfile`, optional
+        If not None, run `code` under this profile.
 
     Returns
     -------
@@ -890,20 +1282,28 @@ def run_code(code, code_path=None, ns=None, function_name=None, workdir=None,
             code = unescape_doctest(code)
             if pre_code and not ns:
                 exec(str(pre_code), ns)
-            ns['print'] = _dummy_print
+            ns['print'] = _dummy_print if capture is None else print
             if "__main__" in code:
                 exec("__name__ = '__main__'", ns)
+            result = None
             if raises is None:
-                exec(code, ns)
+                result = _exec_code(code, ns, capture is not None, profile)
             else:  # Code should raise exception
                 try:
-                    exec(code, ns)
+                    _exec_code(code, ns, profile=profile)
                 except raises:
                     pass
             if function_name:
                 exec(function_name + "()", ns)
         except (Exception, SystemExit):
             raise PlotError(traceback.format_exc())
+        if capture is not None:
+            capture['stdout'] = sys.stdout.getvalue()
+            capture['result'] = (None if result is None
+                                 else format_result(result))
+            # A kernel has to display results that we cannot format.
+            capture['complete'] = (result is None or
+                                   capture['result'] is not None)
     finally:
         os.chdir(pwd)
         sys.argv = old_sys_argv
@@ -912,43 +1312,59 @@ def run_code(code, code_path=None, ns=None, function_name=None, workdir=None,
     return ns
 
 
-def render_figures(code, code_path, output_dir, output_base, config,
-                   context=True, function_name=None, context_reset=False,
-                   close_figs=False, raises=None):
-    """ Run plot code and save the hi/low res PNGs, PDF in `output_dir`
+def _exec_code(code, ns, want_result=False, profile=None):
+    """ Execute `code` in `ns`, maybe return value of final expression
 
-    Save the images under `output_dir` with file names derived from
-    `output_base`.
+    As for IPython, there is no result if the final expression ends with a
+    semicolon.  If `profile` is not None, run the code with
+    :class:`nb2plots.profiling.CodeProfile` `profile`.
+    """
+    if not want_result and profile is None:
+        exec(code, ns)
+        return None
+    tree = ast.parse(code)
+    last = None
+    if (want_result and len(tree.body) > 0 and
+            isinstance(tree.body[-1], ast.Expr)):
+        last = tree.body.pop()
+    if profile is None:
+        exec(compile(tree, '<string>', 'exec'), ns)
+    else:
+        profile.exec_tree(tree, ns)
+    if last is None:
+        return None
+    expr = ast.Expression(last.value)
+    result = (eval(compile(expr, '<string>', 'eval'), ns) if profile is None
+              else profile.eval_expr(expr, ns))
+    return None if _ends_with_semicolon(code) else result
+
+
+def _ends_with_semicolon(code):
+    """ True if last token in `code`, other than comments, is a semicolon
+    """
+    tokens = [tok for tok in
+              tokenize.generate_tokens(io.StringIO(code).readline)
+              if tok.type not in (tokenize.COMMENT, tokenize.NL,
+                                  tokenize.NEWLINE, tokenize.INDENT,
+                                  tokenize.DEDENT, tokenize.ENDMARKER)]
+    return len(tokens) > 0 and tokens[-1].string == ';'
+
+
+def parse_formats(plot_formats):
+    """ Return list of (suffix, dpi) tuples from `plot_formats` setting
 
     Parameters
     ----------
-    code : str
-        String containing code to run.
-    code_path : str
-        Path of file containing code.  Usually path to ``.rst`` file.
-    output_dir : str
-        Path to which to write output images from plots.
-    output_base : str
-        Prefix for filename(s) for output image(s).
-    config : instance
-        Sphinx configuration instance.
-    context : {True, False}, optional
-        If True, use persistent context (workspace) for executing code.
-        Otherwise create new empty context for executing code.
-    function_name : None or str, optional
-        If not-empty str, name of function to execute after executing `code`.
-    context_reset : {False, True}, optional
-        If True, clear persistent context (workspace) for code.
-    close_figs : {False, True}, optional
-        If True, close all figures generated before our `code` runs.  False can
-        be useful when building up a plot with several `code` blocks.
-    raises : None or Exception, optional
-        Exception class that code should raise, or None, for no exception.
+    plot_formats : str or sequence
+        Value of ``nbplot_formats`` configuration setting.
+
+    Returns
+    -------
+    formats : list
+        List of ``(suffix, dpi)`` tuples.
     """
-    # -- Parse format list
     default_dpi = {'png': 80, 'hires.png': 200, 'pdf': 200}
     formats = []
-    plot_formats = config.nbplot_formats
     if isinstance(plot_formats, str):
         # String Sphinx < 1.3, Split on , to mimic
         # Sphinx 1.3 and later. Sphinx 1.3 always
@@ -965,32 +1381,211 @@ def render_figures(code, code_path, output_dir, output_base, config,
             formats.append((str(fmt[0]), int(fmt[1])))
         else:
             raise PlotError('invalid image format "%r" in nbplot_formats' % fmt)
+    return formats
+
+
+# Image formats that builders use, by builder name or builder format.  None
+# means all formats in ``nbplot_formats``.  Builders can also declare the
+# formats they use with an ``nbplot_formats`` attribute.  HTML builders use
+# "png", and, if ``nbplot_html_show_formats`` is True, all other formats.
+BUILDER_FORMATS = {
+    'latex': ('pdf',),
+    'texinfo': ('png',),
+    'text': (),
+    'man': (),
+    'doctest': (),
+    'linkcheck': (),
+}
+
+
+def builder_formats(builder, config):
+    """ Return formats from ``nbplot_formats`` that `builder` will use
+
+    Parameters
+    ----------
+    builder : Sphinx builder instance
+    config : Sphinx configuration instance
+
+    Returns
+    -------
+    formats : list
+        List of ``(suffix, dpi)`` tuples, as returned from
+        :func:`parse_formats`.
+    """
+    formats = parse_formats(config.nbplot_formats)
+    if hasattr(builder, 'nbplot_formats'):
+        used = builder.nbplot_formats
+    elif builder.format == 'html':
+        used = None if config.nbplot_html_show_formats else ('png',)
+    else:
+        used = BUILDER_FORMATS.get(builder.name,
+                                   BUILDER_FORMATS.get(builder.format))
+    if used is None:
+        return formats
+    return [(fmt, dpi) for fmt, dpi in formats if fmt in used]
+
+
+def get_formats(env):
+    """ Return formats to render for current build in `env`
+
+    These are the formats that the current builder uses, and the formats for
+    builders named in the ``nbplot_render_for`` configuration value.
+    """
+    app, config = env.app, env.config
+    builders = [app.builder]
+    for name in config.nbplot_render_for:
+        app.registry.preload_builder(app, name)
+        builders.append(app.registry.builders[name])
+    used = set()
+    for builder in builders:
+        used.update(fmt for fmt, dpi in builder_formats(builder, config))
+    return [(fmt, dpi) for fmt, dpi in parse_formats(config.nbplot_formats)
+            if fmt in used]
+
+
+def code_workdir(config, code_path=None):
+    """ Return working directory for code from file `code_path`
+
+    This is ``config.nbplot_working_directory`` if set, otherwise the
+    directory containing `code_path`, or None (current working directory) if
+    `code_path` is None.
+    """
+    if config.nbplot_working_directory is not None:
+        return _check_wd(config.nbplot_working_directory)
+    if code_path is not None:
+        return abspath(dirname(code_path))
+    return None
+
 
-    # Build the output
-    ns = plot_context if context else {}
+def execute_code(code, code_path, config, context=True, function_name=None,
+                 context_reset=False, close_figs=False, raises=None, ns=None,
+                 capture=None, profile=None):
+    """ Run plot code, leaving any generated figures open
+
+    See :func:`render_figures` for parameters.
+    """
+    plt = _pyplot()
+    import matplotlib
+    if ns is None:
+        ns = plot_context
+    if not context:
+        ns = {}
 
     if context_reset:
         plt.close('all')
         matplotlib.rc_file_defaults()
         matplotlib.rcParams.update(config.nbplot_rcparams)
-        plot_context.clear()
+        ns.clear()
 
     close_figs = not context or close_figs
 
-    # Get working directory for code execution
-    if setup.config.nbplot_working_directory is not None:
-        workdir = _check_wd(setup.config.nbplot_working_directory)
-    elif code_path is not None:
-        workdir = abspath(dirname(code_path))
-    else:
-        workdir = None
-
     if close_figs:
         plt.close('all')
 
-    run_code(code, code_path, ns, function_name, workdir=workdir,
-             pre_code=setup.config.nbplot_pre_code, raises=raises)
+    fignums = set(plt.get_fignums())
+    run_code(code, code_path, ns, function_name,
+             workdir=code_workdir(config, code_path),
+             pre_code=config.nbplot_pre_code, raises=raises, capture=capture,
+             profile=profile)
+    if capture is not None:
+        capture['figures'] = capture_figures(fignums)
+
+
+# Types for which IPython displays the ``repr``.
+_SIMPLE_RESULT_TYPES = (bool, int, float, complex, str)
+
+# IPython display formatter; see :func:`format_result`.
+_display_formatter = None
+
+
+def format_result(result):
+    """ Return notebook display data for `result`, or None if not known
+
+    Parameters
+    ----------
+    result : object
+        Value of final expression in code.
+
+    Returns
+    -------
+    data : None or dict
+        Dict with MIME types as keys, such as ``text/plain``, and the display
+        of `result` in that type, as for the execution result from a Jupyter
+        kernel.  We use the IPython display formatter if IPython is available,
+        otherwise we can only format simple types such as numbers and
+        strings.  None if we cannot tell what the kernel would display.
+    """
+    global _display_formatter
+    if _display_formatter is None:
+        try:
+            from IPython.core.formatters import DisplayFormatter
+        except ImportError:
+            if isinstance(result, _SIMPLE_RESULT_TYPES):
+                return {'text/plain': repr(result)}
+            return None
+        _display_formatter = DisplayFormatter()
+    # The kernel inline backend adds image formats for figures.
+    figure = sys.modules.get('matplotlib.figure')
+    if figure is not None and isinstance(result, figure.Figure):
+        return None
+    data, metadata = _display_formatter.format(result)
+    # Notebooks store binary data, such as images, as base64 text.
+    return {mime_type: (base64.b64encode(value).decode('ascii')
+                        if isinstance(value, bytes) else value)
+            for mime_type, value in data.items()}
+
+
+def capture_figures(old_fignums=()):
+    """ Return notebook display data for new or changed figures
+
+    Parameters
+    ----------
+    old_fignums : sequence, optional
+        Numbers of figures open before running the code.  We capture figures
+        with other numbers, and figures with changes since the last draw.
+
+    Returns
+    -------
+    figures : list
+        List of dicts with keys ``image/png`` (base64-encoded PNG image) and
+        ``text/plain`` (figure ``repr``), as for Jupyter display data.
+    """
+    from matplotlib._pylab_helpers import Gcf
+    figures = []
+    for figman in Gcf.get_all_fig_managers():
+        fig = figman.canvas.figure
+        if figman.num in old_fignums and not fig.stale:
+            continue
+        bio = io.BytesIO()
+        fig.savefig(bio, format='png', bbox_inches='tight')
+        figures.append({'image/png': base64.b64encode(
+                            bio.getvalue()).decode('ascii'),
+                        'text/plain': repr(fig)})
+    return figures
+
+
+def save_figures(output_dir, output_base, formats, timing=None):
+    """ Save open figures to `output_dir` in `formats`, return images
+
+    Parameters
+    ----------
+    output_dir : str
+        Path to which to write output images from plots.
+    output_base : str
+        Prefix for filename(s) for output image(s).
+    formats : list
+        List of ``(suffix, dpi)`` tuples, as returned from
+        :func:`parse_formats`.
+    timing : None or dict, optional
+        If dict, add the time in seconds to save the figures in each format,
+        with the format suffix as key.
 
+    Returns
+    -------
+    images : list
+        List of :class:`ImageFile` instances, one per figure.
+    """
+    from matplotlib._pylab_helpers import Gcf
     images = []
     fig_managers = Gcf.get_all_fig_managers()
     for j, figman in enumerate(fig_managers):
@@ -1000,15 +1595,624 @@ def render_figures(code, code_path, output_dir, output_base, config,
             img = ImageFile("%s_%02d" % (output_base, j), output_dir)
         images.append(img)
         for format, dpi in formats:
+            start = time.perf_counter()
             try:
                 figman.canvas.figure.savefig(img.filename(format), dpi=dpi)
             except Exception:
                 raise PlotError(traceback.format_exc())
+            if timing is not None:
+                timing[format] = (timing.get(format, 0) +
+                                  time.perf_counter() - start)
             img.formats.append(format)
 
     return images
 
 
+def render_figures(code, code_path, output_dir, output_base, config,
+                   context=True, function_name=None, context_reset=False,
+                   close_figs=False, raises=None, ns=None, formats=None,
+                   capture=None, timing=None, memory=None, profile=None):
+    """ Run plot code and save the hi/low res PNGs, PDF in `output_dir`
+
+    Save the images under `output_dir` with file names derived from
+    `output_base`.
+
+    Parameters
+    ----------
+    code : str
+        String containing code to run.
+    code_path : str
+        Path of file containing code.  Usually path to ``.rst`` file.
+    output_dir : str
+        Path to which to write output images from plots.
+    output_base : str
+        Prefix for filename(s) for output image(s).
+    config : instance
+        Sphinx configuration instance.
+    context : {True, False}, optional
+        If True, use persistent context (workspace) for executing code.
+        Otherwise create new empty context for executing code.
+    function_name : None or str, optional
+        If not-empty str, name of function to execute after executing `code`.
+    context_reset : {False, True}, optional
+        If True, clear persistent context (workspace) for code.
+    close_figs : {False, True}, optional
+        If True, close all figures generated before our `code` runs.  False can
+        be useful when building up a plot with several `code` blocks.
+    raises : None or Exception, optional
+        Exception class that code should raise, or None, for no exception.
+    ns : None or dict, optional
+        Namespace for persistent context.  If None, use the module
+        ``plot_context`` namespace.
+    formats : None or list, optional
+        List of ``(suffix, dpi)`` tuples giving formats to save.  If None, use
+        all formats in ``config.nbplot_formats``.
+    capture : None or dict, optional
+        If dict, record standard output, final expression value and figures
+        from running the code, in keys ``stdout``, ``result`` and
+        ``figures``.  See :func:`run_code` and :func:`capture_figures`.
+    timing : None or dict, optional
+        If dict, record wall time and CPU time in seconds for running the
+        code and saving the figures, in keys ``wall`` and ``cpu``, the wall
+        time for running the code in key ``exec``, a dict of wall times for
+        saving each figure format in key ``savefig``, and the number of
+        figures in key ``n_figures``.
+    memory : None or dict, optional
+        If dict, record memory allocated by the code, and still allocated when
+        it finishes, and peak memory allocated while it runs.  See
+        :func:`nb2plots.memory.track_memory`.
+    profile : None or :class:`nb2plots.profiling.CodeProfile`, optional
+        If not None, run the code under this profile.
+    """
+    if formats is None:
+        formats = parse_formats(config.nbplot_formats)
+    with track_memory(memory):
+        if timing is None:
+            execute_code(code, code_path, config, context, function_name,
+                         context_reset, close_figs, raises, ns, capture,
+                         profile)
+            return save_figures(output_dir, output_base, formats)
+        start, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            execute_code(code, code_path, config, context, function_name,
+                         context_reset, close_figs, raises, ns, capture,
+                         profile)
+            timing['exec'] = time.perf_counter() - start
+            timing['savefig'] = {}
+            images = save_figures(output_dir, output_base, formats,
+                                  timing['savefig'])
+            timing['n_figures'] = len(images)
+        finally:
+            timing['wall'] = time.perf_counter() - start
+            timing['cpu'] = time.process_time() - start_cpu
+    return images
+
+
+def _hash_strs(*strs):
+    sha = hashlib.sha256()
+    for s in strs:
+        sha.update(s.encode('utf-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def doc_cache_key(config, formats=None, code_path=None):
+    """ Return image cache key for start of a document with `config`
+
+    The key covers the settings, working directory and library versions that
+    can affect the figures from all code in the document.  `formats` is a list
+    of ``(suffix, dpi)`` tuples of formats to save; if None, use all formats
+    in ``config.nbplot_formats``.  `code_path` is the path of the document,
+    giving the working directory for the code (see :func:`code_workdir`).
+    """
+    if formats is None:
+        formats = parse_formats(config.nbplot_formats)
+    import matplotlib
+    import numpy as np
+    return _hash_strs(str(__version__),
+                      sys.version,
+                      matplotlib.__version__,
+                      np.__version__,
+                      str(config.nbplot_pre_code),
+                      repr(sorted(config.nbplot_rcparams.items())),
+                      repr(formats),
+                      repr(code_workdir(config, code_path)))
+
+
+def block_cache_key(prev_key, code, close_figs=False, raises=None):
+    """ Return image cache key for `code` following key `prev_key`
+
+    Parameters
+    ----------
+    prev_key : str
+        Cache key for previous nbplot directive in document, or document key
+        from :func:`doc_cache_key` for first directive in document.
+    code : str
+        Code to be run.
+    close_figs : {False, True}, optional
+        Whether figures get closed before running `code`.
+    raises : None or str, optional
+        Contents of ``raises`` option of directive.
+
+    Returns
+    -------
+    key : str
+        Hex digest string.
+    """
+    return _hash_strs(prev_key, code, repr(close_figs), repr(raises))
+
+
+class FigureCache(object):
+    """ On-disk store of images generated from nbplot code
+
+    Each cache entry is a directory, named for its key, containing the image
+    files and an ``images.json`` file listing the figures and their formats.
+    """
+
+    manifest_name = 'images.json'
+    capture_name = 'capture.json'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _entry_dir(self, key):
+        return pjoin(self.cache_dir, key[:2], key)
+
+    def has(self, key, capture=False):
+        """ True if cache has entry for `key`, maybe with captured outputs
+        """
+        entry_dir = self._entry_dir(key)
+        if capture and not isfile(pjoin(entry_dir, self.capture_name)):
+            return False
+        return isfile(pjoin(entry_dir, self.manifest_name))
+
+    def get_capture(self, key):
+        """ Return captured outputs for `key`, or None if not present
+        """
+        fname = pjoin(self._entry_dir(key), self.capture_name)
+        if not isfile(fname):
+            return None
+        with open(fname, 'rt') as fobj:
+            return json.load(fobj)
+
+    def get(self, key, output_dir, output_base):
+        """ Copy images for `key` to `output_dir`, return images
+
+        Parameters
+        ----------
+        key : str
+            Cache key.
+        output_dir : str
+            Path to which to write output images.
+        output_base : str
+            Prefix for filename(s) for output image(s).
+
+        Returns
+        -------
+        images : None or list
+            None if there is no entry for `key`, otherwise list of
+            :class:`ImageFile` instances.
+        """
+        entry_dir = self._entry_dir(key)
+        manifest = pjoin(entry_dir, self.manifest_name)
+        if not isfile(manifest):
+            return None
+        with open(manifest, 'rt') as fobj:
+            figures = json.load(fobj)
+        images = []
+        for j, formats in enumerate(figures):
+            img = ImageFile(output_base if len(figures) == 1
+                            else "%s_%02d" % (output_base, j),
+                            output_dir)
+            for fmt in formats:
+                shutil.copyfile(pjoin(entry_dir, '%d.%s' % (j, fmt)),
+                                img.filename(fmt))
+                img.formats.append(fmt)
+            images.append(img)
+        return images
+
+    def put(self, key, images, capture=None):
+        """ Store files from `images`, and `capture`, in cache under `key`
+        """
+        entry_dir = self._entry_dir(key)
+        parent = dirname(entry_dir)
+        if not isdir(parent):
+            os.makedirs(parent, exist_ok=True)
+        # Write to temporary directory, then rename, so entries are complete.
+        tmp_dir = mkdtemp(dir=parent)
+        for j, img in enumerate(images):
+            for fmt in img.formats:
+                shutil.copyfile(img.filename(fmt),
+                                pjoin(tmp_dir, '%d.%s' % (j, fmt)))
+        with open(pjoin(tmp_dir, self.manifest_name), 'wt') as fobj:
+            json.dump([img.formats for img in images], fobj)
+        if capture is not None:
+            with open(pjoin(tmp_dir, self.capture_name), 'wt') as fobj:
+                json.dump(capture, fobj)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:  # Entry already present
+            if capture is not None and not self.has(key, capture=True):
+                os.replace(pjoin(tmp_dir, self.capture_name),
+                           pjoin(entry_dir, self.capture_name))
+            shutil.rmtree(tmp_dir)
+
+
+def get_figure_cache(env):
+    """ Return :class:`FigureCache` for `env`, or None if cache disabled
+    """
+    config = env.config
+    if not (config.nbplot_cache or config.nbplot_jobs > 1):
+        return None
+    cache_dir = config.nbplot_cache_dir
+    if cache_dir is None:
+        cache_dir = pjoin(dirname(env.doctreedir), 'nbplot_cache')
+    return FigureCache(pjoin(env.app.confdir, cache_dir))
+
+
+#------------------------------------------------------------------------------
+# Running code for documents in worker processes
+#------------------------------------------------------------------------------
+
+DIRECTIVE_START = re.compile(r'^(?P<indent> *)\.\. +(?P<name>nbplot|nbplot-flags)'
+                             r' *:: *$')
+
+OPTION_LINE = re.compile(r'^:(?P<name>[\w-]+):(?P<value>.*)$')
+
+# Start of any directive.
+ANY_DIRECTIVE = re.compile(r'^(?P<indent> *)\.\. +(?P<name>[\w:.-]+) *::')
+
+# Start of comment: explicit markup that is not a directive, footnote,
+# citation, substitution definition or target.
+COMMENT_START = re.compile(
+    r'^(?P<indent> *)\.\.(?:$| +(?![\w:.-]+ *::)(?![\[|_]))')
+
+# Directives with content that is not ReST, and so cannot contain directives.
+LITERAL_DIRECTIVES = {'code', 'code-block', 'sourcecode', 'parsed-literal',
+                      'raw', 'math', 'doctest', 'testcode', 'testoutput',
+                      'testsetup', 'testcleanup', 'ipython'}
+
+INCLUDE_LINE = re.compile(r'^ *\.\. +include *:: *(?P<path>.*?) *$', re.M)
+
+
+def _indent(line):
+    return len(line) - len(line.lstrip())
+
+
+def _block_end(lines, i, indent):
+    """ Return index of first line after `i` outside block at `indent`
+    """
+    while i < len(lines):
+        line = lines[i]
+        if line.strip() and _indent(line) <= indent:
+            break
+        i += 1
+    return i
+
+
+def find_nbplots(text):
+    """ Find ``nbplot`` and ``nbplot-flags`` directives in ReST `text`
+
+    This is a quick scan of the ReST source.  It skips literal blocks,
+    comments, and the contents of directives that do not contain ReST, such
+    as ``code-block``, but it can get things wrong for unusual markup, and it
+    does not look in included files.  That is OK, because the directives run
+    any code that the scan did not find, and :func:`release_doc_context`
+    reports any code that the scan found, but the directives did not use.
+
+    Parameters
+    ----------
+    text : str
+        ReST source.
+
+    Returns
+    -------
+    directives : list
+        List of ``(name, options, content)`` tuples, where `name` is the
+        directive name, `options` is a dict of directive options, and
+        `content` is a list of content lines.
+    """
+    lines = text.splitlines()
+    directives = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        match = DIRECTIVE_START.match(line)
+        i += 1
+        if match is None:
+            other = ANY_DIRECTIVE.match(line)
+            if other is not None:
+                if other.group('name') in LITERAL_DIRECTIVES:
+                    i = _block_end(lines, i, len(other.group('indent')))
+            elif COMMENT_START.match(line):
+                i = _block_end(lines, i, _indent(line))
+            elif line.rstrip().endswith('::'):  # Literal block follows.
+                i = _block_end(lines, i, _indent(line))
+            continue
+        indent = len(match.group('indent'))
+        end = _block_end(lines, i, indent)
+        block = textwrap.dedent('\n'.join(lines[i:end])).splitlines()
+        i = end
+        options = {}
+        while block and OPTION_LINE.match(block[0]):
+            opt_match = OPTION_LINE.match(block.pop(0))
+            options[opt_match.group('name')] = opt_match.group('value').strip()
+        directives.append((match.group('name'), options, block))
+    return directives
+
+
+def _includes_nbplots(text, doc_path, srcdir):
+    """ True if ReST `text` includes a file that may have nbplot directives
+
+    Include paths starting with ``/`` are relative to `srcdir`, as for Sphinx;
+    other paths are relative to the directory of `doc_path`.  We assume that
+    a file we cannot read may have directives.
+    """
+    for match in INCLUDE_LINE.finditer(text):
+        path = match.group('path')
+        if path.startswith('<'):  # Standard docutils include files.
+            continue
+        path = (pjoin(srcdir, path.lstrip('/')) if path.startswith('/')
+                else pjoin(dirname(doc_path), path))
+        try:
+            with io.open(path, 'rt', encoding='utf-8') as fobj:
+                if 'nbplot' in fobj.read():
+                    return True
+        except (OSError, ValueError):
+            return True
+    return False
+
+
+def _prerun_blocks(text, flag_ns):
+    """ Return list of dicts with code and options for nbplots in `text`
+    """
+    flag_ns = flag_ns.copy()
+    blocks = []
+    for name, options, content in find_nbplots(text):
+        if name == 'nbplot-flags':
+            exec('\n'.join(content), None, flag_ns)
+            continue
+        to_render, to_run = select_parts(content, options, flag_ns)
+        blocks.append(dict(code=to_run,
+                           close_figs='keepfigs' not in options,
+                           raises=options.get('raises')))
+    return blocks
+
+
+def _prerun_keys(blocks, doc_key):
+    """ Return image cache keys for `blocks` from :func:`_prerun_blocks`
+
+    `doc_key` is the key from :func:`doc_cache_key` for the document.
+    """
+    keys = []
+    for block in blocks:
+        doc_key = block_cache_key(doc_key, **block)
+        keys.append(doc_key)
+    return keys
+
+
+def _preload_modules(pre_code):
+    """ Return names of modules to import in fork server for `pre_code`
+
+    These are this module, :mod:`nb2plots.forkpreload`, to import pyplot with
+    the Agg backend, and the modules that `pre_code` imports.  For ``from
+    module import name``, we return ``module`` and ``module.name``, in case
+    ``name`` is a submodule; the fork server ignores names it cannot import.
+    """
+    names = [__name__, 'nb2plots.forkpreload']
+    try:
+        tree = ast.parse(pre_code or '')
+    except SyntaxError:  # Leave the directives to report the error.
+        return names
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif (isinstance(node, ast.ImportFrom) and node.level == 0 and
+              node.module):
+            names.append(node.module)
+            names += [node.module + '.' + alias.name for alias in node.names
+                      if alias.name != '*']
+    return names
+
+
+def fork_pool_kwargs(pre_code):
+    """ Return pool arguments to run each document in process from fork server
+
+    The fork server is a single-threaded process that has imported this
+    module, pyplot, and the modules that `pre_code` imports.  Each document runs in a new
+    process forked from the server, so documents do not pay to import these
+    modules, and changes to global state in one document cannot leak into
+    another.
+
+    Return empty dict, for plain worker processes, if the platform does not
+    have the fork server, or Python < 3.11 cannot limit worker processes to
+    one task.
+
+    Parameters
+    ----------
+    pre_code : None or str
+        Code that runs before the code of each document.
+
+    Returns
+    -------
+    pool_kwargs : dict
+        Keyword arguments for :class:`ProcessPoolExecutor`.
+    """
+    import multiprocessing
+    if (sys.version_info < (3, 11) or
+        'forkserver' not in multiprocessing.get_all_start_methods()):
+        return {}
+    context = multiprocessing.get_context('forkserver')
+    # Only has an effect if the fork server for this process has not yet
+    # started.
+    context.set_forkserver_preload(_preload_modules(pre_code))
+    return dict(mp_context=context, max_tasks_per_child=1)
+
+
+def prerun_doc(code_path, blocks, config_params, cache_dir):
+    """ Run code from `blocks`, store figures in image cache at `cache_dir`
+
+    Run in worker process.
+
+    Parameters
+    ----------
+    code_path : str
+        Path of document containing code.
+    blocks : list
+        List of dicts, with keys ``code``, ``close_figs`` and ``raises``,
+        giving code and options of nbplot directives, in document order.
+    config_params : dict
+        Values of configuration options needed to run code.
+    cache_dir : str
+        Image cache directory.
+
+    Returns
+    -------
+    errors : dict
+        Dict with keys being image cache keys of directives where code raised
+        an error, and values being the error messages.
+    timings : dict
+        Dict with keys being image cache keys of directives that ran, and
+        values being dicts of timings (see :func:`render_figures`), if
+        ``nbplot_timing`` in `config_params` is True, or None otherwise.
+    memories : dict
+        Dict with keys being image cache keys of directives that ran, and
+        values being dicts of memory use (see :func:`render_figures`), if
+        ``nbplot_memory`` in `config_params` is True, or None otherwise.
+    """
+    with span(code_path, 'prerun'):
+        return _prerun_doc(code_path, blocks, config_params, cache_dir)
+
+
+def _prerun_doc(code_path, blocks, config_params, cache_dir):
+    config = SimpleNamespace(**config_params)
+    cache = FigureCache(cache_dir)
+    context = DocContext()
+    keys = _prerun_keys(blocks, doc_cache_key(config, code_path=code_path))
+    errors, timings, memories = {}, {}, {}
+    output_dir = mkdtemp()
+    try:
+        for i, (key, block) in enumerate(zip(keys, blocks)):
+            kwargs = dict(code=block['code'],
+                          code_path=code_path,
+                          config=config,
+                          context_reset=i == 0,
+                          close_figs=block['close_figs'],
+                          raises=(None if block['raises'] is None
+                                  else eval(block['raises'])),
+                          ns=context.ns)
+            if cache.has(key, capture=config.nbplot_capture):
+                context.deferred.append(kwargs)
+                continue
+            context.run_deferred()
+            capture = {} if config.nbplot_capture else None
+            timing = timings[key] = {} if config.nbplot_timing else None
+            memory = memories[key] = {} if config.nbplot_memory else None
+            try:
+                images = render_figures(output_dir=output_dir,
+                                        output_base='fig',
+                                        capture=capture,
+                                        timing=timing,
+                                        memory=memory,
+                                        **kwargs)
+            except PlotError as err:
+                errors[key] = str(err)
+                continue
+            cache.put(key, images, capture)
+    finally:
+        shutil.rmtree(output_dir)
+        context.ns.clear()
+        _pyplot().close('all')
+    return errors, timings, memories
+
+
+# Error messages from code run by :func:`prerun_doc`, keyed by image cache
+# key.
+prerun_errors = {}
+
+# Timings for code run by :func:`prerun_doc`, keyed by image cache key.
+prerun_timings = {}
+
+# Memory use for code run by :func:`prerun_doc`, keyed by image cache key.
+prerun_memories = {}
+
+# Image cache keys of directives that :func:`prerun_doc` ran, keyed by
+# document name.
+prerun_keys = {}
+
+
+def do_prerun(app, env, docnames):
+    """ Run nbplot code for `docnames` across processes, before reading
+
+    The processes put their figures into the image cache, and the nbplot
+    directives pick them up from there.
+    """
+    prerun_errors.clear()
+    prerun_timings.clear()
+    prerun_memories.clear()
+    prerun_keys.clear()
+    config = env.config
+    # Profiling runs all the code in this process.
+    if config.nbplot_jobs < 2 or config.nbplot_profile:
+        return
+    formats = get_formats(env)
+    if not (formats or config.nbplot_execute_unrendered):
+        return
+    config_params = {name: getattr(config, name) for name in
+                     ('nbplot_pre_code',
+                      'nbplot_rcparams',
+                      'nbplot_working_directory',
+                      'nbplot_capture',
+                      'nbplot_timing',
+                      'nbplot_memory')}
+    config_params['nbplot_formats'] = formats
+    cache_dir = get_figure_cache(env).cache_dir
+    futures = {}
+    pool_kwargs = {}
+    if config.nbplot_fork_workers:
+        pool_kwargs = fork_pool_kwargs(config.nbplot_pre_code)
+    with ProcessPoolExecutor(config.nbplot_jobs, **pool_kwargs) as executor, \
+            span('nbplot prerun', 'prerun'):
+        for docname in docnames:
+            code_path = env.doc2path(docname)
+            with io.open(code_path, 'rt', encoding='utf-8') as fobj:
+                text = fobj.read()
+            # The scan cannot see directives in included files, and these
+            # would change the code and cache keys of later directives.
+            if _includes_nbplots(text, code_path, app.srcdir):
+                logger.info('not running nbplot code for {} in worker '
+                            'process, because it includes nbplot '
+                            'directives'.format(docname))
+                continue
+            try:
+                blocks = _prerun_blocks(text, config.nbplot_flags)
+                doc_key = doc_cache_key(config, formats, code_path)
+            except Exception:  # Leave the directives to report any errors.
+                continue
+            if len(blocks) == 0:
+                continue
+            prerun_keys[docname] = _prerun_keys(blocks, doc_key)
+            futures[docname] = executor.submit(prerun_doc,
+                                               str(code_path),
+                                               blocks,
+                                               config_params,
+                                               cache_dir)
+        for docname in status_iterator(sorted(futures),
+                                       'running nbplot code... ',
+                                       'purple',
+                                       len(futures),
+                                       app.verbosity):
+            try:
+                errors, timings, memories = futures[docname].result()
+            except Exception as err:
+                logger.info('nbplot code run for {} failed in worker '
+                            'process, with error {}'.format(docname, err))
+                continue
+            prerun_errors.update(errors)
+            prerun_timings.update(timings)
+            prerun_memories.update(memories)
+
+
 # Sphinx event handlers
 
 def _false():
@@ -1020,6 +2224,23 @@ def do_builder_init(app):
     env = app.env
     env.nbplot_reset_markers = defaultdict(_false)
     env.nbplot_flag_namespaces = defaultdict(dict)
+    # Keep record of image formats, files from previous builds.
+    if not hasattr(env, 'nbplot_doc_formats'):
+        env.nbplot_doc_formats = {}
+    if not hasattr(env, 'nbplot_doc_images'):
+        env.nbplot_doc_images = {}
+    if not hasattr(env, 'nbplot_captures'):
+        env.nbplot_captures = {}
+    if not hasattr(env, 'nbplot_timings'):
+        env.nbplot_timings = {}
+    if not hasattr(env, 'nbplot_memories'):
+        env.nbplot_memories = {}
+
+
+def do_release_context(app, doctree):
+    """ Free namespace and figures when document has been read
+    """
+    release_doc_context(app.env)
 
 
 def do_purge_doc(app, env, docname):
@@ -1027,6 +2248,68 @@ def do_purge_doc(app, env, docname):
     """
     env.nbplot_reset_markers[docname] = False
     env.nbplot_flag_namespaces[docname] = env.config.nbplot_flags.copy()
+    env.nbplot_doc_formats.pop(docname, None)
+    env.nbplot_doc_images.pop(docname, None)
+    env.nbplot_captures.pop(docname, None)
+    env.nbplot_timings.pop(docname, None)
+    env.nbplot_memories.pop(docname, None)
+    profile = profile_fname(app.outdir, docname)
+    if isfile(profile):
+        os.remove(profile)
+
+
+def do_get_outdated(app, env, added, changed, removed):
+    """ Return documents with figures in formats other than those needed now
+
+    For example, if the last build was for LaTeX, we will only have PDF
+    figures, and we need to reread documents with figures for HTML.
+    """
+    current = [fmt for fmt, dpi in get_formats(env)]
+    return [docname for docname, formats in env.nbplot_doc_formats.items()
+            if formats != current]
+
+
+def do_merge_info(app, env, docnames, other):
+    """ Merge markers, flag namespaces from parallel read of `docnames`
+    """
+    for docname in docnames:
+        env.nbplot_reset_markers[docname] = (
+            other.nbplot_reset_markers[docname])
+        env.nbplot_flag_namespaces[docname] = (
+            other.nbplot_flag_namespaces[docname])
+        if docname in other.nbplot_doc_formats:
+            env.nbplot_doc_formats[docname] = (
+                other.nbplot_doc_formats[docname])
+        if docname in other.nbplot_doc_images:
+            env.nbplot_doc_images[docname] = (
+                other.nbplot_doc_images[docname])
+        if docname in other.nbplot_captures:
+            env.nbplot_captures[docname] = other.nbplot_captures[docname]
+        if docname in other.nbplot_timings:
+            env.nbplot_timings[docname] = other.nbplot_timings[docname]
+        if docname in other.nbplot_memories:
+            env.nbplot_memories[docname] = other.nbplot_memories[docname]
+
+
+def do_copy_images(app, env):
+    """ Copy recorded images missing from builder output directory
+
+    The nbplot directives copy their images to the output directory when they
+    run.  Documents read by an earlier build, or for an earlier builder, may
+    have images that the current builder needs, but has not got.
+    """
+    formats = [fmt for fmt, dpi in builder_formats(app.builder, env.config)]
+    for images in env.nbplot_doc_images.values():
+        for fmt, fname, rel_dir in images:
+            if fmt not in formats or not isfile(fname):
+                continue
+            dest_dir = pjoin(app.builder.outdir, rel_dir)
+            dest_fname = pjoin(dest_dir, basename(fname))
+            if exists(dest_fname):
+                continue
+            if not exists(dest_dir):
+                os.makedirs(dest_dir)
+            shutil.copyfile(fname, dest_fname)
 
 
 def likes_builder(node, builder_name):
@@ -1057,10 +2340,6 @@ def dont_doctest_depart(self, node):
 
 
 def setup(app):
-    setup.app = app
-    setup.config = app.config
-    setup.confdir = app.confdir
-
     # Builders which run visit methods on nodes.  Basically everything but
     # doctest.
     visiting_builders = ('html', 'latex', 'text', 'texinfo')
@@ -1086,8 +2365,41 @@ def setup(app):
     app.add_config_value('nbplot_working_directory', None, True)
     app.add_config_value('nbplot_template', None, True)
     app.add_config_value('nbplot_flags', {}, True)
+    app.add_config_value('nbplot_cache', False, True)
+    app.add_config_value('nbplot_cache_dir', None, True)
+    app.add_config_value('nbplot_jobs', 1, True)
+    app.add_config_value('nbplot_fork_workers', False, True)
+    app.add_config_value('nbplot_execute_unrendered', True, True)
+    app.add_config_value('nbplot_render_for', [], True)
+    app.add_config_value('nbplot_capture', False, True)
+    app.add_config_value('nbplot_timing', False, True)
+    app.add_config_value('nbplot_trace', None, True)
+    app.add_config_value('nbplot_memory', False, True)
+    app.add_config_value('nbplot_memory_budget', None, True)
+    app.add_config_value('nbplot_profile', False, True)
 
     # Create dictionaries in builder environment
     app.connect(str('builder-inited'), do_builder_init)
     # Clear marker indicating that we have already started parsing a page
     app.connect(str('env-purge-doc'), do_purge_doc)
+    # Run code for documents to be read in worker processes
+    app.connect('env-before-read-docs', do_prerun)
+    # Reread documents with figures in formats other than those we need
+    app.connect('env-get-outdated', do_get_outdated)
+    # Collect markers and flags from parallel reads
+    app.connect('env-merge-info', do_merge_info)
+    # Free namespace and figures when we have read each document
+    app.connect('doctree-read', do_release_context)
+    # Copy any images missing from the output directory
+    app.connect('env-updated', do_copy_images)
+    # Write timing report after runroles have filled notebooks
+    app.connect('build-finished', write_timing_report, priority=900)
+    app.connect('build-finished', write_memory_report)
+    app.connect('build-finished', write_profile_summary)
+    # Record timeline of build
+    app.connect('builder-inited', start_trace)
+    app.connect('source-read', trace_read_start)
+    app.connect('doctree-read', trace_read_end)
+    app.connect('build-finished', write_trace, priority=950)
+    return {'parallel_read_safe': True,
+            'parallel_write_safe': True}
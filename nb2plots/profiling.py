@@ -0,0 +1,165 @@
+""" Profile nbplot code, with hot spots by ReST source line
+
+With the ``nbplot_profile`` configuration option set to True, we run the code
+of the nbplot directives under :mod:`cProfile`.  We compile each top-level
+statement of the code separately, with the file name of the ReST document,
+and the line number of the statement in that document, so the profile has
+one entry for each statement, at its line in the ReST document.
+
+When Sphinx has read a document, we write the profile for the document to
+``nbplot_profile/<docname>.pstats`` in the output directory.  You can load
+these with :class:`pstats.Stats`.  At the end of the build, we write a summary
+to ``nbplot_profile.txt`` in the output directory, listing the statements and
+functions from the ReST documents, slowest first, keyed by
+``<docname>:<line>``, and show the slowest in the build output.
+
+To profile all the code, profile mode runs the code for every nbplot
+directive in the main Sphinx process, without using the image cache (see
+``nbplot_cache``) or worker processes (see ``nbplot_jobs``).  Line numbers
+are approximate for directives using the ``run-parts`` option.
+"""
+
+import os
+from os.path import join as pjoin, dirname, isdir, isfile, realpath
+import ast
+from copy import copy
+import cProfile
+import pstats
+
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = 'nbplot_profile'
+
+SUMMARY_NAME = 'nbplot_profile.txt'
+
+# Number of slowest lines to show in build output.
+N_SLOWEST = 10
+
+
+class CodeProfile(object):
+    """ Profile of code run from a ReST document
+
+    Parameters
+    ----------
+    code_path : str
+        Path of ReST document containing code.
+    lineno : int, optional
+        Line number in document of first line of code.
+    profiler : None or :class:`cProfile.Profile`, optional
+        Profiler to collect profile.  If None, make new profiler.
+    """
+
+    def __init__(self, code_path, lineno=1, profiler=None):
+        self.code_path = code_path
+        self.lineno = lineno
+        self.profiler = cProfile.Profile() if profiler is None else profiler
+
+    def at_line(self, lineno):
+        """ Return profile sharing our profiler, for code at `lineno`
+        """
+        return self.__class__(self.code_path, lineno, self.profiler)
+
+    def _run(self, func, node, mode, ns, lineno):
+        ast.increment_lineno(node, self.lineno - 1)
+        code = compile(node, self.code_path, mode)
+        if hasattr(code, 'replace'):  # Python >= 3.8
+            # Code for modules and expressions otherwise starts at line 1.
+            code = code.replace(co_firstlineno=lineno + self.lineno - 1)
+        self.profiler.enable()
+        try:
+            return func(code, ns)
+        finally:
+            self.profiler.disable()
+
+    def exec_tree(self, tree, ns):
+        """ Execute statements in module AST `tree` in namespace `ns`
+
+        Run each top-level statement as a separate code object, so each has
+        its own entry in the profile.
+        """
+        for statement in tree.body:
+            module = copy(tree)
+            module.body = [statement]
+            self._run(exec, module, 'exec', ns, statement.lineno)
+
+    def eval_expr(self, expr, ns):
+        """ Return value of expression AST `expr` in namespace `ns`
+        """
+        return self._run(eval, expr, 'eval', ns, expr.body.lineno)
+
+    def dump(self, fname):
+        """ Write profile to file `fname` in :mod:`pstats` format
+        """
+        path = dirname(fname)
+        if not isdir(path):
+            os.makedirs(path)
+        self.profiler.dump_stats(fname)
+
+
+def profile_fname(outdir, docname):
+    """ Return file name of profile for `docname` in output dir `outdir`
+    """
+    return pjoin(outdir, PROFILE_DIR, docname + '.pstats')
+
+
+def source_lines(stats, docname, code_path):
+    """ Return timings for code from `code_path` in profile `stats`
+
+    Parameters
+    ----------
+    stats : :class:`pstats.Stats` instance
+        Profile for document.
+    docname : str
+        Name of document.
+    code_path : str
+        Path of document.
+
+    Returns
+    -------
+    lines : list
+        List of dicts, one per statement or function from `code_path`, with
+        keys ``key`` (``<docname>:<line>``), ``name`` (function name, or
+        ``<module>`` for statement), ``ncalls``, ``tottime`` (seconds in the
+        statement or function itself) and ``cumtime`` (seconds including
+        functions it calls).
+    """
+    code_path = realpath(code_path)
+    lines = []
+    for (fname, line, name), (cc, nc, tt, ct, callers) in stats.stats.items():
+        if realpath(fname) != code_path:
+            continue
+        lines.append(dict(key='{}:{}'.format(docname, line),
+                          name=name,
+                          ncalls=nc,
+                          tottime=tt,
+                          cumtime=ct))
+    return lines
+
+
+def write_profile_summary(app, exception):
+    """ Write summary of profiles to output directory, show slowest lines
+
+    Called at ``build-finished`` event.
+    """
+    if exception is not None or not app.config.nbplot_profile:
+        return
+    env = app.env
+    lines = []
+    for docname in sorted(env.found_docs):
+        fname = profile_fname(app.outdir, docname)
+        if not isfile(fname):
+            continue
+        lines += source_lines(pstats.Stats(fname), docname,
+                              str(env.doc2path(docname)))
+    lines.sort(key=lambda line: line['cumtime'], reverse=True)
+    summary = ['{cumtime:10.4f} {tottime:10.4f} {ncalls:8d}  {key} '
+               '{name}'.format(**line) for line in lines]
+    with open(pjoin(app.outdir, SUMMARY_NAME), 'wt') as fobj:
+        fobj.write('{:>10} {:>10} {:>8}  {}\n'.format(
+            'cumtime', 'tottime', 'ncalls', 'location'))
+        fobj.write(''.join(line + '\n' for line in summary))
+    logger.info('nbplot profile summary written to {}'.format(SUMMARY_NAME))
+    for line in lines[:N_SLOWEST]:
+        logger.info('  {key}: {cumtime:.3f}s ({name})'.format(**line))
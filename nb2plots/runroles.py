@@ -1,9 +1,18 @@
 """ Sphinx extension to convert RST pages to notebooks """
 
+import os
 from os import makedirs
-from os.path import join as pjoin, dirname, isdir
+from os.path import join as pjoin, dirname, isdir, isfile
 from copy import deepcopy
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing.util
+import traceback
+import hashlib
+import json
+import time
+from datetime import datetime
+from tempfile import mkstemp
 
 from docutils import nodes, utils
 from docutils.parsers.rst.roles import set_classes
@@ -12,13 +21,10 @@ import sphinx
 from sphinx.util.nodes import split_explicit_title, set_role_source_info
 from sphinx.errors import ExtensionError
 
-# Use notebook format version 4
-from nbformat import v4 as nbf
-import nbconvert as nbc
-
 from . import doctree2nb, doctree2py
+from .trace import span
 from .sphinx2foos import PythonBuilder, NotebookBuilder
-from .converters import UnicodeOutput
+from .unicodeio import UnicodeOutput
 
 
 SPHINX_GE_6 = sphinx.version_info[0] >= 6
@@ -99,9 +105,9 @@ class PyRunRole(object):
         Parameters
         ----------
         queue : iterable
-            Iterable of Docutils nodes, where the nodes specify runnable
-            builds, including (for each node) the filename of original ReST
-            document.
+            Iterable of dicts with runrole node attributes (see
+            :func:`queue_runfiles`), where the dicts specify runnable builds,
+            including (for each dict) the filename of original ReST document.
         app : Sphinx Application
             Application responsible for build.
         """
@@ -120,7 +126,8 @@ class PyRunRole(object):
             Application responsible for build.
         """
         out_fname = _relfn2outpath(node['filename'], app)
-        built = self.get_built(node, app)
+        with span(node['filename'], 'runrole', code_type=self.code_type):
+            built = self.get_built(node, app)
         path = dirname(out_fname)
         if not isdir(path):
             makedirs(path)
@@ -147,8 +154,8 @@ class PyRunRole(object):
             own_params[code_type] = self._build(node, app)
         return own_params[code_type]
 
-    def _build(self, node, app):
-        """ Return string containing built / resolved version of `doctree`
+    def _resolve(self, node, app):
+        """ Return builder and resolved doctree for document of `node`
         """
         args = (app, app.env) if SPHINX_GE_6 else (app,)
         builder = self.builder_class(*args)
@@ -157,17 +164,68 @@ class PyRunRole(object):
         builder.prepare_writing([docname])
         # Set current docname for writer to work out link targets
         builder.current_docname = docname
+        return builder, doctree
+
+    def _build(self, node, app):
+        """ Return string containing built / resolved version of `doctree`
+        """
+        builder, doctree = self._resolve(node, app)
         return builder.writer.write(doctree, UnicodeOutput())
 
 
 class ClearNotebookRunRole(PyRunRole):
-    """ Role builder for not-evaluated notebook """
+    """ Role builder for not-evaluated notebook
+
+    We build and cache a notebook node, so the full notebook role can take
+    the notebook from this role without reading it back from JSON.
+    """
 
     default_text = 'Download this page as a Jupyter notebook (no outputs)'
     default_extension = '.ipynb'
     code_type = 'clearnotebook'
     builder_class = NotebookBuilder
 
+    def get_built(self, node, app):
+        """ Build, cache, return notebook JSON, or return from cache.
+
+        Parameters
+        ----------
+        node : object
+            Runrole node.
+        app : object
+            Sphinx application in charge of build
+
+        Returns
+        -------
+        output : str
+            Notebook JSON.
+        """
+        from nbformat import v4 as nbf
+        return nbf.writes(self.get_built_nb(node, app))
+
+    def get_built_nb(self, node, app):
+        """ Build, cache, return notebook node, or return from cache.
+
+        Parameters
+        ----------
+        node : object
+            Runrole node.
+        app : object
+            Sphinx application in charge of build
+
+        Returns
+        -------
+        nb : notebook
+            Notebook node.  The node is in the cache, so do not modify it.
+        """
+        return super(ClearNotebookRunRole, self).get_built(node, app)
+
+    def _build(self, node, app):
+        """ Return notebook node built from document of `node`
+        """
+        builder, doctree = self._resolve(node, app)
+        return builder.writer.to_notebook(doctree)
+
 
 def convert_timeout(argument):
     """ Allow -1, 0, positive integers and None
@@ -201,9 +259,9 @@ class FullNotebookRunRole(ClearNotebookRunRole):
         Parameters
         ----------
         queue : iterable
-            Iterable of Docutils nodes, where the nodes specify runnable
-            builds, including (for each node) the filename of original ReST
-            document.
+            Iterable of dicts with runrole node attributes (see
+            :func:`queue_runfiles`), where the dicts specify runnable builds,
+            including (for each dict) the filename of original ReST document.
         app : Sphinx Application
             Application responsible for build.
         """
@@ -218,15 +276,128 @@ class FullNotebookRunRole(ClearNotebookRunRole):
             for n in duplicates:
                 n['timeout'] = max_timeout
 
+        errors = {}
+        jobs = app.config.fill_notebook_jobs
+        if jobs > 1:
+            errors = self._fill_queue(queue, app, jobs)
+        elif app.config.fill_notebook_kernel_pool:
+            init_kernel_pool(app.config.fill_notebook_kernel_uses,
+                             app.config.fill_notebook_kernel_memory)
+        try:
+            for node in queue:
+                if node['refdoc'] not in errors:
+                    self.write(node, app)
+        finally:
+            shutdown_kernel_pool()
+        if errors:
+            raise RunRoleError('\n'.join(
+                'Error filling notebook for {0}:\n{1}'.format(docname, error)
+                for docname, error in sorted(errors.items())))
+
+    def _fill_queue(self, queue, app, jobs):
+        """ Fill notebooks for `queue` in `jobs` worker processes
+
+        Store the filled notebooks in the runrole cache, for ``write`` to use.
+
+        Parameters
+        ----------
+        queue : iterable
+            Iterable of dicts with runrole node attributes, where the dicts
+            specify runnable builds.
+        app : Sphinx Application
+            Application responsible for build.
+        jobs : int
+            Maximum number of notebooks to fill at the same time.
+
+        Returns
+        -------
+        errors : dict
+            Dict with key, value pairs of document name, error message, for
+            documents where filling the notebook failed.
+        """
+        cache = app.env.runrole_cache
+        to_fill = {}
         for node in queue:
-            self.write(node, app)
+            docname = node['refdoc']
+            if (docname in to_fill or
+                cache[docname].get(self.code_type) is not None):
+                continue
+            nb, full_nb = self._prefilled(node, app)
+            if full_nb is not None:
+                cache[docname][self.code_type] = full_nb
+                continue
+            to_fill[docname] = (nb, self._get_timeout(node, app))
+        nb_cache = get_notebook_cache(app)
+        errors = {}
+        if len(to_fill) == 0:
+            return errors
+        pool_kwargs = {}
+        if app.config.fill_notebook_kernel_pool:
+            pool_kwargs = dict(
+                initializer=_init_worker_kernel_pool,
+                initargs=(app.config.fill_notebook_kernel_uses,
+                          app.config.fill_notebook_kernel_memory))
+        with ProcessPoolExecutor(min(jobs, len(to_fill)),
+                                 **pool_kwargs) as executor:
+            futures = {docname: executor.submit(_fill_notebook_job, *args)
+                       for docname, args in to_fill.items()}
+            for docname in sorted(futures):
+                full_nb, error, wall = futures[docname].result()
+                if error is not None:
+                    errors[docname] = error
+                    continue
+                self._record_timing(docname, full_nb, wall, app)
+                if nb_cache is not None:
+                    nb_cache.put(notebook_cache_key(*to_fill[docname]),
+                                 full_nb)
+                cache[docname][self.code_type] = full_nb
+        return errors
+
+    def _get_timeout(self, node, app):
+        return node.get('timeout', app.config.fill_notebook_timeout)
+
+    def _prefilled(self, node, app):
+        """ Return clear notebook, and notebook filled without running kernel
+
+        We fill the notebook from nbplot captures, or from the notebook cache.
+        The filled notebook is None if we cannot fill the notebook from
+        either.
+        """
+        nb = self.clear_role.get_built_nb(node, app)
+        full_nb = None
+        if getattr(app.config, 'nbplot_capture', False):
+            # Use outputs from nbplot directives, if possible.
+            captures = app.env.nbplot_captures.get(node['refdoc'], [])
+            full_nb = fill_notebook_from_captures(nb, captures)
+        nb_cache = get_notebook_cache(app)
+        if full_nb is None and nb_cache is not None:
+            full_nb = nb_cache.get(
+                notebook_cache_key(nb, self._get_timeout(node, app)), nb)
+        return nb, full_nb
+
+    def _record_timing(self, docname, full_nb, wall, app):
+        """ Record time to fill notebook, if ``nbplot_timing`` is True
+        """
+        if getattr(app.config, 'nbplot_timing', False):
+            app.env.runrole_timings[docname] = dict(
+                wall=wall, cells=cell_times(full_nb))
 
-    def _build(self, node, env):
-        """ Return byte string containing built version of `doctree` """
-        empty_json = self.clear_role.get_built(node, env)
-        timeout = node.get('timeout', env.config.fill_notebook_timeout)
-        full_nb = fill_notebook(nbf.reads(empty_json), timeout=timeout)
-        return nbf.writes(full_nb)
+    def _build(self, node, app):
+        """ Return notebook node, filled with outputs, for document of `node`
+        """
+        nb, full_nb = self._prefilled(node, app)
+        if full_nb is None:
+            timeout = self._get_timeout(node, app)
+            start = time.perf_counter()
+            full_nb = fill_notebook(nb,
+                                    timeout=timeout,
+                                    kernel_pool=_kernel_pool)
+            self._record_timing(node['refdoc'], full_nb,
+                                time.perf_counter() - start, app)
+            nb_cache = get_notebook_cache(app)
+            if nb_cache is not None:
+                nb_cache.put(notebook_cache_key(nb, timeout), full_nb)
+        return full_nb
 
 
 # Collect instances of the known role types
@@ -238,44 +409,70 @@ NAME2ROLE = dict(pyfile=PyRunRole(),
 
 
 def do_builder_init(app):
-    """ Initialize builder with empty runrole caches and queues.
+    """ Initialize builder with empty runrole caches
+
+    The queues of runrole builds stay in the environment, with the documents
+    that we do not read again in this build.
     """
     env = app.env
-    env.runrole_queue = defaultdict(list)
+    if not hasattr(env, 'runrole_queue'):
+        env.runrole_queue = defaultdict(list)
+    env.runrole_written = set()
     env.runrole_cache = defaultdict(dict)
+    env.runrole_timings = {}
 
 
 def do_purge_doc(app, env, docname):
     """ Clear caches and queues of runrole builds from this `docname`.
     """
     env.runrole_cache.pop(docname, None)
+    # Sphinx >= 7.3 keeps pickled doctrees from earlier builds with the same
+    # application, and does not drop them when re-reading the document.  We
+    # build runroles from these doctrees.
+    getattr(env, '_pickled_doctree_cache', {}).pop(docname, None)
     queues = env.runrole_queue
     for code_type in queues:
         queues[code_type] = [node for node in queues[code_type]
                              if node['refdoc'] != docname]
 
 
-def collect_runfiles(app, doctree, fromdocname):
-    r""" Collate requested runnable files, store in env
+def do_merge_info(app, env, docnames, other):
+    """ Merge caches and queues of runrole builds from parallel read
 
-    Traverse doctree, find runrole nodes, and collect the nodes that need to be
-    built.  Store references to the nodes in the ``env.runroles_queue``
-    dictionary, The dictionary has keys giving runrole type (string, one
-    of 'pyfile', 'clearnotebook', 'fullnotebook') and values that are lists
-    of nodes to be built into runnable outputs.
+    The process reading `docnames` queued the runrole builds for these
+    documents in `other`.
+    """
+    for docname in docnames:
+        if docname in other.runrole_cache:
+            env.runrole_cache[docname] = other.runrole_cache[docname]
+    for code_type, queue in other.runrole_queue.items():
+        env.runrole_queue[code_type] += [node for node in queue
+                                         if node['refdoc'] in docnames]
 
-    Set filename of file to be built into node.
 
-    Called at ``doctree-resolved`` event.
+def queue_runfiles(app, doctree):
+    r""" Collate requested runnable files, store in env
+
+    Traverse doctree, find runrole nodes, and collect the nodes that need to be
+    built.  Store copies of the node attributes in the ``env.runrole_queue``
+    dictionary. The dictionary has keys giving runrole type (string, one of
+    'pyfile', 'clearnotebook', 'fullnotebook') and values that are lists of
+    dicts, with the attributes of nodes to be built into runnable outputs.
+    We store attributes rather than nodes, because the nodes refer to their
+    document, and we pickle the queue with the environment.
+
+    Set filename of file to be built into the attributes.
+
+    Called at ``doctree-read`` event, so the process reading the document
+    fills the queue, and :func:`do_merge_info` merges queues from parallel
+    reads.
     """
     env = app.env
     queues = env.runrole_queue
     files = {}
 
     for ref in doctree.traverse(runrole_reference):
-        # Calculate filename of file to be built, relative to project root
-        rel_fn, _ = env.relfn2path(ref['reftarget'], ref['refdoc'])
-        ref['filename'] = rel_fn
+        rel_fn = _runrole_filename(ref, env)
         # Check for duplicates.  It's OK to reference a file that is already
         # registered for building, but it must be of the same code type.
         code_type = ref['reftype']
@@ -290,7 +487,29 @@ def collect_runfiles(app, doctree, fromdocname):
                     files[rel_fn]))
         # The queue can have duplicate combinations of (docname, code_type,
         # rel_fn).
-        queues[code_type].append(ref)
+        queues[code_type].append(dict(ref.attributes, filename=rel_fn))
+
+
+def _runrole_filename(ref, env):
+    """ Filename of file to be built for `ref`, relative to project root
+    """
+    return env.relfn2path(ref['reftarget'], ref['refdoc'])[0]
+
+
+def collect_runfiles(app, doctree, fromdocname):
+    """ Set runrole filenames, record documents of runroles being written
+
+    Set filename of file to be built into runrole nodes, for the link.
+    :func:`write_runfiles` builds the queued runnable files for the
+    documents with runroles written in this build.  The doctree may contain
+    the documents that `fromdocname` includes, as for the LaTeX builder.
+
+    Called at ``doctree-resolved`` event.
+    """
+    env = app.env
+    for ref in doctree.traverse(runrole_reference):
+        ref['filename'] = _runrole_filename(ref, env)
+        env.runrole_written.add(ref['refdoc'])
 
 
 def _relfn2outpath(rel_path, app):
@@ -300,19 +519,29 @@ def _relfn2outpath(rel_path, app):
 def write_runfiles(app, exception):
     """ Write notebooks / code files when build has finished
 
-    :func:`collect_runfiles` has already collected the files that need to be
-    built, and stored then in the ``env.runroles`` dictionary.  See the
+    :func:`queue_runfiles` has already collected the files that need to be
+    built, and stored them in the ``env.runrole_queue`` dictionary.  See the
     docstring for that function for details.
 
-    We cycle through these collected relative filenames, and build the
-    necessary files using the ``write`` method of the stored role instances.
+    We cycle through the collected files for the documents written in this
+    build, and build the files using the ``write`` method of the stored role
+    instances.
 
     Called at ``build-finished`` event.
     """
-    if exception is not None:
-        return
-    for code_type, queue in app.env.runrole_queue.items():
-        NAME2ROLE[code_type].write_queue(queue, app)
+    env = app.env
+    written = env.runrole_written
+    try:
+        if exception is not None:
+            return
+        for code_type, queue in env.runrole_queue.items():
+            queue = [node for node in queue if node['refdoc'] in written]
+            with span(code_type, 'runrole', n_files=len(queue)):
+                NAME2ROLE[code_type].write_queue(queue, app)
+    finally:
+        # Start afresh for next build with this application.  Building the
+        # runfiles resolves doctrees, and so adds to the written documents.
+        env.runrole_written = set()
 
 
 def visit_runrole(self, node):
@@ -326,19 +555,295 @@ def depart_runrole(self, node):
     self.body.append(self.context.pop())
 
 
-def fill_notebook(nb, timeout=30):
+def fill_notebook(nb, timeout=30, kernel_pool=None):
     """ Execute notebook `nb` and return notebook with built outputs
+
+    Parameters
+    ----------
+    nb : notebook
+        Notebook to execute.
+    timeout : None or int, optional
+        Timeout for each cell, in seconds.
+    kernel_pool : None or :class:`KernelPool`, optional
+        If not None, execute notebook in a kernel from this pool, rather than
+        in a new kernel.
+
+    Returns
+    -------
+    output_nb : notebook
+        Notebook with built outputs.
     """
+    if kernel_pool is not None:
+        return kernel_pool.fill(nb, timeout)
+    import nbconvert as nbc
     preprocessor = nbc.preprocessors.execute.ExecutePreprocessor(
         timeout=timeout)
     preprocessor.enabled = True
     RD = nbc.exporters.exporter.ResourcesDict
     res = RD()
     res['metadata'] = RD()
-    output_nb, _ = preprocessor(deepcopy(nb), res)
+    with span('fill notebook', 'kernel'):
+        output_nb, _ = preprocessor(deepcopy(nb), res)
     return output_nb
 
 
+def _fill_notebook_job(nb, timeout):
+    """ Fill notebook `nb` in worker process
+
+    Return filled notebook, error message and wall time in seconds.  Return
+    the error message as a string, rather than raising the error, because we
+    may not be able to pickle the error to pass it back from the worker
+    process.
+    """
+    start = time.perf_counter()
+    try:
+        full_nb = fill_notebook(nb, timeout, _kernel_pool)
+    except Exception:
+        return None, traceback.format_exc(), time.perf_counter() - start
+    return full_nb, None, time.perf_counter() - start
+
+
+def _parse_timestamp(timestamp):
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
+
+def cell_times(nb):
+    """ Return execution times in seconds for code cells of filled `nb`
+
+    Use the timestamps that nbclient records in the cell metadata.  Times are
+    None for cells without timestamps.
+    """
+    times = []
+    for cell in nb.cells:
+        if cell.cell_type != 'code':
+            continue
+        execution = cell.metadata.get('execution', {})
+        try:
+            start = _parse_timestamp(execution['iopub.execute_input'])
+            end = _parse_timestamp(execution['shell.execute_reply'])
+        except (KeyError, ValueError):
+            times.append(None)
+            continue
+        times.append((end - start).total_seconds())
+    return times
+
+
+# Kernels to reuse for filling notebooks in this process, or None.
+_kernel_pool = None
+
+
+def init_kernel_pool(max_uses, max_memory):
+    """ Set up pool of kernels to reuse for filling notebooks in this process
+
+    Parameters
+    ----------
+    max_uses : int
+        Replace a kernel after it has filled this many notebooks.
+    max_memory : None or float
+        If not None, replace a kernel when its process uses more than this
+        many megabytes of memory after the reset that follows each notebook.
+    """
+    global _kernel_pool
+    from .kernelpool import KernelPool
+    _kernel_pool = KernelPool(1, max_uses, max_memory)
+
+
+def shutdown_kernel_pool():
+    """ Shut down kernels in pool for this process, if any
+    """
+    global _kernel_pool
+    if _kernel_pool is not None:
+        _kernel_pool.shutdown()
+    _kernel_pool = None
+
+
+def _init_worker_kernel_pool(max_uses, max_memory):
+    """ Start kernel in worker process, shut it down when worker exits
+    """
+    init_kernel_pool(max_uses, max_memory)
+    _kernel_pool.start()
+    # Worker processes do not run ``atexit`` functions.
+    multiprocessing.util.Finalize(None, shutdown_kernel_pool, exitpriority=10)
+
+
+def notebook_cache_key(nb, timeout):
+    """ Return notebook cache key for filling notebook `nb` with `timeout`
+
+    The key covers the kernel spec, the timeout, and the code cells in order,
+    but not the Markdown cells.
+    """
+    sha = hashlib.sha256()
+    strs = [json.dumps(nb.metadata.get('kernelspec', {}), sort_keys=True),
+            repr(timeout)]
+    strs += [cell.source for cell in nb.cells if cell.cell_type == 'code']
+    for s in strs:
+        sha.update(s.encode('utf-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def splice_outputs(nb, full_nb):
+    """ Return copy of `nb` with code cell outputs from `full_nb`
+
+    Parameters
+    ----------
+    nb : notebook
+        Notebook without outputs.
+    full_nb : notebook
+        Notebook with outputs, with the same code cells as `nb`, but maybe
+        different Markdown cells.
+
+    Returns
+    -------
+    spliced_nb : notebook
+        Copy of `nb` with outputs and execution counts of code cells from
+        `full_nb`.
+    """
+    spliced_nb = deepcopy(nb)
+    code_cells = [cell for cell in spliced_nb.cells
+                  if cell.cell_type == 'code']
+    full_cells = [cell for cell in full_nb.cells if cell.cell_type == 'code']
+    for cell, full_cell in zip(code_cells, full_cells):
+        cell.outputs = full_cell.outputs
+        cell.execution_count = full_cell.execution_count
+    if 'language_info' in full_nb.metadata:
+        spliced_nb.metadata['language_info'] = full_nb.metadata.language_info
+    return spliced_nb
+
+
+class NotebookCache(object):
+    """ On-disk store of notebooks filled by running them in a kernel
+
+    Each cache entry is a notebook file, named for its key.  See
+    :func:`notebook_cache_key`.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _entry_fname(self, key):
+        return pjoin(self.cache_dir, key[:2], key + '.ipynb')
+
+    def get(self, key, nb):
+        """ Return `nb` with outputs from entry for `key`, or None if no entry
+        """
+        from nbformat import v4 as nbf
+        fname = self._entry_fname(key)
+        if not isfile(fname):
+            return None
+        with open(fname, 'rt', encoding='utf-8') as fobj:
+            full_nb = nbf.reads(fobj.read())
+        return splice_outputs(nb, full_nb)
+
+    def put(self, key, full_nb):
+        """ Store filled notebook `full_nb` in cache under `key`
+        """
+        from nbformat import v4 as nbf
+        fname = self._entry_fname(key)
+        path = dirname(fname)
+        if not isdir(path):
+            makedirs(path, exist_ok=True)
+        # Write to temporary file and rename, for parallel builds.
+        fd, tmp_fname = mkstemp(dir=path)
+        with os.fdopen(fd, 'wt', encoding='utf-8') as fobj:
+            fobj.write(nbf.writes(full_nb))
+        os.replace(tmp_fname, fname)
+
+
+def get_notebook_cache(app):
+    """ Return :class:`NotebookCache` for `app`, or None if cache disabled
+    """
+    config = app.config
+    if not config.fill_notebook_cache:
+        return None
+    cache_dir = config.fill_notebook_cache_dir
+    if cache_dir is None:
+        cache_dir = pjoin(dirname(app.doctreedir), 'fill_notebook_cache')
+    return NotebookCache(pjoin(app.confdir, cache_dir))
+
+
+def _cell_source(code):
+    """ Return code cell source for nbplot `code`, stripped of end whitespace
+    """
+    if doctree2py.parse_doctest(code):
+        code = doctree2py.parse_doctest(code)
+    return '\n'.join(line.rstrip() for line in code.strip().splitlines())
+
+
+def capture_outputs(capture, execution_count):
+    """ Return notebook outputs from nbplot `capture`
+
+    Parameters
+    ----------
+    capture : dict
+        Dict with captured ``stdout``, ``result`` and ``figures``, as recorded
+        by the nbplot directive.
+    execution_count : int
+        Execution count for any execution result.
+
+    Returns
+    -------
+    outputs : list
+        List of notebook outputs.
+    """
+    from nbformat import v4 as nbf
+    outputs = []
+    if capture['stdout']:
+        outputs.append(nbf.new_output('stream',
+                                      name='stdout',
+                                      text=capture['stdout']))
+    if capture['result'] is not None:
+        outputs.append(nbf.new_output('execute_result',
+                                      data=capture['result'],
+                                      execution_count=execution_count))
+    for figure in capture['figures']:
+        outputs.append(nbf.new_output('display_data', data=figure))
+    return outputs
+
+
+def fill_notebook_from_captures(nb, captures):
+    """ Return notebook `nb` with outputs from nbplot `captures`, or None
+
+    Parameters
+    ----------
+    nb : notebook
+        Notebook without outputs.
+    captures : list
+        List of dicts, one per nbplot directive in document, in order, with
+        keys ``code`` (code shown by directive) and ``capture`` (captured
+        outputs, or None if outputs not usable).
+
+    Returns
+    -------
+    full_nb : None or notebook
+        Copy of `nb` with outputs, or None if there is a code cell for which
+        we have no captured outputs, or with a result that only a kernel can
+        display.
+    """
+    full_nb = deepcopy(nb)
+    captures = list(captures)
+    execution_count = 0
+    for cell in full_nb.cells:
+        if cell.cell_type != 'code':
+            continue
+        execution_count += 1
+        cell.execution_count = execution_count
+        source = _cell_source(cell.source)
+        if source == '%matplotlib inline':
+            continue
+        # Skip over nbplot directives not shown in notebook.
+        while captures and _cell_source(captures[0]['code']) != source:
+            captures.pop(0)
+        if len(captures) == 0 or captures[0]['capture'] is None:
+            return None
+        if not captures[0]['capture'].get('complete'):
+            # Kernel has to display the result.
+            return None
+        cell.outputs = capture_outputs(captures.pop(0)['capture'],
+                                       execution_count)
+    return full_nb
+
+
 def drop_visit(self, node):
     raise nodes.SkipNode
 
@@ -351,7 +856,11 @@ def setup(app):
     app.connect(str('builder-inited'), do_builder_init)
     # Delete caches when document re-initialized
     app.connect('env-purge-doc', do_purge_doc)
-    # Collect and check all runrole nodes when doctree done
+    # Collect caches and queues from parallel reads
+    app.connect('env-merge-info', do_merge_info)
+    # Collect and check all runrole nodes when document read
+    app.connect('doctree-read', queue_runfiles)
+    # Record documents written in this build
     app.connect('doctree-resolved', collect_runfiles)
     # Write output files at end of build
     app.connect('build-finished', write_runfiles)
@@ -366,3 +875,5 @@ def setup(app):
     app.set_translator('markdown', doctree2py.Translator)
     app.set_translator('pyfile', doctree2py.Translator)
     app.set_translator('ipynb', doctree2nb.Translator)
+    return {'parallel_read_safe': True,
+            'parallel_write_safe': True}
@@ -0,0 +1,360 @@
+""" Server keeping warm converters for fast conversions from ReST
+
+Each run of a ``sphinx2*`` script starts Python, imports Sphinx and its
+extensions, and makes a new Sphinx application.  This takes much longer than
+the conversion itself, for short pages.  The ``nb2plots-server`` script starts
+a server that listens on a Unix socket, and converts ReST with warm converters
+(see :class:`nb2plots.converters.WarmConverter`), one for each builder, in
+each of its worker processes.  Give the ``sphinx2*`` scripts the ``--server``
+option to send their conversions to the server.  The scripts fall back to
+converting in their own process if the server is not running.
+
+The socket is at the path in the ``NB2PLOTS_SOCKET`` environment variable or,
+by default, at ``nb2plots.sock`` in the ``XDG_RUNTIME_DIR`` directory, if that
+environment variable is set, or at ``nb2plots-<uid>/server.sock`` in the
+temporary directory.  The server makes the ``nb2plots-<uid>`` directory, and
+refuses to start if another user owns the directory, or other users can access
+it.  Only the user who started the server can connect to it, and the clients
+refuse to send requests to a socket that another user owns.  Clients give up
+on a conversion that takes longer than `CONVERT_TIMEOUT` seconds, and the
+scripts then convert in their own process.
+
+Requests and replies are JSON dicts.  A client sends a request, then shuts
+down its side of the connection.  The server sends back the reply, and closes
+the connection.  Requests have keys:
+
+* ``rst``: ReST text to convert;
+* ``builder``: name of builder for output format;
+* ``warningiserror``: (optional) if True, fail on warning in the build.
+
+The reply has key ``output``, with the converted text, or ``error``, with the
+error message from a failed conversion.  A request ``{"command": "ping"}``
+gets the reply ``{"ping": "pong"}``.
+
+This module only uses the standard library at import, so the scripts can
+import it quickly to talk to the server.
+"""
+
+import os
+from os.path import join as pjoin, exists, dirname
+import stat
+import sys
+import json
+import socket
+import traceback
+from tempfile import gettempdir
+
+# Environment variable giving server socket path.
+SOCKET_VAR = 'NB2PLOTS_SOCKET'
+
+# Builders for which each worker makes a converter at start-up.
+WARM_BUILDERS = ('markdown', 'python', 'jupyter', 'pseudoxml')
+
+# Receive data in chunks of this many bytes.
+CHUNK_SIZE = 2 ** 16
+
+# Seconds to wait for server to reply to conversion request.
+CONVERT_TIMEOUT = 300
+
+
+class ServerError(RuntimeError):
+    """ Error from conversion in server """
+
+
+def default_socket_path():
+    """ Return path of server socket from environment, or default path
+
+    See the module docstring for the default path.
+    """
+    path = os.environ.get(SOCKET_VAR)
+    if path:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return pjoin(runtime_dir, 'nb2plots.sock')
+    uid = os.getuid() if hasattr(os, 'getuid') else 0
+    return pjoin(gettempdir(), 'nb2plots-{}'.format(uid), 'server.sock')
+
+
+def _private_dir(path):
+    """ Make directory `path`, if needed; check only this user can access it
+
+    Raises
+    ------
+    PermissionError
+        If `path` is not a directory, another user owns it, or other users
+        can access it.
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or
+        st.st_uid != os.getuid() or
+        st.st_mode & 0o077):
+        raise PermissionError(
+            'Directory {} for server socket must belong to this user, and '
+            'other users must not have access'.format(path))
+
+
+def _check_owner(socket_path):
+    """ Raise PermissionError if another user owns `socket_path`
+
+    Another user could make a socket at the path we expect, to receive our
+    requests.
+    """
+    if hasattr(os, 'getuid') and os.stat(socket_path).st_uid != os.getuid():
+        raise PermissionError(
+            'Server socket {} belongs to another user'.format(socket_path))
+
+
+def _recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(CHUNK_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def request(req, socket_path=None, timeout=None):
+    """ Send request dict `req` to server, return reply dict
+
+    Parameters
+    ----------
+    req : dict
+        Request.  See module docstring.
+    socket_path : None or str, optional
+        Path of server socket.  If None, use :func:`default_socket_path`.
+    timeout : None or float, optional
+        Timeout in seconds for connecting, sending and receiving.  None means
+        no timeout.
+
+    Returns
+    -------
+    reply : dict
+        Reply from server.
+
+    Raises
+    ------
+    OSError
+        If we cannot connect to the server, including on platforms without
+        Unix sockets, if another user owns the socket, or if the server does
+        not reply within `timeout`.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        raise OSError('Platform does not have Unix sockets')
+    socket_path = default_socket_path() if socket_path is None else socket_path
+    _check_owner(socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(req).encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        data = _recv_all(sock)
+    if not data:
+        raise ConnectionError('Server closed connection without reply')
+    return json.loads(data.decode('utf-8'))
+
+
+def server_running(socket_path=None):
+    """ True if server is running at `socket_path`
+
+    See :func:`request` for `socket_path`.
+    """
+    try:
+        reply = request(dict(command='ping'), socket_path, timeout=5)
+    except (OSError, ValueError):
+        return False
+    return reply.get('ping') == 'pong'
+
+
+def convert(rst_text, buildername, warningiserror=False, socket_path=None,
+            timeout=CONVERT_TIMEOUT):
+    """ Return output from converting `rst_text` with server
+
+    Parameters
+    ----------
+    rst_text : str
+        ReST text to convert.
+    buildername : str
+        Name of builder for output format.
+    warningiserror : {False, True}, optional
+        If True, fail on warning in the build.
+    socket_path : None or str, optional
+        Path of server socket.  If None, use :func:`default_socket_path`.
+    timeout : None or float, optional
+        Timeout in seconds for connecting, sending and waiting for the reply.
+        None means no timeout.
+
+    Returns
+    -------
+    output : str
+        Converted text.
+
+    Raises
+    ------
+    OSError
+        If we cannot connect to the server, or the server does not reply in
+        time.
+    ServerError
+        If the conversion failed in the server.
+    """
+    reply = request(dict(rst=rst_text,
+                         builder=buildername,
+                         warningiserror=warningiserror),
+                    socket_path,
+                    timeout)
+    if 'error' in reply:
+        raise ServerError(reply['error'])
+    return reply['output']
+
+
+# Warm converters in worker process, keyed by (builder name, warningiserror).
+_converters = {}
+
+
+def _close_converters():
+    while _converters:
+        _converters.popitem()[1].close()
+
+
+def _get_converter(buildername, warningiserror):
+    from .converters import WarmNbConverter
+    key = (buildername, warningiserror)
+    if key not in _converters:
+        _converters[key] = WarmNbConverter(buildername,
+                                           status=None,
+                                           warningiserror=warningiserror)
+    return _converters[key]
+
+
+def init_worker(buildernames):
+    """ Make and warm up converters for `buildernames` in this process
+    """
+    import multiprocessing.util
+    # Remove Sphinx application temporary directories at process exit.
+    multiprocessing.util.Finalize(None, _close_converters, exitpriority=10)
+    for buildername in buildernames:
+        _get_converter(buildername, False).from_rst('Warm up\n')
+
+
+def convert_in_worker(rst_text, buildername, warningiserror):
+    """ Return reply dict from converting `rst_text` in worker process
+    """
+    try:
+        output = _get_converter(buildername,
+                                warningiserror).from_rst(rst_text)
+    except Exception:
+        return dict(error=traceback.format_exc())
+    return dict(output=output)
+
+
+def _no_op():
+    return None
+
+
+def _reply_for(req, executor):
+    if req.get('command') == 'ping':
+        return dict(ping='pong')
+    if 'rst' not in req or 'builder' not in req:
+        return dict(error='Request needs "rst" and "builder"')
+    return executor.submit(convert_in_worker,
+                           req['rst'],
+                           req['builder'],
+                           bool(req.get('warningiserror', False))).result()
+
+
+def make_server(socket_path=None, jobs=1, buildernames=WARM_BUILDERS):
+    """ Return server listening on `socket_path`, ready to serve
+
+    The server handles each connection in a thread, and runs the conversions
+    in a pool of `jobs` worker processes.  Sphinx applications are not thread
+    safe, so each worker runs one conversion at a time.  Call the
+    ``serve_forever`` method of the returned server to serve requests, and the
+    ``server_close`` method to close the server and its workers.
+
+    Parameters
+    ----------
+    socket_path : None or str, optional
+        Path of server socket.  If None, use :func:`default_socket_path`, and
+        make its directory if needed (see the module docstring).
+    jobs : int, optional
+        Number of worker processes.
+    buildernames : sequence, optional
+        Names of builders for which each worker makes a warm converter at
+        start-up.  Workers make converters for other builders on first use.
+
+    Returns
+    -------
+    server : :class:`socketserver.ThreadingUnixStreamServer` instance
+        Server.
+    """
+    import socketserver
+    from concurrent.futures import ProcessPoolExecutor
+    if socket_path is None:
+        socket_path = default_socket_path()
+        if not os.environ.get(SOCKET_VAR):
+            _private_dir(dirname(socket_path))
+    if exists(socket_path):
+        if server_running(socket_path):
+            raise RuntimeError('Server already running at ' + socket_path)
+        os.unlink(socket_path)
+    executor = ProcessPoolExecutor(jobs,
+                                   initializer=init_worker,
+                                   initargs=(tuple(buildernames),))
+    # Start workers before starting any threads.
+    executor.submit(_no_op).result()
+
+    class Handler(socketserver.BaseRequestHandler):
+
+        def handle(self):
+            try:
+                req = json.loads(_recv_all(self.request).decode('utf-8'))
+                reply = _reply_for(req, executor)
+            except Exception:
+                reply = dict(error=traceback.format_exc())
+            self.request.sendall(json.dumps(reply).encode('utf-8'))
+
+    class Server(socketserver.ThreadingUnixStreamServer):
+
+        daemon_threads = True
+
+        def server_close(self):
+            super().server_close()
+            executor.shutdown()
+            if exists(socket_path):
+                os.unlink(socket_path)
+
+    # Only allow connections from this user.
+    old_umask = os.umask(0o177)
+    try:
+        server = Server(socket_path, Handler)
+    except BaseException:
+        executor.shutdown()
+        raise
+    finally:
+        os.umask(old_umask)
+    return server
+
+
+def serve(socket_path=None, jobs=1, buildernames=WARM_BUILDERS):
+    """ Serve conversions until interrupted
+
+    See :func:`make_server` for parameters.
+    """
+    import signal
+    server = make_server(socket_path, jobs, buildernames)
+    # Stop cleanly on SIGTERM as well as on keyboard interrupt.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    sys.stderr.write('nb2plots server listening on {}\n'.format(
+        server.server_address))
+    sys.stderr.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
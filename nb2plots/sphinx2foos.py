@@ -15,6 +15,8 @@ class MarkdownBuilder(TextBuilder):
     format = 'markdown'
     out_suffix = '.md'
     writer_class = doctree2md.Writer
+    # Image formats from nbplot directives used by builder (none).
+    nbplot_formats = ()
 
     def __init__(self, app, env=None):
         """ Initialize Markdown (and friends) builder
@@ -55,3 +57,5 @@ def setup(app):
     app.add_builder(NotebookBuilder)
     # Base URL for Markdown link conversion
     app.add_config_value('markdown_http_base', None, True)
+    return {'parallel_read_safe': True,
+            'parallel_write_safe': True}
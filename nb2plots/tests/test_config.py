@@ -18,10 +18,34 @@ def test_nbplots_setup():
                     'nbplot_rcparams',
                     'nbplot_working_directory',
                     'nbplot_template',
-                    'nbplot_flags']
+                    'nbplot_flags',
+                    'nbplot_cache',
+                    'nbplot_cache_dir',
+                    'nbplot_jobs',
+                    'nbplot_fork_workers',
+                    'nbplot_execute_unrendered',
+                    'nbplot_render_for',
+                    'nbplot_capture',
+                    'nbplot_timing',
+                    'nbplot_trace',
+                    'nbplot_memory',
+                    'nbplot_memory_budget',
+                    'nbplot_profile']
     connects = [
         ('builder-inited', nbp.do_builder_init),
         ('env-purge-doc', nbp.do_purge_doc),
+        ('env-get-outdated', nbp.do_get_outdated),
+        ('env-merge-info', nbp.do_merge_info),
+        ('env-before-read-docs', nbp.do_prerun),
+        ('env-updated', nbp.do_copy_images),
+        ('doctree-read', nbp.do_release_context),
+        ('build-finished', nbp.write_timing_report),
+        ('build-finished', nbp.write_memory_report),
+        ('build-finished', nbp.write_profile_summary),
+        ('builder-inited', nbp.start_trace),
+        ('source-read', nbp.trace_read_start),
+        ('doctree-read', nbp.trace_read_end),
+        ('build-finished', nbp.write_trace),
     ]
     for method_name, args, kwargs in app.method_calls:
         if (method_name == 'add_config_value' and
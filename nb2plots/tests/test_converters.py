@@ -2,8 +2,12 @@
 """
 
 import re
+from os.path import isdir
 
-from nb2plots.converters import Converter
+import pytest
+
+from nb2plots.converters import (Converter, WarmConverter, NbConverter,
+                                 WarmNbConverter, to_py)
 from nb2plots.testing import OPT_TRANS
 
 NEW_PAGE = u"""
@@ -34,3 +38,111 @@ More compelling text"""
         <paragraph>
             More compelling text
 """, pxml) is not None
+
+
+OTHER_PAGE = u"""
+Other title
++++++++++++
+
+Other text
+"""
+
+
+def test_warm_converter():
+    # Warm converter reuses app across conversions
+    with WarmConverter() as conv:
+        assert conv.from_rst(NEW_PAGE).strip() == """\
+More fancy title
+****************
+
+More compelling text"""
+        app = conv._app
+        tmp_dir = app.tmp_dir
+        assert isdir(tmp_dir)
+        assert conv.from_rst(OTHER_PAGE).strip() == """\
+Other title
+***********
+
+Other text"""
+        assert conv._app is app
+        # Same content as a previous conversion
+        assert 'More fancy' in conv.from_rst(NEW_PAGE)
+    assert conv._app is None
+    assert not isdir(tmp_dir)
+
+
+def test_warm_nb_converter():
+    # Extensions keep no state between conversions
+    with WarmNbConverter('python') as conv:
+        assert conv.from_rst(u"""
+Title
++++++
+
+.. nbplot::
+
+    >>> a = 1
+""") == u"""# ## Title
+
+a = 1
+"""
+        assert conv.from_rst(u"""
+Title
++++++
+
+.. nbplot::
+
+    >>> 'a' in globals()
+    False
+
+Text
+""") == u"""# ## Title
+
+'a' in globals()
+
+# Text
+"""
+
+
+def test_warm_converter_error():
+    # Converter throws away app after error
+    conv = WarmConverter()
+    conv.from_rst(NEW_PAGE)
+    with pytest.raises(Exception):
+        conv.from_rst(u".. unknown-directive::\n")
+    assert conv._app is None
+    assert 'Other text' in conv.from_rst(OTHER_PAGE)
+    conv.close()
+
+
+def test_from_rst_many():
+    conv = Converter('pseudoxml')
+    texts = {'new': NEW_PAGE, 'other': OTHER_PAGE}
+    outputs = conv.from_rst_many(texts)
+    assert sorted(outputs) == ['new', 'other']
+    for key, text in texts.items():
+        # Output same as single conversion, apart from document name.
+        single = conv.from_rst(text)
+        assert (outputs[key].splitlines()[1:] ==
+                single.splitlines()[1:])
+    assert conv.from_rst_many({}) == {}
+
+
+def test_nb_from_rst_many():
+    # Build documents in parallel, each with own nbplot namespace
+    page = u"""
+Title {0}
++++++++++
+
+.. nbplot::
+
+    >>> assert 'a' not in globals()
+    >>> a = {0}
+"""
+    texts = {i: page.format(i) for i in range(8)}
+    expected = {i: to_py.from_rst(text) for i, text in texts.items()}
+    assert NbConverter('python').from_rst_many(texts, jobs=2) == expected
+    # Extensions all parallel safe
+    conv = Converter('python',
+                     conf_txt='master_doc = "contents"\n'
+                     'extensions = ["nb2plots"]\n')
+    assert conv.from_rst_many(texts, jobs=2) == expected
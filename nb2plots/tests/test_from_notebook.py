@@ -2,13 +2,18 @@
 """
 
 from os.path import dirname, join as pjoin
+import tracemalloc
 
 import nbformat
 
+from nb2plots import from_notebook
 from nb2plots.from_notebook import (convert_nb, convert_nb_fname, to_doctests,
-                                    has_mpl_inline, CODE_WITH_OUTPUT)
+                                    has_mpl_inline, make_exporter, iter_rst,
+                                    read_nb, SKIP_TYPES)
 from nb2plots.testing import stripeq
 
+import pytest
+
 
 DATA_PATH = pjoin(dirname(__file__), 'data')
 
@@ -131,57 +136,248 @@ def test_small():
         assert stripeq(out, fobj.read())
 
 
-code = \
-"""##CODE_START##
-a = 1
-b = 2
-##CODE_END##"""
-
-code_value = 'a = 1\nb = 2\n'
-
-stdout = \
-"""##STDOUT_START##
-one
-two
-##STDOUT_END##"""
-
-stdout_value = 'one\ntwo\n'
-
-end_out = \
-"""##END_OUT_START##
-three
-4
-##END_OUT_END##"""
-
-end_out_value = 'three\n4\n'
-
-
-def test_code_regex():
-    # Test regular expression matching for code, output parts
-
-    def get_dict(s):
-        match = CODE_WITH_OUTPUT.search(s)
-        if match is None:
-            return None
-        return match.groupdict()
-
-    # Check that the code part must match
-    assert get_dict(stdout) is None
-    assert get_dict(end_out) is None
-    # Check different joins still allows detection of parts
-    for combination, output in zip(
-        ((code,),
-         (code, stdout),
-         (code, end_out),
-         (code, stdout, end_out)),
-        (dict(code=code_value, stdout=None, end_out=None),
-         dict(code=code_value, stdout=stdout_value, end_out=None),
-         dict(code=code_value, stdout=None, end_out=end_out_value),
-         dict(code=code_value, stdout=stdout_value, end_out=end_out_value)
-        )):
-        for joiner in ('\n', '\n  \n\n'):
-            in_str = joiner.join(combination)
-            assert get_dict(in_str) == output
-            # Check adding extra carriage returns etc is OK
-            in_str += '\n\n'
-            assert get_dict(in_str) == output
+def test_reuse_exporter():
+    # One exporter can convert many notebooks
+    v4 = nbformat.v4
+    exporter = make_exporter()
+    for code in ('a = 10', 'b = 2\nprint(b)'):
+        nb = v4.new_notebook()
+        nb['cells'] = [v4.new_code_cell(code)]
+        assert convert_nb(nb, exporter) == convert_nb(nb)
+
+
+def _code_nb(*cells):
+    # Notebook from (source, outputs) tuples, or cells
+    v4 = nbformat.v4
+    nb = v4.new_notebook()
+    for cell in cells:
+        if isinstance(cell, tuple):
+            source, outputs = cell
+            cell = v4.new_code_cell(source)
+            cell.outputs = list(outputs)
+        nb.cells.append(cell)
+    return nb
+
+
+def _stream(text, name='stdout'):
+    return nbformat.v4.new_output('stream', name=name, text=text)
+
+
+def _result(text):
+    return nbformat.v4.new_output('execute_result', {'text/plain': text},
+                                  execution_count=1)
+
+
+FIG = nbformat.v4.new_output('display_data', {'image/png': 'AAAA',
+                                              'text/plain': '<Figure>'})
+SVG = nbformat.v4.new_output('display_data', {'image/svg+xml': '<svg/>'})
+HTML = nbformat.v4.new_output('display_data', {'text/html': '<b>x</b>',
+                                               'text/plain': 'x'})
+ERROR = nbformat.v4.new_output('error', ename='E', evalue='v',
+                               traceback=['tb1', 'tb2'])
+MPL_OUT = '[<matplotlib.lines.Line2D at 0x10>]'
+
+
+def test_code_cells():
+    # Code cells give nbplot directives, with outputs as doctest output
+    nb = _code_nb(('print(1)\n1', [_stream('1\n'), _result('1'), FIG]),
+                  ('a = 2', []))
+    assert convert_nb(nb) == """\
+.. nbplot::
+
+    >>> print(1)
+    >>> 1
+    1
+
+    1
+
+
+
+
+.. nbplot::
+
+    >>> a = 2
+"""
+    nb = _code_nb(('%matplotlib inline\nplt.plot()', [_result(MPL_OUT)]))
+    assert convert_nb(nb) == """\
+.. mpl-interactive::
+
+.. nbplot::
+
+    >>> plt.plot()
+    [...]
+"""
+    # Directive ending in printed output takes newline from next cell.
+    nb = _code_nb(('print(1)', [_stream('1')]), ('b = 2', []))
+    assert convert_nb(nb) == """\
+.. nbplot::
+
+    >>> print(1)
+
+    1
+.. nbplot::
+
+    >>> b = 2
+"""
+
+
+def test_output_cells():
+    # Outputs of cells without code go into previous directive.
+    v4 = nbformat.v4
+    no_source = v4.new_code_cell('b = 1')
+    no_source.metadata['transient'] = {'remove_source': True}
+    no_source.outputs = [_stream('1\n')]
+    nb = _code_nb(('a = 1', []), ('%timeit a', [_stream('1 loop\n')]),
+                  no_source)
+    assert convert_nb(nb) == """\
+.. nbplot::
+
+    >>> a = 1
+
+    1 loop
+    1
+
+"""
+    # Streams go together, after any result.
+    nb = _code_nb(('a', [_stream('1\n'), _stream('2\n', 'stderr'),
+                         _result('3')]))
+    assert convert_nb(nb) == """\
+.. nbplot::
+
+    >>> a
+    3
+
+    1
+    2
+
+"""
+    # Output without a directive before it.
+    nb = _code_nb(v4.new_raw_cell('Raw'),
+                  ('%timeit a', [_stream('1 loop\n')]))
+    assert convert_nb(nb) == """\
+Raw
+
+
+
+.. parsed-literal::
+
+    1 loop
+
+"""
+
+
+def test_other_cells():
+    # Other outputs, and raw cells, as for the nbconvert template.
+    v4 = nbformat.v4
+    nb = _code_nb(('a', [HTML]), ('b', [ERROR]), v4.new_raw_cell('Raw'),
+                  v4.new_raw_cell('Html',
+                                  metadata={'raw_mimetype': 'text/html'}))
+    assert convert_nb(nb) == """\
+.. nbplot::
+
+    >>> a
+
+
+
+.. raw:: html
+
+    <b>x</b>
+
+
+.. nbplot::
+
+    >>> b
+
+
+::
+
+
+    tb1
+
+    tb2
+
+
+Raw
+"""
+
+
+def test_markdown_cells(monkeypatch):
+    # Markdown cells convert with pandoc.
+    v4 = nbformat.v4
+    monkeypatch.setattr(from_notebook, 'convert_pandoc',
+                        lambda source, from_, to: '{}-{}: {}'.format(
+                            from_, to, source))
+    nb = _code_nb(v4.new_markdown_cell('Some *text*'), ('a = 1', []))
+    parts = list(iter_rst(nb.cells, lambda data: sorted(data)))
+    assert parts[0] == '\nmarkdown-rst: Some *text*\n'
+    assert ''.join(parts) == ('\nmarkdown-rst: Some *text*\n\n'
+                              '.. nbplot::\n\n    >>> a = 1\n')
+    assert convert_nb(nb) == ''.join(parts).lstrip()
+
+
+def test_large_output():
+    # Memory for conversion goes up in proportion to size of outputs.
+    nb = _code_nb(*[('print(i)', [_stream('A line of output\n' * 5000)])
+                    for i in range(20)])
+    exporter = make_exporter()
+    tracemalloc.start()
+    try:
+        rst = convert_nb(nb, exporter)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert rst.count('.. nbplot::') == 20
+    # Notebook copy, outputs and ReST; no copies of whole ReST text.
+    assert peak < 6 * len(rst)
+
+
+def test_read_nb(tmp_path):
+    # Read notebook without image data
+    v4 = nbformat.v4
+    tricky = 'a "quote", \\"image/png\\": "x", "image/png": "y" \\'
+    cell = v4.new_code_cell(tricky + '\nplt.plot()')
+    cell.outputs = [
+        v4.new_output('stream', name='stdout', text=tricky + '\n'),
+        v4.new_output('display_data',
+                      {'image/png': 'iVBORw0KGgo' * 100,
+                       'text/plain': '<Figure>'},
+                      metadata={'image/png': {'width': 100}}),
+        v4.new_output('display_data',
+                      {'image/svg+xml': '<svg>\n<g a="1"/>\n</svg>\n',
+                       'text/plain': tricky})]
+    nb = v4.new_notebook()
+    nb.cells = [cell, v4.new_markdown_cell('Some "text"')]
+    nb_fname = str(tmp_path / 'test.ipynb')
+    nbformat.write(nb, nb_fname)
+    notebook = read_nb(nb_fname)
+    expected = nbformat.read(nb_fname, as_version=4)
+    for output in expected.cells[0].outputs[1:]:
+        for data_type in SKIP_TYPES:
+            if data_type in output.data:
+                output.data[data_type] = ''
+    assert notebook == expected
+    del nb.cells[1]
+    nbformat.write(nb, nb_fname)
+    assert (convert_nb_fname(nb_fname) ==
+            convert_nb(nbformat.read(nb_fname, as_version=4)))
+
+
+def test_read_nb_memory(tmp_path):
+    # We do not load image data into memory
+    v4 = nbformat.v4
+    cell = v4.new_code_cell('plt.plot()')
+    cell.outputs = [v4.new_output('display_data',
+                                  {'image/png': 'iVBORw0KGgo' * 2 ** 20,
+                                   'text/plain': '<Figure>'})]
+    nb = v4.new_notebook()
+    nb.cells = [cell]
+    nb_fname = str(tmp_path / 'big.ipynb')
+    nbformat.write(nb, nb_fname)
+    tracemalloc.start()
+    try:
+        notebook = read_nb(nb_fname)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert notebook.cells[0].outputs[0].data['text/plain'] == '<Figure>'
+    assert peak < 2 ** 20
@@ -0,0 +1,41 @@
+""" Test importing nb2plots does not import slow dependencies
+"""
+
+import sys
+import subprocess
+
+import pytest
+
+# Modules that are slow to import, that we only need when building pages with
+# nbplot directives, or notebooks.
+SLOW_MODULES = ('matplotlib', 'matplotlib.pyplot', 'nbformat', 'nbconvert',
+                'nbclient', 'jupyter_client')
+
+# Test infrastructure, that the Sphinx extensions should not need.
+TEST_MODULES = ('sphinxtesters',)
+
+
+def imported_by(module_name, check_modules=SLOW_MODULES):
+    # Import module in fresh process, return `check_modules` it imported
+    code = ('import sys, {0}\n'
+            'print(" ".join(m for m in {1!r} if m in sys.modules))'.format(
+                module_name, check_modules))
+    out = subprocess.check_output([sys.executable, '-c', code])
+    return out.decode('latin1').split()
+
+
+@pytest.mark.parametrize('module_name',
+                         ['nb2plots', 'nb2plots.doctree2md',
+                          'nb2plots.commands', 'nb2plots.nbplots',
+                          'nb2plots.runroles', 'nb2plots.codelinks'])
+def test_lazy_imports(module_name):
+    assert imported_by(module_name, SLOW_MODULES + TEST_MODULES) == []
+
+
+def test_client_imports():
+    # Script client for server does not need Sphinx
+    for module_name in ('nb2plots.commands', 'nb2plots.server'):
+        code = 'import sys, {}; print("sphinx" in sys.modules)'.format(
+            module_name)
+        out = subprocess.check_output([sys.executable, '-c', code])
+        assert out.strip() == b'False'
@@ -0,0 +1,117 @@
+""" Tests for kernelpool module
+"""
+
+import os
+
+import numpy as np
+
+from nbformat import v4 as nbf
+
+from nb2plots.kernelpool import KernelPool, PooledKernel
+
+import pytest
+
+
+def _code_nb(*sources):
+    return nbf.new_notebook(cells=[nbf.new_code_cell(source)
+                                   for source in sources])
+
+
+def test_kernel_pool(tmp_path):
+    pool = KernelPool(max_uses=2, cwd=str(tmp_path))
+    nb = _code_nb("print('leaked' in globals())\nleaked = 1",
+                  "import os\nos.chdir('..')\nos.getcwd()")
+    try:
+        for i in range(3):
+            full_nb = pool.fill(nb)
+            # Namespace cleared, working directory and count reset
+            assert full_nb.cells[0].outputs[0].text == 'False\n'
+            assert (full_nb.cells[1].outputs[0].data['text/plain'] ==
+                    repr(os.path.dirname(str(tmp_path))))
+            assert [c.execution_count for c in full_nb.cells] == [1, 2]
+            # Kernel replaced after two uses
+            assert [k.uses for k in pool._idle] == [[1], [], [1]][i]
+        # Errors shut down the kernel.
+        with pytest.raises(Exception):
+            pool.fill(_code_nb('raise ValueError'))
+        assert pool._idle == []
+    finally:
+        pool.shutdown()
+    assert pool._idle == []
+
+
+def test_kernel_pool_memory(tmp_path):
+    pool = KernelPool(max_memory=1, cwd=str(tmp_path))
+    try:
+        pool.fill(_code_nb('a = 1'))
+        # Kernel uses more than 1MB, so pool replaces it.
+        assert pool._idle == []
+    finally:
+        pool.shutdown()
+
+
+def test_reset_output(tmp_path):
+    # Output from the notebook code during the reset does not break the fill.
+    pool = KernelPool(cwd=str(tmp_path))
+    nb = _code_nb("class P(object):\n"
+                  "    def __del__(self):\n"
+                  "        print('Deleted 1.5')\n"
+                  "p = P()")
+    try:
+        pool.fill(nb)
+        assert [k.uses for k in pool._idle] == [1]
+        # The reset cannot report memory use; replace the kernel.
+        full_nb = pool.fill(_code_nb("import builtins\n"
+                                     "builtins.print = lambda *a, **k: None"))
+        assert full_nb.cells[0].execution_count == 1
+        assert pool._idle == []
+    finally:
+        pool.shutdown()
+
+
+def test_current_memory(tmp_path):
+    # Memory use is for after the reset, not the peak.
+    kernel = PooledKernel(cwd=str(tmp_path))
+    try:
+        _, before = kernel.fill(_code_nb('a = 1'))
+        if before is None:
+            pytest.skip('Cannot get kernel memory use')
+        _, after = kernel.fill(_code_nb("big = b'x' * (400 * 2 ** 20)"))
+        assert after < before + 200
+        assert kernel.reusable
+    finally:
+        kernel.shutdown()
+
+
+def test_reset_state(tmp_path):
+    # Reset restores library and interpreter state changed by notebook.
+    kernel = PooledKernel(cwd=str(tmp_path))
+    nb1 = _code_nb("import sys, warnings\n"
+                   "import numpy as np\n"
+                   "import matplotlib as mpl\n"
+                   "mpl.rcParams['lines.linewidth'] = 11\n"
+                   "np.set_printoptions(precision=2)\n"
+                   "np.random.seed(0)\n"
+                   "sys.path.insert(0, 'some_path')\n"
+                   "warnings.simplefilter('ignore')")
+    nb2 = _code_nb("import sys, warnings\n"
+                   "import numpy as np\n"
+                   "import matplotlib as mpl\n"
+                   "print(mpl.rcParams['lines.linewidth'] == "
+                   "mpl.rcParamsDefault['lines.linewidth'])\n"
+                   "print(np.get_printoptions()['precision'])\n"
+                   "print('some_path' in sys.path)\n"
+                   "print(('ignore', None, Warning, None, 0) in "
+                   "warnings.filters)\n"
+                   "print(np.random.randint(2 ** 30))")
+    try:
+        kernel.fill(nb1)
+        full_nb, _ = kernel.fill(nb2)
+        lines = full_nb.cells[0].outputs[0].text.splitlines()
+        assert lines[:4] == ['True', '8', 'False', 'False']
+        # Random state not from seed in first notebook.
+        np.random.seed(0)
+        assert int(lines[4]) != np.random.randint(2 ** 30)
+        assert kernel.reusable
+    finally:
+        kernel.shutdown()
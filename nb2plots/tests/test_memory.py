@@ -0,0 +1,108 @@
+""" Tests for memory module
+"""
+
+import json
+
+import numpy as np
+
+from nb2plots.memory import (track_memory, memory_report, over_budget,
+                             current_rss, REPORT_NAME)
+
+from nb2plots.testing import PlotsBuilder
+
+import pytest
+
+
+def test_track_memory():
+    with track_memory(None):
+        pass
+    record = {}
+    with track_memory(record):
+        arr = np.ones(2 ** 20)  # 8MB
+        tmp = np.ones(2 ** 21)  # 16MB
+        del tmp
+    assert 7.5 < record['net'] < 9
+    assert record['peak'] > 23.5
+    assert over_budget(record, 16)
+    assert not over_budget(record, 32)
+    assert not over_budget(record, None)
+    del arr
+
+
+def test_current_rss():
+    before = current_rss()
+    if before is None:
+        pytest.skip('Cannot get memory use')
+    arr = np.ones(2 ** 24)  # 128MB
+    during = current_rss()
+    del arr
+    # Resident memory goes down again, unlike the peak.
+    assert during > before + 100
+    assert current_rss() < during - 100
+
+
+def test_memory_report():
+    report = memory_report(
+        {'a': [dict(lineno=4, net=1., peak=2., rss=100.),
+               dict(lineno=7, net=-0.5, peak=1., rss=90.),
+               dict(lineno=10, cached=True)],
+         'b': [dict(lineno=3, net=3., peak=4., rss=120.)]})
+    # Document resident memory is after last block that ran.
+    assert report['documents'] == [
+        dict(docname='b', net=3., peak=4., rss=120., n_blocks=1),
+        dict(docname='a', net=0.5, peak=2., rss=90., n_blocks=3)]
+    assert [(b['docname'], b['lineno']) for b in report['blocks']] == [
+        ('b', 3), ('a', 4), ('a', 10), ('a', 7)]
+
+
+class TestMemory(PlotsBuilder):
+    """ Build writes memory report
+    """
+
+    conf_source = PlotsBuilder.conf_source + 'nbplot_memory = True\n'
+
+    rst_sources = {'a_page': """\
+Title
+#####
+
+.. nbplot::
+
+    >>> a = np.ones(2 ** 21)
+
+.. nbplot::
+
+    >>> b = a.sum()
+"""}
+
+    def test_report(self):
+        report = json.loads(self.get_built_file(REPORT_NAME))
+        doc, = report['documents']
+        assert doc['docname'] == 'a_page'
+        assert doc['n_blocks'] == 2
+        assert doc['net'] > 15.5
+        blocks = report['blocks']
+        assert [b['lineno'] for b in blocks] == [6, 10]
+        assert blocks[0]['net'] > 15.5
+        assert blocks[1]['net'] < 1
+        for block in blocks:
+            assert block['peak'] >= block['net']
+            assert not block['error']
+
+
+class TestPrerunMemory(TestMemory):
+    """ Memory use comes back from worker processes
+    """
+
+    conf_source = TestMemory.conf_source + 'nbplot_jobs = 2\n'
+
+
+class TestMemoryBudget(TestMemory):
+    """ Block over memory budget gives warning
+    """
+
+    conf_source = TestMemory.conf_source + 'nbplot_memory_budget = 8\n'
+
+    should_error = True
+
+    def test_report(self):
+        assert 'over budget of 8MB' in str(self.build_error)
@@ -0,0 +1,89 @@
+""" Tests for building with several builders from one read
+"""
+
+from os.path import join as pjoin, dirname, isfile
+import shutil
+from io import StringIO
+
+from nb2plots import runroles
+from nb2plots.multibuild import build_all
+
+from unittest import mock
+
+HERE = dirname(__file__)
+
+PLOT_PAGE = """\
+Plots
+=====
+
+.. nbplot::
+
+    >>> with open('runs.txt', 'at') as fobj:
+    ...     _ = fobj.write('run\\n')
+    >>> plt.plot(range(10))
+    [...]
+
+.. only:: html
+
+    Only in HTML.
+
+.. only:: markdown
+
+    Only in Markdown.
+"""
+
+
+def test_build_all(tmp_path):
+    srcdir = str(tmp_path / 'proj')
+    shutil.copytree(pjoin(HERE, 'proj1'), srcdir)
+    with open(pjoin(srcdir, 'plots.rst'), 'wt') as fobj:
+        fobj.write(PLOT_PAGE)
+    with open(pjoin(srcdir, 'index.rst'), 'at') as fobj:
+        fobj.write('\n.. toctree::\n\n    plots\n')
+    outdir = str(tmp_path / 'build')
+    with mock.patch.object(runroles, 'fill_notebook',
+                           wraps=runroles.fill_notebook) as fill_nb:
+        build_all(srcdir, outdir, status=StringIO(), warning=StringIO())
+    # nbplot code ran once for all builders
+    with open(pjoin(srcdir, 'runs.txt'), 'rt') as fobj:
+        assert fobj.read() == 'run\n'
+    # Notebook filled once for all builders
+    assert fill_nb.call_count == 1
+    for buildername, suffix in (('html', '.html'),
+                                ('markdown', '.md'),
+                                ('python', '.py'),
+                                ('jupyter', '.ipynb')):
+        build_dir = pjoin(outdir, buildername)
+        assert isfile(pjoin(build_dir, 'plots' + suffix))
+        assert isfile(pjoin(build_dir, 'another.ipynb'))
+    # Figures only in the builder that uses them
+    for fmt in ('png', 'hires.png', 'pdf'):
+        assert isfile(pjoin(outdir, 'html', 'plots-1.' + fmt))
+        assert not isfile(pjoin(outdir, 'markdown', 'plots-1.' + fmt))
+    assert isfile(pjoin(outdir, 'html', '_images', 'plots-1.png'))
+    # Only directives select for current builder
+    with open(pjoin(outdir, 'html', 'plots.html'), 'rt') as fobj:
+        html = fobj.read()
+    assert 'Only in HTML' in html
+    assert 'Only in Markdown' not in html
+    with open(pjoin(outdir, 'markdown', 'plots.md'), 'rt') as fobj:
+        markdown = fobj.read()
+    assert 'Only in HTML' not in markdown
+    assert 'Only in Markdown' in markdown
+
+
+def test_build_all_images(tmp_path):
+    # Later builders get images from reads for earlier builders.
+    srcdir = str(tmp_path / 'proj')
+    shutil.copytree(pjoin(HERE, 'proj1'), srcdir)
+    with open(pjoin(srcdir, 'a_page.rst'), 'wt') as fobj:
+        fobj.write(PLOT_PAGE)
+    outdir = str(tmp_path / 'build')
+    build_all(srcdir, outdir, builders=['markdown', 'html', 'dirhtml'],
+              status=StringIO(), warning=StringIO())
+    with open(pjoin(srcdir, 'runs.txt'), 'rt') as fobj:
+        assert fobj.read() == 'run\n'
+    for buildername in ('html', 'dirhtml'):
+        for fmt in ('png', 'hires.png', 'pdf'):
+            assert isfile(pjoin(outdir, buildername, 'a_page-1.' + fmt))
+    assert not isfile(pjoin(outdir, 'markdown', 'a_page-1.png'))
@@ -1,8 +1,14 @@
 """ Tests for build using nbplot extension """
 
-from os.path import (join as pjoin, dirname, isdir)
+from os.path import (join as pjoin, dirname, isdir, isfile)
 import re
 import os
+import sys
+import gc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.pyplot as plt
 
 from docutils.nodes import paragraph, title
 
@@ -10,8 +16,9 @@ import sphinx
 
 SPHINX_ge_1p8 = sphinx.version_info[:2] >= (1, 8)
 
+from nb2plots import nbplots as nbp
 from nb2plots.nbplots import (run_code, parse_parts, nbplot_container,
-                              nbplot_epilogue)
+                              nbplot_epilogue, format_result)
 from sphinxtesters import SourcesBuilder
 
 from nb2plots.testing import PlotsBuilder, OPT_TRANS
@@ -57,6 +64,49 @@ def test_run_code():
     run_code('d', raises=NameError)
 
 
+def test_run_code_capture():
+    # Test capture of stdout and final expression
+    capture = {}
+    run_code('print("Hello")\na = 10\na + 1', capture=capture)
+    assert capture == dict(stdout='Hello\n', result={'text/plain': '11'},
+                           complete=True)
+    run_code('a = 10\n', capture=capture)
+    assert capture == dict(stdout='', result=None, complete=True)
+    # Final semicolon suppresses result
+    run_code('a = 10\na;  # Comment\n# Comment', capture=capture)
+    assert capture['result'] is None
+    # Doctest code
+    run_code('>>> a = [1]\n>>> a\n[1]\n', capture=capture)
+    assert capture['result'] == {'text/plain': '[1]'}
+    # Results formatted as for IPython, not with plain repr
+    run_code('list(range(30))', capture=capture)
+    assert capture['result']['text/plain'].startswith('[0,\n 1,\n')
+    # Only the kernel can display figures
+    run_code('import matplotlib.pyplot as plt\nplt.figure()',
+             capture=capture)
+    assert capture['result'] is None
+    assert not capture['complete']
+    plt.close('all')
+    # Without capture, print is quiet
+    capture = {}
+    run_code('print("Hello")\n10')
+    assert capture == {}
+
+
+def test_format_result():
+    assert format_result(10) == {'text/plain': '10'}
+
+    class Pic:
+        def _repr_png_(self):
+            return b'PNG'
+
+        def __repr__(self):
+            return 'Pic'
+
+    assert format_result(Pic()) == {'text/plain': 'Pic',
+                                    'image/png': 'UE5H'}
+
+
 class TestNbplots(SourcesBuilder):
 
     conf_source = ('extensions = ["nb2plots"]\n'
@@ -197,6 +247,636 @@ Some text.
         self.__class__.build_source()
 
 
+# Weak references to objects from nbplot namespaces, for TestReleaseContext.
+NS_REFS = []
+
+
+class TestReleaseContext(PlotsBuilder):
+    """ Test namespace and figures freed when document has been read
+    """
+
+    rst_sources = dict(a_page="""\
+A title
+-------
+
+.. nbplot::
+
+    import weakref
+    from nb2plots.tests import test_nbplots
+
+    class C(object):
+        pass
+
+    # Only the garbage collector can free an object in a reference cycle.
+    c = C()
+    c.me = c
+    test_nbplots.NS_REFS.append(weakref.ref(c))
+    plt.plot(range(10))
+""")
+
+    @classmethod
+    def setup_class(cls):
+        del NS_REFS[:]
+        # Check we collect the garbage ourselves.
+        gc.disable()
+        try:
+            super(TestReleaseContext, cls).setup_class()
+        finally:
+            gc.enable()
+
+    def test_released(self):
+        assert len(NS_REFS) == 1
+        assert NS_REFS[0]() is None
+        assert plt.get_fignums() == []
+
+
+class TestReleaseNoFigures(TestReleaseContext):
+    """ Test namespace freed for document without figures
+    """
+
+    rst_sources = dict(a_page=TestReleaseContext.rst_sources['a_page'].replace(
+        '    plt.plot(range(10))\n', ''))
+
+
+class TestReleaseOldCycle(TestReleaseContext):
+    """ Test namespace freed when its cycles are in the oldest generation
+    """
+
+    # A collection moves the surviving cycle into the oldest generation, as
+    # automatic collections do for objects of long-running code.
+    rst_sources = dict(a_page=TestReleaseNoFigures.rst_sources['a_page'] + """
+    import gc
+    gc.collect()
+""")
+
+
+class TestFigureCache(PlotsBuilder):
+    """ Test image cache reuses images, and restores context when needed
+    """
+
+    conf_source = PlotsBuilder.conf_source + 'nbplot_cache = True\n'
+
+    rst_sources = dict(a_page="""\
+A title
+-------
+
+.. nbplot::
+
+    with open('runs.txt', 'at') as fobj:
+        _ = fobj.write('run\\n')
+    a = 10
+    plt.plot(range(a))
+
+Some text.
+
+.. nbplot::
+
+    b = a + 1
+""")
+
+    def n_runs(self):
+        with open(pjoin(self.page_source, 'runs.txt'), 'rt') as fobj:
+            return len(fobj.readlines())
+
+    def test_cache(self):
+        assert self.n_runs() == 1
+        assert isdir(pjoin(self.build_path, 'nbplot_cache'))
+        png = self.get_built_file('a_page-1.png', None)
+        page_fname = pjoin(self.page_source, 'a_page.rst')
+        # Changing the text gives the same figures, without running code.
+        with open(page_fname, 'a') as fobj:
+            fobj.write('\nSomething added\n')
+        self.__class__.build_source()
+        assert self.n_runs() == 1
+        assert self.get_built_file('a_page-1.png', None) == png
+        # Changing the second block needs the context from the first.
+        with open(page_fname, 'rt') as fobj:
+            contents = fobj.read()
+        with open(page_fname, 'wt') as fobj:
+            fobj.write(contents.replace('b = a + 1', 'assert a == 10'))
+        self.__class__.build_source()
+        assert self.n_runs() == 2
+
+
+WORKDIR_PAGE = """\
+A title
+-------
+
+.. nbplot::
+
+    with open('runs.txt', 'at') as fobj:
+        _ = fobj.write('run\\n')
+    plt.plot(range(10))
+"""
+
+
+class TestFigureCacheWorkdir(PlotsBuilder):
+    """ Test same code in different source directories does not share images
+
+    The code runs in the directory of its document, so can read different
+    files there.
+    """
+
+    conf_source = PlotsBuilder.conf_source + 'nbplot_cache = True\n'
+
+    rst_sources = {'one/a_page': WORKDIR_PAGE, 'two/a_page': WORKDIR_PAGE}
+
+    def test_workdir(self):
+        for dir_name in ('one', 'two'):
+            runs_fname = pjoin(self.page_source, dir_name, 'runs.txt')
+            with open(runs_fname, 'rt') as fobj:
+                assert fobj.read() == 'run\n'
+
+
+PARALLEL_PAGE = """\
+A title
+-------
+
+.. nbplot-flags::
+
+    page_no = {0}
+
+.. nbplot::
+
+    assert 'a' not in globals()
+    a = {0}
+    import os
+    with open('pid_{0}.txt', 'wt') as fobj:
+        _ = fobj.write(str(os.getpid()))
+    plt.plot(range(a + 1))
+
+.. nbplot::
+
+    assert a == {0}
+"""
+
+
+class TestParallelRead(PlotsBuilder):
+    """ Test parallel read keeps namespaces for each document
+    """
+
+    rst_sources = {'page_{}'.format(i): PARALLEL_PAGE.format(i)
+                   for i in range(8)}
+
+    @classmethod
+    def build_source(cls):
+        cls.build_app.parallel = 2
+        super(TestParallelRead, cls).build_source()
+
+    def test_parallel(self):
+        pids = set()
+        for i in range(8):
+            with open(pjoin(self.page_source, 'pid_{}.txt'.format(i))) as fobj:
+                pids.add(int(fobj.read()))
+        assert os.getpid() not in pids
+        env = self.build_app.env
+        for i in range(8):
+            docname = 'page_{}'.format(i)
+            assert env.nbplot_flag_namespaces[docname] == {'page_no': i}
+            assert env.nbplot_reset_markers[docname]
+            assert isfile(pjoin(self.out_dir, docname + '-1.png'))
+
+
+PRERUN_PAGE = """\
+A title
+-------
+
+.. nbplot-flags::
+
+    use_second = True
+
+.. nbplot::
+
+    assert 'a' not in globals()
+    a = {0}
+    import os
+    with open('pid_{0}.txt', 'at') as fobj:
+        _ = fobj.write(str(os.getpid()) + '\\n')
+    plt.plot(range(a + 1))
+
+.. nbplot::
+    :keepfigs:
+    :run-parts: 1 if use_second else 0
+
+    .. part
+
+    assert False
+
+    .. part
+
+    assert a == {0}
+
+.. nbplot::
+    :raises: ValueError
+
+    raise ValueError
+"""
+
+
+class TestPrerun(PlotsBuilder):
+    """ Test running of nbplot code in worker processes
+    """
+
+    conf_source = PlotsBuilder.conf_source + 'nbplot_jobs = 2\n'
+
+    rst_sources = {'page_{}'.format(i): PRERUN_PAGE.format(i)
+                   for i in range(4)}
+
+    def test_prerun(self):
+        for i in range(4):
+            with open(pjoin(self.page_source, 'pid_{}.txt'.format(i))) as fobj:
+                pids = [int(line) for line in fobj]
+            # Code ran once, in worker process.
+            assert len(pids) == 1
+            assert pids[0] != os.getpid()
+            assert isfile(pjoin(self.out_dir, 'page_{}-1.png'.format(i)))
+            # keepfigs for second plot
+            assert file_same(pjoin(self.out_dir, 'page_{}-1.png'.format(i)),
+                             pjoin(self.out_dir, 'page_{}-2.png'.format(i)))
+
+
+# Directives in markup that the nbplot directives do not run.
+PRERUN_MARKUP_PAGE = """\
+A title
+-------
+
+.. note::
+
+    .. nbplot::
+
+        import os
+        def record(name):
+            with open(name + '.txt', 'at') as fobj:
+                _ = fobj.write(str(os.getpid()) + '\\n')
+        record('first')
+
+Example markup in a literal block::
+
+    .. nbplot::
+
+        record('literal')
+
+.. code-block:: rst
+
+    .. nbplot::
+
+        record('code_block')
+
+..
+    .. nbplot::
+
+        record('comment')
+
+.. only:: html
+
+    .. nbplot::
+        :keepfigs:
+
+        record('only')
+
+.. nbplot::
+    :raises: ValueError
+
+    record('last')
+    raise ValueError
+"""
+
+
+def _recorded_pids(path, name):
+    fname = pjoin(path, name + '.txt')
+    if not isfile(fname):
+        return []
+    with open(fname) as fobj:
+        return [int(line) for line in fobj]
+
+
+class TestPrerunMarkup(PlotsBuilder):
+    """ Test running code in worker process for document with other markup
+    """
+
+    conf_source = PlotsBuilder.conf_source + 'nbplot_jobs = 2\n'
+
+    rst_sources = dict(a_page=PRERUN_MARKUP_PAGE)
+
+    def test_prerun(self):
+        for name in ('literal', 'code_block', 'comment'):
+            assert _recorded_pids(self.page_source, name) == []
+        for name in ('first', 'only', 'last'):
+            pids = _recorded_pids(self.page_source, name)
+            # Code ran once, in worker process.
+            assert len(pids) == 1
+            assert pids[0] != os.getpid()
+
+
+class TestPrerunMismatch(PlotsBuilder):
+    """ Test directives run their own code if the prerun does not match them
+    """
+
+    # A directive with literal content, that the scan does not know.
+    conf_source = PlotsBuilder.conf_source + """\
+nbplot_jobs = 2
+
+from docutils import nodes
+from docutils.parsers.rst import Directive
+
+class Verbatim(Directive):
+    has_content = True
+
+    def run(self):
+        return [nodes.literal_block(text='\\n'.join(self.content))]
+
+def setup(app):
+    app.add_directive('verbatim', Verbatim)
+"""
+
+    rst_sources = dict(a_page=PRERUN_MARKUP_PAGE.replace(
+        '.. code-block:: rst', '.. verbatim::'))
+
+    def test_prerun(self):
+        for name in ('literal', 'comment'):
+            assert _recorded_pids(self.page_source, name) == []
+        # Prerun ran the verbatim code, and so has different code and keys
+        # for the directives after the verbatim block.
+        pids = _recorded_pids(self.page_source, 'code_block')
+        assert len(pids) == 1
+        assert pids[0] != os.getpid()
+        assert _recorded_pids(self.page_source, 'first')[0] != os.getpid()
+        for name in ('only', 'last'):
+            pids = _recorded_pids(self.page_source, name)
+            assert pids[-1] == os.getpid()
+
+
+class TestPrerunInclude(PlotsBuilder):
+    """ Test documents including nbplot directives run in main process
+    """
+
+    conf_source = PlotsBuilder.conf_source + 'nbplot_jobs = 2\n'
+
+    rst_sources = {'page_{}'.format(i): """\
+A title
+-------
+
+.. include:: {0}
+
+.. nbplot::
+
+    import os
+    with open('pid_{1}.txt', 'at') as fobj:
+        _ = fobj.write(str(os.getpid()) + '\\n')
+""".format(inc, i) for i, inc in enumerate(('/plots.inc', 'links.inc'))}
+
+    @classmethod
+    def modify_source(cls):
+        super(TestPrerunInclude, cls).modify_source()
+        with open(pjoin(cls.page_source, 'plots.inc'), 'wt') as fobj:
+            fobj.write('.. nbplot::\n\n    a = 1\n')
+        with open(pjoin(cls.page_source, 'links.inc'), 'wt') as fobj:
+            fobj.write('.. _python: https://www.python.org\n')
+
+    def test_prerun(self):
+        # Including nbplot directives.
+        assert _recorded_pids(self.page_source, 'pid_0') == [os.getpid()]
+        # Including links.
+        pids = _recorded_pids(self.page_source, 'pid_1')
+        assert len(pids) == 1
+        assert pids[0] != os.getpid()
+
+
+def test_find_nbplots():
+    found = nbp.find_nbplots(PRERUN_MARKUP_PAGE)
+    assert [(name, options) for name, options, content in found] == [
+        ('nbplot', {}),
+        ('nbplot', {'keepfigs': ''}),
+        ('nbplot', {'raises': 'ValueError'})]
+    assert found[1][2] == ['', "record('only')"]
+    assert found[2][2] == ['', "record('last')", 'raise ValueError']
+    # Directive after a comment with content on the first line, and a
+    # literal block after a paragraph.
+    assert nbp.find_nbplots("""\
+.. a comment
+    .. nbplot::
+
+        a = 1
+
+Some text::
+
+    .. nbplot::
+
+        a = 2
+
+.. nbplot::
+
+    a = 3
+""") == [('nbplot', {}, ['', 'a = 3'])]
+
+
+class TestForkWorkers(PlotsBuilder):
+    """ Test running of nbplot code in processes from fork server
+    """
+
+    # The fork server has already imported the modules the pre code imports.
+    conf_source = (PlotsBuilder.conf_source +
+                   'nbplot_jobs = 2\n'
+                   'nbplot_fork_workers = True\n'
+                   'nbplot_pre_code = "import sys; '
+                   "preloaded = 'colorsys' in sys.modules; "
+                   'import colorsys"\n')
+
+    rst_sources = {'page_{}'.format(i): """\
+A title
+-------
+
+.. nbplot::
+
+    import os
+    assert 'a' not in globals()
+    a = 1
+    with open('pids_{0}.txt', 'wt') as fobj:
+        _ = fobj.write('{{}} {{}}'.format(os.getpid(), preloaded))
+""".format(i) for i in range(4)}
+
+    def test_fork_workers(self):
+        if (sys.version_info < (3, 11) or
+            'forkserver' not in multiprocessing.get_all_start_methods()):
+            pytest.skip('No fork server process pool')
+        run_pids = set()
+        for i in range(4):
+            with open(pjoin(self.page_source, 'pids_{}.txt'.format(i))) as fobj:
+                run_pid, preloaded = fobj.read().split()
+            run_pids.add(int(run_pid))
+            assert preloaded == 'True'
+        # Each document ran in its own process.
+        assert len(run_pids) == 4
+        assert os.getpid() not in run_pids
+
+
+def test_preload_modules():
+    base = ['nb2plots.nbplots', 'nb2plots.forkpreload']
+    assert nbp._preload_modules(
+        'import numpy as np\nfrom matplotlib import pyplot as plt\n'
+        'from . import local\nimport os.path, sys\nfrom math import *') == (
+            base + ['numpy', 'matplotlib', 'matplotlib.pyplot', 'os.path',
+                    'sys', 'math'])
+    assert nbp._preload_modules(None) == base
+    assert nbp._preload_modules('import (') == base
+
+
+def test_fork_pyplot():
+    # Processes forked from the fork server have pyplot, with Agg backend.
+    pool_kwargs = nbp.fork_pool_kwargs(None)
+    if pool_kwargs == {}:
+        pytest.skip('No fork server process pool')
+    with ProcessPoolExecutor(1, **pool_kwargs) as executor:
+        # Evaluate in worker, without importing this module, which imports
+        # pyplot.
+        assert executor.submit(
+            eval, "'matplotlib.pyplot' in __import__('sys').modules").result()
+        assert executor.submit(
+            eval, "__import__('matplotlib').get_backend()").result() == 'Agg'
+
+
+class TestPrerunError(PlotsBuilder):
+    """ Test reporting of error from worker process
+    """
+
+    conf_source = PlotsBuilder.conf_source + 'nbplot_jobs = 2\n'
+
+    rst_sources = dict(a_page="""\
+A title
+-------
+
+.. nbplot::
+
+    import os
+    with open('pid.txt', 'at') as fobj:
+        _ = fobj.write(str(os.getpid()) + '\\n')
+    raise RuntimeError('Wrong here')
+""")
+
+    should_error = True
+
+    def test_error(self):
+        assert 'Wrong here' in str(self.build_error)
+        with open(pjoin(self.page_source, 'pid.txt')) as fobj:
+            pids = [int(line) for line in fobj]
+        assert len(pids) == 1
+        assert pids[0] != os.getpid()
+
+
+FORMATS_PAGE = """\
+A title
+-------
+
+.. nbplot::
+
+    plt.plot(range(10))
+"""
+
+
+def _built_formats(out_dir):
+    return sorted(fname[len('a_page-1'):] for fname in os.listdir(out_dir)
+                  if fname.startswith('a_page-1'))
+
+
+class TestHtmlFormats(PlotsBuilder):
+    """ HTML builder renders all formats when showing format links """
+
+    rst_sources = dict(a_page=FORMATS_PAGE)
+
+    def test_formats(self):
+        assert _built_formats(self.out_dir) == ['.hires.png', '.pdf', '.png']
+
+
+class TestHtmlNoShowFormats(TestHtmlFormats):
+    """ HTML builder only needs PNG if not showing format links """
+
+    conf_source = ('extensions = ["nb2plots"]\n'
+                   'nbplot_html_show_formats = False\n')
+
+    def test_formats(self):
+        assert _built_formats(self.out_dir) == ['.png']
+
+
+class TestLatexFormats(TestHtmlFormats):
+    """ LaTeX builder only renders PDF """
+
+    builder = 'latex'
+
+    def test_formats(self):
+        assert _built_formats(self.out_dir) == ['.pdf']
+
+
+class TestDoctestFormats(TestHtmlFormats):
+    """ Doctest builder renders no figures, but runs the code """
+
+    builder = 'doctest'
+    rst_sources = dict(a_page=FORMATS_PAGE + """
+
+.. nbplot::
+
+    >>> a = 1
+""")
+
+    def test_formats(self):
+        assert _built_formats(self.out_dir) == []
+        assert not isdir(pjoin(dirname(self.doctree_dir), 'nbplot_directive'))
+
+
+class TestExecuteUnrendered(PlotsBuilder):
+    """ Builders without figures run the code by default """
+
+    builder = 'text'
+    rst_sources = dict(a_page="""\
+A title
+-------
+
+.. nbplot::
+
+    raise ValueError('Wrong here')
+""")
+
+    should_error = True
+
+    def test_execute(self):
+        assert 'Wrong here' in str(self.build_error)
+
+
+class TestNoExecuteUnrendered(TestExecuteUnrendered):
+    """ Builders without figures can skip running the code """
+
+    conf_source = ('extensions = ["nb2plots"]\n'
+                   'nbplot_execute_unrendered = False\n')
+
+    should_error = False
+
+    def test_execute(self):
+        assert 'A title' in self.get_built_file('a_page.txt')
+
+
+def test_builder_formats():
+    from types import SimpleNamespace
+    from nb2plots.nbplots import builder_formats
+    config = SimpleNamespace(nbplot_formats=['png', ('hires.png', 200), 'pdf'],
+                             nbplot_html_show_formats=True)
+
+    def builder(name, format, **kwargs):
+        return SimpleNamespace(name=name, format=format, **kwargs)
+
+    all_formats = [('png', 80), ('hires.png', 200), ('pdf', 200)]
+    assert builder_formats(builder('html', 'html'), config) == all_formats
+    assert builder_formats(builder('dirhtml', 'html'), config) == all_formats
+    assert builder_formats(builder('latex', 'latex'), config) == [('pdf', 200)]
+    assert builder_formats(builder('texinfo', 'texinfo'), config) == [
+        ('png', 80)]
+    for name in ('text', 'doctest', 'man', 'linkcheck'):
+        assert builder_formats(builder(name, ''), config) == []
+    assert builder_formats(builder('foo', 'foo'), config) == all_formats
+    assert builder_formats(builder('foo', 'foo', nbplot_formats=('pdf',)),
+                           config) == [('pdf', 200)]
+    config.nbplot_html_show_formats = False
+    assert builder_formats(builder('html', 'html'), config) == [('png', 80)]
+
+
 class TestRcparams(PlotsBuilder):
     """ Test that rcparams get applied and kept across plots in documents
     """
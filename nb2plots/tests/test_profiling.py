@@ -0,0 +1,73 @@
+""" Tests for profiling module
+"""
+
+import ast
+from os.path import isfile
+import pstats
+
+from nb2plots.profiling import (CodeProfile, source_lines, profile_fname,
+                                SUMMARY_NAME)
+
+from nb2plots.testing import PlotsBuilder
+
+
+def test_code_profile():
+    profile = CodeProfile('my_doc.rst').at_line(10)
+    ns = {}
+    tree = ast.parse('a = 1\n\nb = [a,\n     2]\n')
+    profile.exec_tree(tree, ns)
+    expr = ast.parse('b[1] + a', mode='eval')
+    assert profile.eval_expr(expr, ns) == 3
+    profile.profiler.create_stats()
+    stats = pstats.Stats(profile.profiler)
+    lines = source_lines(stats, 'my_doc', 'my_doc.rst')
+    assert {line['key'] for line in lines} == {'my_doc:10', 'my_doc:12'}
+
+
+class TestProfile(PlotsBuilder):
+    """ Build writes profiles, summary
+    """
+
+    conf_source = PlotsBuilder.conf_source + 'nbplot_profile = True\n'
+
+    rst_sources = {'a_page': """\
+Title
+#####
+
+.. nbplot::
+
+    >>> import time
+    >>> time.sleep(0.2)
+
+Some text.
+
+.. nbplot::
+
+    def slow():
+        time.sleep(0.1)
+
+    slow()
+"""}
+
+    def test_profile(self):
+        # Test builder adds two lines to start of page.
+        assert isfile(profile_fname(self.out_dir, 'a_page'))
+        summary = self.get_built_file(SUMMARY_NAME).splitlines()
+        assert summary[0].split() == ['cumtime', 'tottime', 'ncalls',
+                                      'location']
+        locations = [line.split()[3:] for line in summary[1:]]
+        assert locations[0] == ['a_page:9', '<module>']
+        assert ['a_page:15', 'slow'] in locations[1:3]
+        assert ['a_page:18', '<module>'] in locations[1:3]
+        times = {' '.join(loc): float(line.split()[0])
+                 for loc, line in zip(locations, summary[1:])}
+        assert times['a_page:9 <module>'] >= 0.2
+        assert times['a_page:18 <module>'] >= 0.1
+
+
+class TestProfileJobs(TestProfile):
+    """ Profile runs code in main process, ignoring workers, cache
+    """
+
+    conf_source = TestProfile.conf_source + ('nbplot_jobs = 2\n'
+                                             'nbplot_cache = True\n')
@@ -1,7 +1,12 @@
 """ Tests for runroles module
 """
+import os
 import re
-from os.path import isfile, join as pjoin
+from copy import deepcopy
+from os.path import isfile, isdir, join as pjoin
+from unittest import mock
+
+from nbformat import v4 as nbf
 
 from nb2plots import runroles as rr
 from nb2plots.runroles import convert_timeout
@@ -19,7 +24,9 @@ def test_runroles_setup(*args):
     # Test extension setup works as expected
     app = mockapp.get_app()
     rr.setup(app)
-    connects = [('doctree-resolved', rr.collect_runfiles),
+    connects = [('env-merge-info', rr.do_merge_info),
+                ('doctree-read', rr.queue_runfiles),
+                ('doctree-resolved', rr.collect_runfiles),
                 ('build-finished', rr.write_runfiles)]
     roles = list(rr.NAME2ROLE.items())
     translators = [('ipynb', doctree2nb.Translator),
@@ -168,6 +175,44 @@ True
         assert isfile(pjoin(self.out_dir, 'a_page.py'))
 
 
+class TestParallelRead(PlotsBuilder):
+    """ Test runfiles for pages read in worker processes
+
+    Sphinx only reads in parallel if there are more than 5 pages.
+    """
+
+    rst_sources = {'page_{}'.format(i): """\
+Title
+#####
+
+:pyfile:`.`
+
+:clearnotebook:`.`
+
+>>> page_no = {}
+""".format(i) for i in range(8)}
+
+    @classmethod
+    def build_source(cls):
+        cls.build_app.parallel = 2
+        super(TestParallelRead, cls).build_source()
+
+    def test_output(self):
+        for i in range(8):
+            for suffix in ('.py', '.ipynb'):
+                assert isfile(pjoin(self.out_dir,
+                                    'page_{}{}'.format(i, suffix)))
+        # Building again without reading writes none of the files.
+        for suffix in ('.py', '.ipynb'):
+            os.remove(pjoin(self.out_dir, 'page_0' + suffix))
+        self.__class__.build_source()
+        assert not isfile(pjoin(self.out_dir, 'page_0.py'))
+        # Writing all documents writes the files from the stored queue.
+        self.build_app.build(True, [])
+        for suffix in ('.py', '.ipynb'):
+            assert isfile(pjoin(self.out_dir, 'page_0' + suffix))
+
+
 class TestDuplicatesOK(PlotsBuilder):
     """ Test that same and different filename for same code type works.
     """
@@ -204,3 +249,301 @@ Title
 """}
 
     should_error = True
+
+
+class TestRebuild(PlotsBuilder):
+    """ Build runroles from new text of document read again by same app
+
+    Sphinx >= 7.3 keeps the pickled doctrees it has loaded in memory, and
+    does not drop a doctree when it reads the document again, so, unless we
+    drop the doctree, we build the runroles from the old text.
+    """
+
+    rst_sources = {'a_page': """\
+Title
+#####
+
+:clearnotebook:`.`
+
+Some text.
+"""}
+
+    def test_rebuild(self):
+        page_fname = pjoin(self.page_source, 'a_page.rst')
+        with open(page_fname, 'rt') as fobj:
+            contents = fobj.read()
+        with open(page_fname, 'wt') as fobj:
+            fobj.write(contents.replace('Some text.', 'Other text.'))
+        self.__class__.build_source()
+        nb = nbf.reads(self.get_built_file('a_page.ipynb'))
+        assert 'Other text.' in nb.cells[0].source
+
+
+class TestClearAndFull(PlotsBuilder):
+    """ Clear and full notebooks for the same page
+    """
+
+    rst_sources = {'a_page': """\
+Title
+#####
+
+:fullnotebook:`.`
+
+:clearnotebook:`clear <clear.ipynb>`
+
+>>> print('Hello')
+Hello
+"""}
+
+    def test_output(self):
+        full_json = self.get_built_file('a_page.ipynb')
+        full_nb = nbf.reads(full_json)
+        assert full_json == nbf.writes(full_nb)
+        cell = [c for c in full_nb.cells if c.cell_type == 'code'][0]
+        assert cell.outputs[0].text == 'Hello\n'
+        # Filling the full notebook does not change the clear notebook.
+        clear_json = self.get_built_file('clear.ipynb')
+        clear_nb = nbf.reads(clear_json)
+        assert clear_json == nbf.writes(clear_nb)
+        cell = [c for c in clear_nb.cells if c.cell_type == 'code'][0]
+        assert cell.outputs == []
+        assert cell.execution_count is None
+        # Roles return JSON from get_built, and notebooks from get_built_nb.
+        node = dict(refdoc='a_page')
+        for name, nb_json in (('clearnotebook', clear_json),
+                              ('fullnotebook', full_json)):
+            role = rr.NAME2ROLE[name]
+            built = role.get_built(node, self.build_app)
+            assert built == nb_json
+            assert role.get_built_nb(node, self.build_app) == nbf.reads(built)
+
+
+class TestFillJobs(PlotsBuilder):
+    """ Fill full notebooks for several pages in worker processes
+    """
+
+    conf_source = PlotsBuilder.conf_source + 'fill_notebook_jobs = 2\n'
+
+    rst_sources = {name: """\
+Title
+#####
+
+:fullnotebook:`.`
+
+:fullnotebook:`other <{0}_other.ipynb>`
+
+>>> print('{0}')
+{0}
+""".format(name) for name in ('page_a', 'page_b', 'page_c')}
+
+    def test_output(self):
+        for name in ('page_a', 'page_b', 'page_c'):
+            for suffix in ('.ipynb', '_other.ipynb'):
+                nb = nbf.reads(self.get_built_file(name + suffix))
+                cell = [c for c in nb.cells if c.cell_type == 'code'][0]
+                assert cell.outputs[0].text == name + '\n'
+
+
+class TestKernelPool(PlotsBuilder):
+    """ Reuse kernel for several notebooks
+    """
+
+    conf_source = (PlotsBuilder.conf_source +
+                   'fill_notebook_kernel_pool = True\n')
+
+    rst_sources = {name: """\
+Title
+#####
+
+:fullnotebook:`.`
+
+>>> print('leaked' in globals())
+False
+>>> leaked = 1
+""" for name in ('page_a', 'page_b', 'page_c')}
+
+    def test_output(self):
+        for name in ('page_a', 'page_b', 'page_c'):
+            nb = nbf.reads(self.get_built_file(name + '.ipynb'))
+            cells = [c for c in nb.cells if c.cell_type == 'code']
+            assert cells[0].outputs[0].text == 'False\n'
+            assert cells[0].execution_count == 1
+        assert rr._kernel_pool is None
+
+
+class TestKernelPoolJobs(TestKernelPool):
+    """ Reuse kernels in worker processes
+    """
+
+    conf_source = TestKernelPool.conf_source + 'fill_notebook_jobs = 2\n'
+
+
+class TestNotebookCache(PlotsBuilder):
+    """ Reuse outputs from notebook cache when only the text changes
+    """
+
+    conf_source = PlotsBuilder.conf_source + 'fill_notebook_cache = True\n'
+
+    rst_sources = {'a_page': """\
+Title
+#####
+
+:fullnotebook:`.`
+
+Some text.
+
+>>> a = 10
+>>> a + 1
+11
+"""}
+
+    def rebuild(self, old, new):
+        page_fname = pjoin(self.page_source, 'a_page.rst')
+        with open(page_fname, 'rt') as fobj:
+            contents = fobj.read()
+        with open(page_fname, 'wt') as fobj:
+            fobj.write(contents.replace(old, new))
+        with mock.patch.object(rr, 'fill_notebook',
+                               wraps=rr.fill_notebook) as fill_nb:
+            self.__class__.build_source()
+        nb = nbf.reads(self.get_built_file('a_page.ipynb'))
+        return fill_nb.call_count, nb
+
+    def test_cache(self):
+        assert isdir(pjoin(self.build_path, 'fill_notebook_cache'))
+        n_fills, nb = self.rebuild('Some text.', 'Other text.')
+        assert n_fills == 0
+        assert 'Other text.' in nb.cells[0].source
+        assert nb.cells[1].outputs[0].data['text/plain'] == '11'
+        assert nb.cells[1].execution_count == 1
+        n_fills, nb = self.rebuild('a + 1', 'a + 2')
+        assert n_fills == 1
+        assert nb.cells[1].outputs[0].data['text/plain'] == '12'
+
+
+class TestCaptureNotebook(PlotsBuilder):
+    """ Fill full notebook from outputs of nbplot directives
+    """
+
+    conf_source = PlotsBuilder.conf_source + 'nbplot_capture = True\n'
+
+    # The kernel does not have the nbplot pre code, so would fail with a
+    # NameError for ``np``.
+    rst_sources = {'a_page': """\
+Title
+#####
+
+:fullnotebook:`.`
+
+.. nbplot::
+
+    >>> a = np.arange(3)
+    >>> print('Hello')
+    Hello
+    >>> a
+    array([0, 1, 2])
+
+.. nbplot::
+    :hide-from: all
+
+    >>> b = 1
+
+.. nbplot::
+
+    >>> plt.plot(a)
+    [...]
+"""}
+
+    def test_output(self):
+        nb = nbf.reads(self.get_built_file('a_page.ipynb'))
+        cells = [cell for cell in nb.cells if cell.cell_type == 'code']
+        assert [cell.execution_count for cell in cells] == [1, 2]
+        stream, result = cells[0].outputs
+        assert stream.output_type == 'stream'
+        assert stream.text == 'Hello\n'
+        assert result.output_type == 'execute_result'
+        assert result.data['text/plain'] == 'array([0, 1, 2])'
+        result, figure = cells[1].outputs
+        assert result.data['text/plain'].startswith('[<matplotlib.lines')
+        assert figure.output_type == 'display_data'
+        assert figure.data['image/png']
+        assert figure.data['text/plain'].startswith('<Figure size')
+
+
+class TestCaptureKernel(PlotsBuilder):
+    """ Captured results display as they do from the kernel
+    """
+
+    conf_source = PlotsBuilder.conf_source + 'nbplot_capture = True\n'
+
+    rst_sources = {'a_page': """\
+Title
+#####
+
+:fullnotebook:`.`
+
+.. nbplot::
+
+    >>> import numpy as np
+    >>> np.arange(40).reshape(4, 10) / 3
+    array(...)
+
+.. nbplot::
+
+    >>> list(range(30))
+    [...]
+"""}
+
+    def test_output(self):
+        nb = nbf.reads(self.get_built_file('a_page.ipynb'))
+        # Outputs come from captures, without kernel timing metadata.
+        assert not any('execution' in cell.metadata for cell in nb.cells)
+        empty_nb = deepcopy(nb)
+        for cell in empty_nb.cells:
+            if cell.cell_type == 'code':
+                cell.outputs = []
+        kernel_nb = rr.fill_notebook(empty_nb)
+        for nb_ in (nb, kernel_nb):
+            cells = [cell for cell in nb_.cells if cell.cell_type == 'code']
+            assert [len(cell.outputs) for cell in cells] == [1, 1]
+        captured = [cell.outputs[0].data for cell in nb.cells
+                    if cell.cell_type == 'code']
+        kernel = [cell.outputs[0].data for cell in kernel_nb.cells
+                  if cell.cell_type == 'code']
+        assert captured == kernel
+        assert captured[1]['text/plain'].startswith('[0,\n 1,\n')
+
+
+class TestCapturePrerun(TestCaptureNotebook):
+    """ Outputs captured in worker processes come through the figure cache
+    """
+
+    conf_source = TestCaptureNotebook.conf_source + 'nbplot_jobs = 2\n'
+
+
+class TestCaptureFallback(PlotsBuilder):
+    """ Run notebook in kernel if code cells not all from nbplot directives
+    """
+
+    conf_source = PlotsBuilder.conf_source + 'nbplot_capture = True\n'
+
+    rst_sources = {'a_page': """\
+Title
+#####
+
+:fullnotebook:`.`
+
+.. nbplot::
+
+    >>> b = 10
+
+Not from nbplot:
+
+>>> b + 1
+11
+"""}
+
+    def test_output(self):
+        nb = nbf.reads(self.get_built_file('a_page.ipynb'))
+        cells = [cell for cell in nb.cells if cell.cell_type == 'code']
+        assert cells[1].outputs[0].data['text/plain'] == '11'
@@ -112,3 +112,216 @@ def test_nb2plots():
     code, stdout, stderr = run_command(cmd)
     output = stdout.decode('utf-8')
     assert output.strip() == expected.strip()
+
+
+@script_test
+def test_sphinx2all(tmp_path):
+    src_path = tmp_path / 'proj'
+    src_path.mkdir()
+    (src_path / 'conf.py').write_text('extensions = ["nb2plots"]\n')
+    (src_path / 'index.rst').write_text((RST_MD_PATH / 'sect_text.rst')
+                                        .read_text())
+    out_path = tmp_path / 'build'
+    cmd = ['sphinx2all', str(src_path), str(out_path),
+           '-b', 'html', '-b', 'markdown']
+    code, stdout, stderr = run_command(cmd)
+    assert (out_path / 'html' / 'index.html').is_file()
+    output = (out_path / 'markdown' / 'index.md').read_text()
+    assert 'Some *text*.' in output
+
+
+@script_test
+def test_sphinx2md_many(tmp_path):
+    # Multiple files, directories and globs to output directory
+    in_path = tmp_path / 'in'
+    (in_path / 'sub').mkdir(parents=True)
+    names = ('sect_text', 'lists', 'sub/code')
+    for name in names:
+        src = RST_MD_PATH / (name.split('/')[-1] + '.rst')
+        (in_path / (name + '.rst')).write_text(src.read_text())
+    for jobs in ('1', '2'):
+        out_path = tmp_path / ('out' + jobs)
+        cmd = ['sphinx2md', str(in_path), '-o', str(out_path), '-j', jobs]
+        code, stdout, stderr = run_command(cmd)
+        for name in names:
+            out = out_path / (name + '.md')
+            expected = RST_MD_PATH / (name.split('/')[-1] + '.smd')
+            if not expected.is_file():
+                expected = expected.with_suffix('.md')
+            assert unsmart(out.read_text()) == expected.read_text()
+    out_path = tmp_path / 'out_glob'
+    cmd = ['sphinx2py', str(in_path / '*.rst'), str(in_path / 'sub' /
+                                                    'code.rst'),
+           '--output-dir', str(out_path)]
+    code, stdout, stderr = run_command(cmd)
+    assert sorted(p.name for p in out_path.iterdir()) == [
+        'code.py', 'lists.py', 'sect_text.py']
+
+
+@script_test
+def test_sphinx2md_many_errors(tmp_path):
+    # More than one file needs output directory
+    rst_paths = [str(RST_MD_PATH / 'sect_text.rst'),
+                 str(RST_MD_PATH / 'lists.rst')]
+    code, stdout, stderr = run_command(['sphinx2md'] + rst_paths,
+                                       check_code=False)
+    assert code != 0
+    assert b'--output-dir' in stderr
+    # Files that fail to convert give errors, others convert
+    bad_path = tmp_path / 'bad.rst'
+    bad_path.write_text('A ref to :ref:`nowhere`\n')
+    out_path = tmp_path / 'out'
+    code, stdout, stderr = run_command(
+        ['sphinx2md', '-W', str(bad_path), rst_paths[0],
+         '-o', str(out_path)], check_code=False)
+    assert code == 1
+    assert b'bad.rst' in stderr
+    assert (out_path / 'sect_text.md').is_file()
+    assert not (out_path / 'bad.md').exists()
+
+
+@script_test
+def test_sphinx2md_same_names(tmp_path):
+    # Different inputs that would write the same output give an error
+    for name, src in (('a', 'sect_text'), ('b', 'lists')):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'index.rst').write_text(
+            (RST_MD_PATH / (src + '.rst')).read_text())
+    out_path = tmp_path / 'out'
+    for inputs in (['a/index.rst', 'b/index.rst'], ['a', 'b']):
+        code, stdout, stderr = run_command(
+            ['sphinx2md'] + [str(tmp_path / i) for i in inputs] +
+            ['-o', str(out_path)], check_code=False)
+        assert code != 0
+        assert b'would both write output' in stderr
+        assert not out_path.exists()
+    # The same input twice is OK.
+    index_path = str(tmp_path / 'a' / 'index.rst')
+    run_command(['sphinx2md', index_path, index_path, '-o', str(out_path)])
+    # A glob keeps the directories.
+    run_command(['sphinx2md', str(tmp_path / '*' / 'index.rst'),
+                 '-o', str(out_path)])
+    assert (unsmart((out_path / 'a' / 'index.md').read_text()) ==
+            (RST_MD_PATH / 'sect_text.smd').read_text())
+    assert (unsmart((out_path / 'b' / 'index.md').read_text()) ==
+            (RST_MD_PATH / 'lists.md').read_text())
+
+
+@script_test
+def test_no_inputs(tmp_path):
+    # No matching input files is an error, with or without output directory
+    out_path = tmp_path / 'out'
+    for cmd, pattern in (('sphinx2md', '*.rst'), ('nb2plots', '*.ipynb')):
+        for extra in ([], ['-o', str(out_path)]):
+            code, stdout, stderr = run_command(
+                [cmd, str(tmp_path / pattern)] + extra, check_code=False)
+            assert code != 0
+            assert b'no input files' in stderr
+    assert not out_path.exists()
+
+
+def _write_code_nb(nb_path, codes):
+    # Write notebook with code cells, with outputs, to `nb_path`
+    import nbformat
+    v4 = nbformat.v4
+    nb = v4.new_notebook()
+    for i, code in enumerate(codes):
+        cell = v4.new_code_cell(code, execution_count=i + 1)
+        cell.outputs = [v4.new_output('execute_result', {'text/plain': code},
+                                      execution_count=i + 1)]
+        nb.cells.append(cell)
+    nb_path.parent.mkdir(parents=True, exist_ok=True)
+    nb_path.write_text(nbformat.writes(nb))
+
+
+@script_test
+def test_nb2plots_many(tmp_path):
+    # Convert notebooks in directories, skip unchanged notebooks
+    from nb2plots.from_notebook import convert_nb_fname
+    in_path = tmp_path / 'in'
+    names = ('one', 'two', 'sub/three')
+    for name in names:
+        _write_code_nb(in_path / (name + '.ipynb'), ['a = 1', name + '_b'])
+    # Checkpoint notebooks are in hidden directory
+    _write_code_nb(in_path / '.ipynb_checkpoints' / 'one-checkpoint.ipynb',
+                   ['a = 1'])
+    out_path = tmp_path / 'out'
+    cmd = ['nb2plots', str(in_path), '-o', str(out_path), '-j', '2']
+    code, stdout, stderr = run_command(cmd)
+    for name in names:
+        expected = convert_nb_fname(str(in_path / (name + '.ipynb'))) + '\n'
+        assert (out_path / (name + '.rst')).read_text() == expected
+    assert not (out_path / '.ipynb_checkpoints').exists()
+    # Second run skips all notebooks
+    code, stdout, stderr = run_command(cmd)
+    assert b'Skipped 3 unchanged' in stderr
+    # Changed notebook gets converted again
+    _write_code_nb(in_path / 'two.ipynb', ['c = 3'])
+    code, stdout, stderr = run_command(cmd)
+    assert b'Skipped 2 unchanged' in stderr
+    assert '>>> c = 3' in (out_path / 'two.rst').read_text()
+    # Deleted output gets converted again
+    (out_path / 'one.rst').unlink()
+    code, stdout, stderr = run_command(cmd)
+    assert b'Skipped 2 unchanged' in stderr
+    assert (out_path / 'one.rst').is_file()
+    # Force converts all
+    code, stdout, stderr = run_command(cmd + ['--force'])
+    assert b'Skipped' not in stderr
+
+
+@script_test
+def test_nb2plots_same_names(tmp_path):
+    # Hashes are for input notebooks, not output files
+    from nb2plots.from_notebook import convert_nb_fname
+    a_path = tmp_path / 'a' / 'index.ipynb'
+    b_path = tmp_path / 'b' / 'index.ipynb'
+    _write_code_nb(a_path, ['a = 1'])
+    _write_code_nb(b_path, ['b = 2'])
+    out_path = tmp_path / 'out'
+    out_rst = out_path / 'index.rst'
+    # Same names from different directories give an error
+    code, stdout, stderr = run_command(
+        ['nb2plots', str(a_path), str(b_path), '-o', str(out_path)],
+        check_code=False)
+    assert code != 0
+    assert b'would both write output' in stderr
+    # A glob keeps the directories
+    run_command(['nb2plots', str(tmp_path / '*' / 'index.ipynb'),
+                 '-o', str(out_path)])
+    assert (out_path / 'a' / 'index.rst').is_file()
+    assert (out_path / 'b' / 'index.rst').is_file()
+    # Notebooks that write the same output in different runs
+    for nb_path in (a_path, b_path, a_path):
+        code, stdout, stderr = run_command(
+            ['nb2plots', str(nb_path), '-o', str(out_path)])
+        assert b'Skipped' not in stderr
+        assert out_rst.read_text() == convert_nb_fname(str(nb_path)) + '\n'
+    code, stdout, stderr = run_command(
+        ['nb2plots', str(a_path), '-o', str(out_path)])
+    assert b'Skipped 1 unchanged' in stderr
+
+
+@script_test
+def test_nb2plots_many_errors(tmp_path):
+    nb_path = tmp_path / 'good.ipynb'
+    _write_code_nb(nb_path, ['a = 1'])
+    # More than one notebook needs output directory
+    code, stdout, stderr = run_command(['nb2plots', str(nb_path),
+                                        str(nb_path)], check_code=False)
+    assert code != 0
+    assert b'--output-dir' in stderr
+    # Notebooks that fail give errors, others convert
+    bad_path = tmp_path / 'bad.ipynb'
+    bad_path.write_text('Not a notebook')
+    out_path = tmp_path / 'out'
+    cmd = ['nb2plots', str(tmp_path / '*.ipynb'), '-o', str(out_path)]
+    code, stdout, stderr = run_command(cmd, check_code=False)
+    assert code == 1
+    assert b'bad.ipynb' in stderr
+    assert (out_path / 'good.rst').is_file()
+    # Failed notebooks are not skipped on next run
+    code, stdout, stderr = run_command(cmd, check_code=False)
+    assert code == 1
+    assert b'Skipped 1 unchanged' in stderr
+    assert b'bad.ipynb' in stderr
@@ -0,0 +1,257 @@
+""" Tests for conversion server
+"""
+
+import os
+from os.path import exists
+import json
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import pytest
+
+from scripttester import ScriptTester
+
+from nb2plots import server
+from nb2plots.commands import convert_files
+from nb2plots.converters import NbConverter
+from nb2plots.testing.convutils import unsmart
+
+runner = ScriptTester('nb2plots', win_bin_ext='.bat')
+run_command = runner.run_command
+
+RST_MD_PATH = Path(__file__).parent / 'rst_md_files'
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32',
+                                reason='Needs Unix sockets')
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    path = str(tmp_path / 'server.sock')
+    srv = server.make_server(path, jobs=2, buildernames=('markdown',))
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.start()
+    yield path
+    srv.shutdown()
+    thread.join()
+    srv.server_close()
+    assert not exists(path)
+
+
+def test_convert(socket_path):
+    assert server.server_running(socket_path)
+    rst = (RST_MD_PATH / 'sect_text.rst').read_text()
+    for buildername in ('markdown', 'python'):
+        expected = NbConverter(buildername, status=None).from_rst(rst)
+        assert server.convert(rst, buildername,
+                              socket_path=socket_path) == expected
+    # Conversion errors come back as ServerError
+    with pytest.raises(server.ServerError):
+        server.convert('A ref to :ref:`nowhere`\n', 'markdown', True,
+                       socket_path=socket_path)
+    # Without error for warnings, we get the conversion.
+    assert 'nowhere' in server.convert('A ref to :ref:`nowhere`\n',
+                                       'markdown', False,
+                                       socket_path=socket_path)
+    # Bad requests give errors
+    assert 'error' in server.request(dict(rst='Text'), socket_path)
+
+
+def test_concurrent(socket_path):
+    # Many requests at the same time give the right answers.
+    texts = ['Text number {}\n'.format(i) for i in range(12)]
+    with ThreadPoolExecutor(6) as executor:
+        outputs = list(executor.map(
+            lambda t: server.convert(t, 'markdown', socket_path=socket_path),
+            texts))
+    assert [o.strip() for o in outputs] == [t.strip() for t in texts]
+
+
+def test_not_running(tmp_path):
+    path = str(tmp_path / 'no_server.sock')
+    assert not server.server_running(path)
+    with pytest.raises(OSError):
+        server.convert('Text', 'markdown', socket_path=path)
+
+
+def test_already_running(socket_path):
+    with pytest.raises(RuntimeError):
+        server.make_server(socket_path)
+
+
+def test_default_socket_path(monkeypatch, tmp_path):
+    monkeypatch.delenv(server.SOCKET_VAR, raising=False)
+    monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+    # Socket in directory for this user, in temporary directory.
+    monkeypatch.setattr(server, 'gettempdir', lambda: str(tmp_path))
+    path = server.default_socket_path()
+    assert path == str(tmp_path / 'nb2plots-{}'.format(os.getuid()) /
+                       'server.sock')
+    monkeypatch.setenv('XDG_RUNTIME_DIR', 'run_dir')
+    assert server.default_socket_path() == os.path.join('run_dir',
+                                                        'nb2plots.sock')
+    monkeypatch.setenv(server.SOCKET_VAR, 'my.sock')
+    assert server.default_socket_path() == 'my.sock'
+    # Server makes directory for default socket, only for this user.
+    monkeypatch.delenv(server.SOCKET_VAR)
+    monkeypatch.delenv('XDG_RUNTIME_DIR')
+    srv = server.make_server(jobs=1, buildernames=())
+    try:
+        assert srv.server_address == path
+        assert os.stat(os.path.dirname(path)).st_mode & 0o777 == 0o700
+    finally:
+        srv.server_close()
+
+
+def test_private_dir(tmp_path):
+    path = tmp_path / 'a_dir'
+    server._private_dir(str(path))
+    assert path.stat().st_mode & 0o777 == 0o700
+    server._private_dir(str(path))
+    # Other users can get into directory.
+    path.chmod(0o755)
+    with pytest.raises(PermissionError):
+        server._private_dir(str(path))
+    # Not a directory.
+    a_file = tmp_path / 'a_file'
+    a_file.write_text('')
+    with pytest.raises(PermissionError):
+        server._private_dir(str(a_file))
+
+
+def _with_socket(path, func, *args, **kwargs):
+    old = os.environ.get(server.SOCKET_VAR)
+    os.environ[server.SOCKET_VAR] = path
+    try:
+        return func(*args, **kwargs)
+    finally:
+        if old is None:
+            del os.environ[server.SOCKET_VAR]
+        else:
+            os.environ[server.SOCKET_VAR] = old
+
+
+def test_script_server(socket_path, tmp_path):
+    # Scripts send conversions to server with --server
+    rst_path = RST_MD_PATH / 'sect_text.rst'
+    expected = (RST_MD_PATH / 'sect_text.smd').read_text()
+    code, stdout, stderr = _with_socket(
+        socket_path, run_command, ['sphinx2md', '--server', str(rst_path)])
+    assert unsmart(stdout.decode('utf-8')) == expected
+    # Sphinx status messages only come from conversion in script.
+    assert b'build succeeded' not in stderr
+    out_path = tmp_path / 'out'
+    code, stdout, stderr = _with_socket(
+        socket_path, run_command,
+        ['sphinx2md', '--server', str(rst_path), '-o', str(out_path)])
+    assert unsmart((out_path / 'sect_text.md').read_text()) == expected
+
+
+def test_script_fallback(tmp_path):
+    # Scripts convert in process when server is not running
+    rst_path = RST_MD_PATH / 'sect_text.rst'
+    expected = (RST_MD_PATH / 'sect_text.smd').read_text()
+    path = str(tmp_path / 'no_server.sock')
+    code, stdout, stderr = _with_socket(
+        path, run_command, ['sphinx2md', '--server', str(rst_path)])
+    assert unsmart(stdout.decode('utf-8')) == expected
+    out_path = tmp_path / 'out'
+    code, stdout, stderr = _with_socket(
+        path, run_command,
+        ['sphinx2md', '--server', str(rst_path), '-o', str(out_path)])
+    assert unsmart((out_path / 'sect_text.md').read_text()) == expected
+
+
+def test_convert_files_server_died(socket_path, tmp_path, monkeypatch):
+    # Files convert in process after the server stops.
+    rst_paths = []
+    for i in range(3):
+        rst_path = tmp_path / 'page_{}.rst'.format(i)
+        rst_path.write_text('Text number {}\n'.format(i))
+        rst_paths.append(str(rst_path))
+    server_convert = server.convert
+    calls = []
+
+    def convert(*args, **kwargs):
+        calls.append(args[0])
+        if len(calls) > 1:
+            raise ConnectionRefusedError('Server died')
+        return server_convert(*args, **kwargs)
+
+    monkeypatch.setenv(server.SOCKET_VAR, socket_path)
+    monkeypatch.setattr(server, 'convert', convert)
+    out_path = tmp_path / 'out'
+    errors = convert_files([(p, os.path.basename(p)) for p in rst_paths],
+                           str(out_path),
+                           'markdown',
+                           use_server=True)
+    assert errors == {}
+    assert len(calls) == 3
+    for i in range(3):
+        md = (out_path / 'page_{}.md'.format(i)).read_text()
+        assert md.strip() == 'Text number {}'.format(i)
+
+
+def test_other_owner(socket_path, monkeypatch):
+    # We do not send requests to a socket belonging to another user.
+    uid = os.getuid()
+    monkeypatch.setattr(server.os, 'getuid', lambda: uid + 1)
+    assert not server.server_running(socket_path)
+    with pytest.raises(PermissionError):
+        server.convert('Text', 'markdown', socket_path=socket_path)
+
+
+@pytest.fixture
+def stuck_path(tmp_path):
+    # Socket for server that answers pings, but not conversions.
+    path = str(tmp_path / 'stuck.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen()
+    connections = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                break
+            req = json.loads(server._recv_all(conn).decode('utf-8'))
+            if req.get('command') == 'ping':
+                conn.sendall(b'{"ping": "pong"}')
+                conn.close()
+            else:
+                connections.append(conn)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield path
+    listener.shutdown(socket.SHUT_RDWR)
+    listener.close()
+    thread.join()
+    for conn in connections:
+        conn.close()
+
+
+def test_convert_timeout(stuck_path, tmp_path, monkeypatch):
+    assert server.server_running(stuck_path)
+    with pytest.raises(OSError):
+        server.convert('Text', 'markdown', socket_path=stuck_path,
+                       timeout=0.5)
+    # Files convert in process when the server does not reply in time.
+    rst_path = tmp_path / 'page.rst'
+    rst_path.write_text('Some text\n')
+    monkeypatch.setenv(server.SOCKET_VAR, stuck_path)
+    monkeypatch.setattr(server, 'convert',
+                        partial(server.convert, timeout=0.5))
+    out_path = tmp_path / 'out'
+    errors = convert_files([(str(rst_path), 'page.rst')],
+                           str(out_path),
+                           'markdown',
+                           use_server=True)
+    assert errors == {}
+    assert (out_path / 'page.md').read_text().strip() == 'Some text'
@@ -133,3 +133,11 @@ Add :longerfullnotebook:`long <long.ipynb>`
     >>> from time import sleep
     >>> sleep(5)
 """}
+
+
+class TestJobsTimeout(TestConfTimeout):
+    """ Errors from notebooks filled in worker processes stop the build
+    """
+
+    conf_source = (TestConfTimeout.conf_source +
+                   '\nfill_notebook_jobs = 2')
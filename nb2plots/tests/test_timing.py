@@ -0,0 +1,71 @@
+""" Tests for timing module
+"""
+
+import json
+
+from nb2plots.timing import timing_report, REPORT_NAME
+
+from nb2plots.testing import PlotsBuilder
+
+
+def test_timing_report():
+    report = timing_report(
+        {'a': [dict(lineno=4, wall=1., exec=0.5, n_figures=1),
+               dict(lineno=10, cached=True)],
+         'b': [dict(lineno=3, wall=3., exec=2., n_figures=0)]},
+        {'a': dict(wall=4., cells=[1., 2.])})
+    assert report['documents'] == [
+        dict(docname='a', wall=5., nbplot=1., notebook=4., n_blocks=2),
+        dict(docname='b', wall=3., nbplot=3., notebook=0., n_blocks=1)]
+    assert [(b['docname'], b['lineno']) for b in report['blocks']] == [
+        ('b', 3), ('a', 4), ('a', 10)]
+    assert report['notebooks'] == [dict(docname='a', wall=4., cells=[1., 2.])]
+
+
+class TestTiming(PlotsBuilder):
+    """ Build writes timing report
+    """
+
+    conf_source = PlotsBuilder.conf_source + 'nbplot_timing = True\n'
+
+    rst_sources = {'a_page': """\
+Title
+#####
+
+:fullnotebook:`.`
+
+.. nbplot::
+
+    >>> import matplotlib.pyplot as plt
+    >>> a = 1
+
+.. nbplot::
+
+    >>> plt.plot(range(a + 2))
+    [...]
+"""}
+
+    def test_report(self):
+        report = json.loads(self.get_built_file(REPORT_NAME))
+        doc, = report['documents']
+        assert doc['docname'] == 'a_page'
+        assert doc['n_blocks'] == 2
+        assert doc['notebook'] > 0
+        assert doc['wall'] == doc['nbplot'] + doc['notebook']
+        blocks = sorted(report['blocks'], key=lambda b: b['lineno'])
+        assert [b['lineno'] for b in blocks] == [8, 13]
+        assert [b['n_figures'] for b in blocks] == [0, 1]
+        assert sorted(blocks[1]['savefig']) == ['hires.png', 'pdf', 'png']
+        for block in blocks:
+            assert block['wall'] >= block['exec']
+            assert not block['error']
+        notebook, = report['notebooks']
+        assert len(notebook['cells']) == 2
+        assert all(t >= 0 for t in notebook['cells'])
+
+
+class TestPrerunTiming(TestTiming):
+    """ Timings come back from worker processes
+    """
+
+    conf_source = TestTiming.conf_source + 'nbplot_jobs = 2\n'
@@ -0,0 +1,95 @@
+""" Tests for trace module
+"""
+
+import os
+import json
+
+from nb2plots.trace import span, collect_events, TRACE_DIR_VAR
+
+from nb2plots.testing import PlotsBuilder
+
+
+def test_span(tmpdir):
+    # No trace directory, no events
+    with span('foo', 'bar'):
+        pass
+    os.environ[TRACE_DIR_VAR] = str(tmpdir)
+    try:
+        with span('foo', 'bar', baz=1):
+            pass
+    finally:
+        del os.environ[TRACE_DIR_VAR]
+    events = collect_events(str(tmpdir), os.getpid())
+    assert [e['ph'] for e in events] == ['M', 'X']
+    assert events[0]['args'] == dict(name='sphinx main')
+    event = events[1]
+    assert (event['name'], event['cat']) == ('foo', 'bar')
+    assert event['args'] == dict(baz=1)
+    assert event['dur'] >= 0
+
+
+class TestTrace(PlotsBuilder):
+    """ Build writes trace file
+    """
+
+    conf_source = PlotsBuilder.conf_source + 'nbplot_trace = "trace.json"\n'
+
+    rst_sources = {'a_page': """\
+Title
+#####
+
+:fullnotebook:`.` :pyfile:`.`
+
+.. nbplot::
+
+    >>> a = 1
+
+.. nbplot::
+
+    >>> b = a + 2
+"""}
+
+    # Category of spans expected in trace
+    categories = {'build', 'read', 'nbplot', 'runrole', 'kernel'}
+
+    def get_events(self):
+        trace = json.loads(self.get_built_file('trace.json'))
+        return trace['traceEvents']
+
+    def test_trace(self):
+        assert TRACE_DIR_VAR not in os.environ
+        events = self.get_events()
+        spans = [e for e in events if e['ph'] == 'X']
+        assert {e['cat'] for e in spans} == self.categories
+        names = {e['name'] for e in spans if e['cat'] == 'nbplot'}
+        assert names == {'a_page:8', 'a_page:12'}
+        assert 'a_page' in {e['name'] for e in spans if e['cat'] == 'read'}
+        build, = [e for e in spans if e['cat'] == 'build']
+        for event in spans:
+            assert event['ts'] >= build['ts']
+            assert event['ts'] + event['dur'] <= build['ts'] + build['dur']
+        assert 'sphinx main' in [e['args']['name'] for e in events
+                                 if e['ph'] == 'M']
+
+
+class TestPrerunTrace(TestTrace):
+    """ Trace picks up events from worker processes
+    """
+
+    conf_source = TestTrace.conf_source + 'nbplot_jobs = 2\n'
+
+    categories = TestTrace.categories | {'prerun'}
+
+    def test_workers(self):
+        events = self.get_events()
+        pids = {e['pid'] for e in events if e.get('cat') == 'prerun'
+                if e['name'] != 'nbplot prerun'}
+        assert os.getpid() not in pids
+
+
+class TestNoTrace(PlotsBuilder):
+    """ No trace without configuration
+    """
+
+    def test_no_trace(self):
+        assert not os.path.exists(os.path.join(self.out_dir, 'trace.json'))
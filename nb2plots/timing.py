@@ -0,0 +1,111 @@
+""" Report time spent running nbplot code and filling notebooks
+
+With the ``nbplot_timing`` configuration option set to True, the nbplot
+directives record timings for the code they run, and the ``fullnotebook`` role
+records timings for the notebooks it fills in a Jupyter kernel.  At the end of
+the build, we write a report of these timings to ``nbplot_timing.json`` in the
+output directory.  The report is a dict with keys:
+
+* ``documents``: list of dicts, one per document, slowest first, with keys
+  ``docname``, ``wall`` (total seconds), ``nbplot`` (seconds in nbplot
+  directives), ``notebook`` (seconds filling the full notebook) and
+  ``n_blocks`` (number of nbplot directives).
+* ``blocks``: list of dicts, one per nbplot directive, slowest first, with
+  keys ``docname``, ``lineno``, ``error``, and the timings from
+  :func:`nb2plots.nbplots.render_figures`.  Directives taking their figures
+  from the image cache have ``cached`` set to True, and no timings.
+* ``notebooks``: list of dicts, one per full notebook filled in a kernel,
+  slowest first, with keys ``docname``, ``wall``, and ``cells``, giving the
+  execution time of each code cell.
+
+Timings for each document come from the last time Sphinx read the document,
+which may be from an earlier build.  Timings for notebooks come from this
+build.
+"""
+
+import json
+from os.path import join as pjoin
+
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+REPORT_NAME = 'nbplot_timing.json'
+
+# Number of slowest documents and blocks to show in build output.
+N_SLOWEST = 5
+
+
+def _by_wall(timings):
+    return sorted(timings, key=lambda t: t.get('wall', 0), reverse=True)
+
+
+def timing_report(block_timings, notebook_timings):
+    """ Return timing report from block and notebook timings
+
+    Parameters
+    ----------
+    block_timings : dict
+        Dict with keys being document names, and values being lists of dicts
+        with timings for nbplot directives in document.
+    notebook_timings : dict
+        Dict with keys being document names, and values being dicts with
+        timings for filling notebook for document.
+
+    Returns
+    -------
+    report : dict
+        Timing report.  See module docstring.
+    """
+    documents = {}
+
+    def doc_record(docname):
+        return documents.setdefault(docname, dict(docname=docname,
+                                                  wall=0.,
+                                                  nbplot=0.,
+                                                  notebook=0.,
+                                                  n_blocks=0))
+
+    blocks = []
+    for docname, timings in block_timings.items():
+        record = doc_record(docname)
+        for timing in timings:
+            record['nbplot'] += timing.get('wall', 0)
+            record['n_blocks'] += 1
+            blocks.append(dict(docname=docname, **timing))
+    notebooks = []
+    for docname, timing in notebook_timings.items():
+        doc_record(docname)['notebook'] += timing['wall']
+        notebooks.append(dict(docname=docname, **timing))
+    for record in documents.values():
+        record['wall'] = record['nbplot'] + record['notebook']
+    return dict(documents=_by_wall(documents.values()),
+                blocks=_by_wall(blocks),
+                notebooks=_by_wall(notebooks))
+
+
+def write_timing_report(app, exception):
+    """ Write timing report to output directory, show summary
+
+    Called at ``build-finished`` event, after runroles have filled the
+    notebooks.
+    """
+    if exception is not None or not app.config.nbplot_timing:
+        return
+    env = app.env
+    report = timing_report(env.nbplot_timings,
+                           getattr(env, 'runrole_timings', {}))
+    with open(pjoin(app.outdir, REPORT_NAME), 'wt') as fobj:
+        json.dump(report, fobj, indent=1)
+    logger.info('nbplot timings written to {}'.format(REPORT_NAME))
+    for record in report['documents'][:N_SLOWEST]:
+        logger.info('  {docname}: {wall:.2f}s (nbplot {nbplot:.2f}s, '
+                    'notebook {notebook:.2f}s)'.format(**record))
+    blocks = [block for block in report['blocks'] if 'wall' in block]
+    for block in blocks[:N_SLOWEST]:
+        logger.info('  {0}, line {1}: {2:.2f}s (exec {3:.2f}s, '
+                    '{4} figures)'.format(block['docname'],
+                                          block['lineno'],
+                                          block['wall'],
+                                          block.get('exec', block['wall']),
+                                          block.get('n_figures', 0)))
@@ -0,0 +1,188 @@
+""" Timeline of nb2plots build phases, as Chrome trace events
+
+Set the ``nbplot_trace`` configuration option, or the ``NB2PLOTS_TRACE``
+environment variable, to a file name, to write a timeline of the build to that
+file in the output directory.  The configuration option takes precedence.
+The timeline has spans for:
+
+* reading each document;
+* running nbplot code in worker processes before reading (see
+  ``nbplot_jobs``), and for each document in the workers;
+* running each nbplot directive;
+* building each runrole output at the end of the build;
+* starting Jupyter kernels, and running notebooks in them.
+
+The file is in Chrome trace event JSON format.  Open it in
+``chrome://tracing`` or https://ui.perfetto.dev.  Each process in the build,
+including Sphinx parallel read processes and our worker processes, has its own
+row.
+
+Processes write their events to files in a temporary directory, one file per
+process, so events from worker processes do not need to pass back through
+Sphinx.  At the end of the build, we collect these into the timeline.
+"""
+
+import os
+from os.path import join as pjoin, isdir
+import json
+import time
+import threading
+import shutil
+from glob import glob
+from contextlib import contextmanager
+from tempfile import mkdtemp
+
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+# Environment variable giving trace file name.
+TRACE_VAR = 'NB2PLOTS_TRACE'
+
+# Environment variable giving directory for trace events during build.  Worker
+# processes inherit the environment, whatever their start method.
+TRACE_DIR_VAR = '_NB2PLOTS_TRACE_DIR'
+
+# Start time of traced build.
+_build_start = None
+
+
+def _now():
+    # Microseconds, comparable across processes.
+    return time.time_ns() / 1000
+
+
+def add_event(name, cat, start, end, **args):
+    """ Record span `name` in category `cat` from `start` to `end`
+
+    Do nothing if we are not tracing.
+
+    Parameters
+    ----------
+    name : str
+        Name of span.
+    cat : str
+        Category of span.
+    start : float
+        Start time in microseconds since the epoch.
+    end : float
+        End time in microseconds since the epoch.
+    args : dict
+        Any further keyword arguments give extra information to attach to the
+        span.
+    """
+    trace_dir = os.environ.get(TRACE_DIR_VAR)
+    if trace_dir is None or not isdir(trace_dir):
+        return
+    event = dict(name=name,
+                 cat=cat,
+                 ph='X',
+                 ts=start,
+                 dur=end - start,
+                 pid=os.getpid(),
+                 tid=threading.get_ident() % 2 ** 31,
+                 args=args)
+    with open(pjoin(trace_dir, '%d.jsonl' % os.getpid()), 'at') as fobj:
+        fobj.write(json.dumps(event) + '\n')
+
+
+@contextmanager
+def span(name, cat, **args):
+    """ Context manager to record span `name` while running block
+
+    See :func:`add_event` for parameters.
+    """
+    if TRACE_DIR_VAR not in os.environ:
+        yield
+        return
+    start = _now()
+    try:
+        yield
+    finally:
+        add_event(name, cat, start, _now(), **args)
+
+
+def get_trace_fname(config):
+    """ Return trace file name from `config` or environment, or None
+    """
+    if config.nbplot_trace is not None:
+        return config.nbplot_trace
+    return os.environ.get(TRACE_VAR) or None
+
+
+def start_trace(app):
+    """ Start collecting trace events, if trace requested
+
+    Called at ``builder-inited`` event.
+    """
+    global _build_start
+    if get_trace_fname(app.config) is None:
+        return
+    os.environ[TRACE_DIR_VAR] = mkdtemp()
+    _build_start = _now()
+
+
+def trace_read_start(app, docname, source):
+    """ Record start of reading `docname`
+
+    Called at ``source-read`` event.
+    """
+    if TRACE_DIR_VAR in os.environ:
+        app.env.temp_data['nbplot_trace_read'] = _now()
+
+
+def trace_read_end(app, doctree):
+    """ Record end of reading document
+
+    Called at ``doctree-read`` event.
+    """
+    start = app.env.temp_data.get('nbplot_trace_read')
+    if start is not None:
+        add_event(app.env.docname, 'read', start, _now())
+
+
+def collect_events(trace_dir, main_pid=None):
+    """ Return trace events from files in `trace_dir`
+
+    Add process name metadata events, naming the process with `main_pid` as
+    the main process, and other processes as workers.
+    """
+    events = []
+    pids = set()
+    for fname in sorted(glob(pjoin(trace_dir, '*.jsonl'))):
+        with open(fname, 'rt') as fobj:
+            for line in fobj:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                pids.add(event['pid'])
+                events.append(event)
+    for pid in sorted(pids):
+        name = ('sphinx main' if pid == main_pid
+                else 'worker {}'.format(pid))
+        events.append(dict(name='process_name', ph='M', pid=pid,
+                           args=dict(name=name)))
+    return sorted(events, key=lambda e: e.get('ts', 0))
+
+
+def write_trace(app, exception):
+    """ Write trace file to output directory, stop collecting events
+
+    Called at ``build-finished`` event, after runroles have built their
+    outputs.
+    """
+    trace_dir = os.environ.get(TRACE_DIR_VAR)
+    if trace_dir is None:
+        return
+    add_event('build', 'build', _build_start, _now())
+    del os.environ[TRACE_DIR_VAR]
+    try:
+        events = collect_events(trace_dir, os.getpid())
+    finally:
+        shutil.rmtree(trace_dir)
+    if exception is not None:
+        return
+    fname = pjoin(app.outdir, get_trace_fname(app.config))
+    with open(fname, 'wt') as fobj:
+        json.dump(dict(traceEvents=events, displayTimeUnit='ms'), fobj)
+    logger.info('nb2plots trace written to {}'.format(fname))
@@ -0,0 +1,16 @@
+""" Docutils output that returns the written text
+"""
+
+from docutils.io import Output
+
+
+class UnicodeOutput(Output):
+    """ Don't do anything to the string; just return it.
+    """
+
+    default_destination_path = '<string>'
+
+    def write(self, data):
+        """ Store `data` in `self.destination`, and return it."""
+        self.destination = data
+        return data
@@ -112,7 +112,9 @@ setup(name='nb2plots',
                  'scripts/sphinx2py',
                  'scripts/sphinx2md',
                  'scripts/sphinx2pxml',
-                 'scripts/rst2md'],
+                 'scripts/sphinx2all',
+                 'scripts/rst2md',
+                 'scripts/nb2plots-server'],
       long_description = open('README.rst', 'rt').read(),
       install_requires = install_requires,
       extras_require = {'test': test_requires},
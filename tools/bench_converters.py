@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+""" Compare per-call latency of cold and warm converters
+
+Usage::
+
+    python tools/bench_converters.py [n_calls]
+
+Converts a short ReST page to Markdown `n_calls` times with
+:class:`nb2plots.converters.NbConverter`, which makes a new Sphinx application
+for each call, and with :class:`nb2plots.converters.WarmNbConverter`, which
+reuses one application.  Then converts `n_calls` pages in one build, with
+:meth:`nb2plots.converters.Converter.from_rst_many`.
+"""
+
+import sys
+import time
+from statistics import median
+
+from nb2plots.converters import NbConverter, WarmNbConverter
+
+PAGE = """\
+A title
+=======
+
+Some *text* with ``code``.
+
+.. nbplot::
+
+    >>> a = {}
+    >>> a * 2
+    {}
+"""
+
+
+def call_times(converter, n_calls):
+    times = []
+    for i in range(n_calls):
+        start = time.perf_counter()
+        converter.from_rst(PAGE.format(i, i * 2))
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    n_calls = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    cold = call_times(NbConverter('markdown', status=None), n_calls)
+    with WarmNbConverter('markdown', status=None) as converter:
+        warm = call_times(converter, n_calls)
+    for name, times in (('cold', cold), ('warm', warm)):
+        print('{}: first {:.1f}ms, median {:.1f}ms, total {:.2f}s'.format(
+            name, times[0] * 1000, median(times) * 1000, sum(times)))
+    texts = {i: PAGE.format(i, i * 2) for i in range(n_calls)}
+    start = time.perf_counter()
+    NbConverter('markdown', status=None).from_rst_many(texts)
+    total = time.perf_counter() - start
+    print('batch: per page {:.1f}ms, total {:.2f}s'.format(
+        total / n_calls * 1000, total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+""" Time notebook to ReST conversion for large notebooks
+
+Usage::
+
+    python tools/bench_from_notebook.py [n_cells [output_kb [interleave]]]
+
+Makes a notebook with `n_cells` code cells, each with printed output of about
+`output_kb` kilobytes, an end-of-cell result, and a figure.  If `interleave`
+is 1, put a raw cell before each code cell, as for a notebook with text
+between the code cells.  (We use raw cells because Markdown cells need
+pandoc, and pandoc time does not depend on the code cells.)
+
+Converts the notebook with :func:`nb2plots.from_notebook.convert_nb`, and
+converts a notebook with twice as many cells, to check the time goes up in
+proportion to the size of the notebook.  Shows the time and peak memory for
+each.
+"""
+
+import sys
+import time
+import tracemalloc
+
+import nbformat
+
+from nb2plots.from_notebook import make_exporter, convert_nb
+
+
+def make_notebook(n_cells, output_kb, interleave=False):
+    v4 = nbformat.v4
+    nb = v4.new_notebook()
+    line = 'Some printed output, with a number {}\n'
+    n_lines = output_kb * 1024 // len(line)
+    for i in range(n_cells):
+        if interleave:
+            nb.cells.append(v4.new_raw_cell(
+                'Some text about cell {}.\n\nMore text.'.format(i)))
+        cell = v4.new_code_cell(
+            'for i in range({}):\n    print(i)\nplt.plot([{}])'.format(
+                n_lines, i),
+            execution_count=i + 1)
+        cell.outputs = [
+            v4.new_output('stream', name='stdout',
+                          text=''.join(line.format(j)
+                                       for j in range(n_lines))),
+            v4.new_output('execute_result',
+                          {'text/plain': '[<matplotlib.lines.Line2D at '
+                           '0x{:x}>]'.format(i)},
+                          execution_count=i + 1),
+            v4.new_output('display_data',
+                          {'image/png': 'iVBORw0KGgo' * 5000,
+                           'text/plain': '<Figure size 640x480>'})]
+        nb.cells.append(cell)
+    return nb
+
+
+def measure(func, *args):
+    # Time without tracing memory, which slows Python code.
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak / 2 ** 20
+
+
+def main():
+    n_cells = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    output_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    interleave = bool(int(sys.argv[3])) if len(sys.argv) > 3 else False
+    exporter = make_exporter()
+    for n in (n_cells, n_cells * 2):
+        nb = make_notebook(n, output_kb, interleave)
+        rst, elapsed, peak = measure(convert_nb, nb, exporter)
+        print('{} cells: {:.2f}s, peak {:.0f}MB, {:.0f}MB ReST'.format(
+            n, elapsed, peak, len(rst) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
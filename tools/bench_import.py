@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+""" Time ``import nb2plots`` in fresh Python processes
+
+Usage::
+
+    python tools/bench_import.py [n_repeats]
+
+Prints the median, and best, import times in milliseconds, and the modules
+taking the longest to import, from ``python -X importtime``.
+"""
+
+import sys
+import subprocess
+from statistics import median
+
+
+def import_times(module_name='nb2plots'):
+    """ Return list of (cumulative usec, module name) for importing module
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           'import ' + module_name],
+                          stderr=subprocess.PIPE, check=True)
+    times = []
+    for line in proc.stderr.decode('latin1').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cum_us, name = line[len('import time:'):].split('|')
+        times.append((int(cum_us), name.strip()))
+    return times
+
+
+def main():
+    n_repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    totals = []
+    for i in range(n_repeats):
+        times = import_times()
+        totals.append(times[-1][0] / 1000)
+    print('import nb2plots: median {:.1f}ms, best {:.1f}ms'.format(
+        median(totals), min(totals)))
+    top_level = [(t, name) for t, name in times if '.' not in name]
+    for t, name in sorted(top_level, reverse=True)[:10]:
+        print('{:10.1f}ms  {}'.format(t / 1000, name))
+
+
+if __name__ == '__main__':
+    main()